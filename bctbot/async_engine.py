@@ -0,0 +1,172 @@
+import asyncio
+import time
+
+from ccxt.base.errors import ExchangeError, NetworkError
+from metrics import METRICS, PhaseTimer
+from utils import async_retry
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+
+class AsyncTradingEngine:
+    """ Runs the TradingBot cycle on asyncio, polling all exchanges and markets concurrently.
+
+    Balances and tickers are fetched through the ccxt.async_support twin of every Exchange, while the
+    strategies keep running on the synchronous objects. Events are only dispatched after all data of a
+    cycle is in, one market at a time, so every market still sees its balance event before its price event.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.clients = {}
+        self.semaphores = {}
+        self.client_exchanges = {}          # Exchange name -> the Exchange its client was created for
+
+    async def start(self):
+        self.bot.start_feeds()
+        await self.sync_clients()
+
+    async def sync_clients(self):
+        """ Creates the clients of exchanges added or rebuilt since the last cycle and closes the ones of removed
+        exchanges. """
+        for exch_name in list(self.clients):
+            if self.bot.exchanges.get(exch_name) is not self.client_exchanges[exch_name]:
+                await self.clients.pop(exch_name).close()
+                del self.semaphores[exch_name], self.client_exchanges[exch_name]
+        for exch_name, exchange in self.bot.exchanges.items():
+            if exch_name not in self.clients:
+                self.clients[exch_name] = exchange.create_async_client()
+                # ccxt throttles requests by rateLimit, the semaphore caps how many are in flight at once
+                self.semaphores[exch_name] = asyncio.Semaphore(exchange.max_concurrent_requests)
+                self.client_exchanges[exch_name] = exchange
+
+    async def close(self):
+        self.bot.stop_feeds()
+        for client in self.clients.values():
+            await client.close()
+        self.clients = {}
+        self.semaphores = {}
+        self.client_exchanges = {}
+
+    @async_retry(NetworkError, tries=3, key=lambda self, f, exch_name, method, *args: (exch_name, method))
+    async def request(self, exch_name, method, *args):
+        async with self.semaphores[exch_name]:
+            rate_limiter = self.bot.exchanges[exch_name].rate_limiter
+            if rate_limiter is not None:
+                # Shared with the orders the strategies place from the synchronous exchange
+                waited = await asyncio.get_running_loop().run_in_executor(None, rate_limiter.acquire, method)
+                METRICS.observe("bctbot_rate_limit_wait_seconds", waited, exchange=exch_name, endpoint=method)
+            recorder = self.bot.exchanges[exch_name].recorder
+            start = time.perf_counter()
+            try:
+                response = await getattr(self.clients[exch_name], method)(*args)
+            except Exception as e:
+                METRICS.inc("bctbot_api_errors_total", exchange=exch_name, endpoint=method, error=e.__class__.__name__)
+                if recorder is not None:
+                    recorder.record(method, args, {}, time.perf_counter() - start, error=e)
+                raise
+            finally:
+                METRICS.observe("bctbot_api_request_seconds", time.perf_counter() - start,
+                                exchange=exch_name, endpoint=method)
+            if recorder is not None:
+                recorder.record(method, args, {}, time.perf_counter() - start, response)
+            return response
+
+    async def fetch_prices(self, exch_name, exchange, symbols):
+        """ Fetches the tickers of the given symbols, batched per fetch_tickers call where supported.
+
+        :return: dict of symbol to ticker, or to the exception raised while fetching it
+        """
+        tickers = {}
+        if exchange.has.get("fetchTickers"):
+            batches = exchange.ticker_batches(symbols)
+            results = await asyncio.gather(*[self.request(exch_name, "fetch_tickers", symbols) for symbols in batches],
+                                           return_exceptions=True)
+            for symbols, result in zip(batches, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Fetching tickers in batch failed for {exchange.id}: {result!r}")
+                    continue
+                symbols = set(symbols)
+                tickers.update({symbol: ticker for symbol, ticker in result.items()
+                                if symbol in symbols and ticker.get("last") is not None})
+        missing = [symbol for symbol in symbols if symbol not in tickers]
+        results = await asyncio.gather(*[self.request(exch_name, "fetch_ticker", symbol) for symbol in missing],
+                                       return_exceptions=True)
+        tickers.update(zip(missing, results))
+        return tickers
+
+    async def fetch_balance(self, exch_name, exchange):
+        """ Fetches the balance if it can have changed since it was last fetched, None otherwise. """
+        if exchange.balance_tracker.due():
+            return await self.request(exch_name, "fetch_balance")
+        return None
+
+    async def poll_exchange(self, exch_name, markets):
+        exchange = self.bot.exchanges[exch_name]
+        symbols = [market.symbol for market in markets if not market.feed.live]
+        balance, tickers = await asyncio.gather(self.fetch_balance(exch_name, exchange),
+                                                self.fetch_prices(exch_name, exchange, symbols),
+                                                return_exceptions=True)
+        if isinstance(tickers, Exception):
+            tickers = {symbol: tickers for symbol in symbols}
+        return balance, [(market, tickers.get(market.symbol)) for market in markets]
+
+    def apply_exchange(self, exch_name, exchange, balance, tickers):
+        if isinstance(balance, Exception):
+            logger.error(f"Fetching balance failed for {exchange.id}: {balance!r}")
+            return
+        if balance is not None:
+            exchange.set_balance(balance)
+        for market, ticker in tickers:
+            with market.lock:
+                market.invalidate_open_orders()
+                market.update_balance()
+                market.dispatch_balance_event()
+                if isinstance(ticker, Exception):
+                    logger.warning(f"Fetching ticker failed for {market.symbol} on {exchange.id}: {ticker!r}")
+                    continue
+                # Markets with a live streaming feed get their prices from the feed
+                if ticker is not None:
+                    market.add_price(ticker["last"])
+                    market.dispatch_price_event()
+            self.bot.scheduler.reschedule(exch_name, market)
+
+    async def cycle(self):
+        timer = PhaseTimer()
+        timer.phase("logging")
+        logger.debug("%s", self.bot, extra={"sample": logging_setup.TICK_SAMPLE})
+        timer.phase("polling")
+        await self.sync_clients()
+        due = list(self.bot.scheduler.due().items())
+        polled = await asyncio.gather(*[self.poll_exchange(exch_name, markets) for exch_name, markets in due])
+        timer.phase("strategies")
+        for (exch_name, _), (balance, tickers) in zip(due, polled):
+            exchange = self.bot.exchanges[exch_name]
+            try:
+                self.apply_exchange(exch_name, exchange, balance, tickers)
+            except ExchangeError as e:
+                logging_setup.logging.exception(str(e))
+                continue
+        timer.phase("checkpoint")
+        self.bot.finish_cycle()
+        timer.stop()
+
+    async def run(self, cycles=None):
+        """ Runs cycles until the bot is deactivated or the given number of cycles is reached. """
+        await self.start()
+        try:
+            while self.bot.active and (cycles is None or cycles > 0):
+                start = time.monotonic()
+                await self.cycle()
+                logger.debug(f"Async cycle {self.bot.cycles} took {time.monotonic() - start:.3f}s")
+                if cycles is not None:
+                    cycles -= 1
+                    if cycles == 0:
+                        break
+                await asyncio.sleep(self.bot.scheduler.time_until_next())
+        finally:
+            await self.close()
+
+    def run_forever(self):
+        asyncio.run(self.run())
@@ -0,0 +1,222 @@
+""" Replays historical prices through a strategy on a PaperExchange to evaluate its settings.
+
+The real Market, Strategy and Order objects and the strategy's transitions state machine are used, only the
+exchange is simulated. To get through millions of ticks quickly, ticks that can't change anything are skipped
+before the replay: a tick only matters when it lands on another side of one of the strategy's order prices or
+buy trigger than the tick before it. Right after a tick that changed something the next tick is always
+replayed as well, since strategies can make a follow-up transition on the next price event.
+
+Run from the bctbot folder, e.g.:
+    python backtest.py --prices ohlcv.csv --settings strategy.json
+    python backtest.py --random 5000000 --settings strategy.json --grid grid.json --processes 8
+
+The prices file is a CSV of either prices, timestamp and price, or timestamp, open, high, low, close and volume
+(e.g. from ccxt's fetch_ohlcv). Every candle is replayed as four ticks: open, low, high and close for rising
+candles, open, high, low and close for falling ones. The grid file maps strategy settings to lists of values,
+all combinations of which are backtested.
+"""
+import argparse
+import copy
+import itertools
+import json
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+from exchange import Exchange
+from paper_exchange import PaperExchange
+
+Exchange.register_backend("paper", PaperExchange)
+
+
+def ohlcv_to_ticks(ohlcv):
+    """ :return: (timestamps, prices) with four ticks per candle """
+    timestamp, open_, high, low, close = (ohlcv[:, i] for i in range(5))
+    rising = close >= open_
+    prices = np.column_stack([open_, np.where(rising, low, high), np.where(rising, high, low), close]).ravel()
+    return np.repeat(timestamp, 4), prices
+
+
+def load_ticks(file_path):
+    """ :return: (timestamps or None, prices) from a CSV file """
+    with open(file_path) as f:
+        first = f.readline().split(",")[0]
+    try:
+        float(first)
+        skip = 0
+    except ValueError:
+        skip = 1
+    data = np.loadtxt(file_path, delimiter=",", skiprows=skip, ndmin=2)
+    if data.shape[1] >= 5:
+        return ohlcv_to_ticks(data)
+    if data.shape[1] == 2:
+        return data[:, 0], data[:, 1]
+    return None, data[:, 0]
+
+
+def random_walk(ticks, start=0.000005, volatility=0.001, seed=None):
+    rng = np.random.default_rng(seed)
+    return start * np.exp(np.cumsum(rng.normal(0, volatility, ticks)))
+
+
+def crossing_ticks(prices, thresholds):
+    """ Indices of the ticks that land in another band between the thresholds than the tick before.
+
+    Landing exactly on a threshold counts as a band of its own, since conditions and fills differ between
+    being at and being past a price.
+    """
+    thresholds = np.unique(np.asarray(thresholds, dtype=float))
+    bands = np.searchsorted(thresholds, prices, "left") + np.searchsorted(thresholds, prices, "right")
+    changed = np.empty(len(prices), dtype=bool)
+    changed[:1] = True
+    np.not_equal(bands[1:], bands[:-1], out=changed[1:])
+    return np.flatnonzero(changed)
+
+
+class Backtest:
+
+    def __init__(self, strategy_settings, strategy_name="range_account_building_1", symbol="ADB/ETH",
+                 initial_balance=None, fee=0.001):
+        self.symbol = symbol
+        quote = symbol.split("/")[1]
+        initial_balance = {quote: strategy_settings.get("total_buy_cost", 1) * 2} if initial_balance is None \
+            else initial_balance
+        settings = {
+            "ccxt_config": {"symbols": [symbol], "initial_balance": initial_balance, "fee": fee},
+            "traded_markets": {symbol: {"strategies": {strategy_name: copy.deepcopy(strategy_settings)}}}
+        }
+        self.exchange = Exchange("paper", settings)
+        self.market = self.exchange.traded_markets[symbol]
+        self.strategy = self.market.strategies[strategy_name]
+        self.initial_equity = None
+        self.fills_seen = 0
+        self.transitions = 0
+
+    def thresholds(self):
+        """ Prices at which something can happen: all order prices and the prices the strategy watches. """
+        return [price for price in self.strategy.thresholds() if price]
+
+    def equity(self, price):
+        balance = self.exchange.fetch_balance()
+        base, quote = self.market.base, self.market.quote
+        return balance.get(quote, {}).get("total", 0) + balance.get(base, {}).get("total", 0) * price
+
+    def step(self, price, timestamp=None):
+        """ Replays one tick the way the bot's loop handles a cycle: balance event first, then the price event.
+
+        :return: True if the tick filled an order or changed the state of the strategy
+        """
+        state = self.strategy.state
+        self.exchange.set_price(self.symbol, price, timestamp)
+        filled = len(self.exchange.fills) > self.fills_seen
+        if filled:
+            self.fills_seen = len(self.exchange.fills)
+            self.exchange.get_balance()
+            self.market.invalidate_open_orders()
+            for strategy in self.market.strategies.values():
+                strategy.balance_change_event()
+        self.market.add_price(price, timestamp)
+        self.market.dispatch_price_event()
+        # Orders placed during the events may have filled right away, the next tick reports those
+        changed = filled or self.strategy.state != state or len(self.exchange.fills) > self.fills_seen
+        self.transitions += self.strategy.state != state
+        return changed
+
+    def run(self, prices, timestamps=None):
+        start = time.perf_counter()
+        prices = np.asarray(prices, dtype=float)
+        self.initial_equity = float(self.equity(prices[0]))
+        candidates = crossing_ticks(prices, self.thresholds())
+        replayed, last = 0, -1
+        for i in candidates.tolist():
+            if i <= last:
+                continue
+            while True:
+                changed = self.step(float(prices[i]), None if timestamps is None else float(timestamps[i]))
+                replayed += 1
+                last = i
+                i += 1
+                if not changed or i >= len(prices):
+                    break
+        final_equity = float(self.equity(prices[-1]))
+        return {
+            "ticks": len(prices),
+            "replayed_ticks": replayed,
+            "seconds": time.perf_counter() - start,
+            "fills": len(self.exchange.fills),
+            "transitions": self.transitions,
+            "state": self.strategy.state,
+            "initial_equity": self.initial_equity,
+            "final_equity": final_equity,
+            "profit": final_equity - self.initial_equity
+        }
+
+
+_ticks = None
+
+
+def init_worker(ticks):
+    global _ticks
+    _ticks = ticks
+
+
+def run_combination(args):
+    strategy_settings, params = args
+    settings = dict(strategy_settings, **params)
+    timestamps, prices = _ticks
+    return params, Backtest(settings).run(prices, timestamps)
+
+
+def sweep(prices, strategy_settings, grid, timestamps=None, processes=None):
+    """ Backtests every combination of the settings in grid, spread over a pool of processes.
+
+    :param grid: dict of strategy setting name to a list of values to try
+    :return: list of (params, result), most profitable first
+    """
+    names = list(grid)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=((timestamps, prices),)) as pool:
+        results = pool.map(run_combination, [(strategy_settings, params) for params in combinations])
+    return sorted(results, key=lambda result: result[1]["profit"], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--settings", required=True, help="JSON file with the strategy settings")
+    parser.add_argument("--prices", help="CSV file with prices or OHLCV candles")
+    parser.add_argument("--random", type=int, help="Replay a random walk of this many ticks instead")
+    parser.add_argument("--grid", help="JSON file with lists of strategy settings to sweep")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    # A candle can fill several orders at once, the strategy then tries to cancel some already filled orders
+    # and logs the OrderNotFound errors, which would flood the output
+    logging.disable(logging.ERROR)
+    with open(args.settings) as f:
+        strategy_settings = json.load(f)
+    if args.prices:
+        timestamps, prices = load_ticks(args.prices)
+    else:
+        timestamps, prices = None, random_walk(args.random or 1000000, start=strategy_settings["buy_price_1"])
+
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+        start = time.perf_counter()
+        results = sweep(prices, strategy_settings, grid, timestamps, args.processes)
+        seconds = time.perf_counter() - start
+        for params, result in results:
+            print(f"{params}: profit {result['profit']:.8f}, fills {result['fills']}")
+        print(f"{len(results)} backtests of {len(prices)} ticks in {seconds:.1f}s "
+              f"({len(results) * len(prices) / seconds * 60:,.0f} ticks/minute)")
+    else:
+        result = Backtest(strategy_settings).run(prices, timestamps)
+        for key, value in result.items():
+            print(f"{key}: {value}")
+        print(f"{result['ticks'] / result['seconds'] * 60:,.0f} ticks/minute")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+""" Balance of an exchange account kept as a snapshot, with the changes per currency between snapshots.
+
+Every new balance, polled with fetch_balance or pushed by a balance stream, is compared with the last one. The free,
+used and total deltas of the currencies that changed go to the subscribers and to the markets trading them as base
+or quote, so only those markets fire the balance events of their strategies.
+
+fetch_balance is only polled when the balance can have changed: while the bot has open orders, after it placed or
+canceled orders since the last poll, and every max_age seconds to notice deposits and withdrawals. A live balance
+stream makes polling unnecessary altogether.
+"""
+import threading
+import time
+
+from feeds import BalanceStream
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+FIELDS = ("free", "used", "total")
+
+
+def currency_balances(balance):
+    """ :return: dict of currency to (free, used, total) of a ccxt balance structure """
+    free, used, total = (balance.get(field) or {} for field in FIELDS)
+    return {currency: (free.get(currency) or 0, used.get(currency) or 0, total.get(currency) or 0)
+            for currency in set(free) | set(used) | set(total)}
+
+
+class BalanceTracker:
+
+    def __init__(self, exchange, settings=None):
+        """
+
+        :param exchange: Exchange object
+        :param settings: dict:
+            max_age: seconds after which the balance is polled even without order activity (default 60)
+            stream: balance stream settings, see BalanceStream.set_stream
+        """
+        self.exchange = exchange
+        self.settings = {} if settings is None else settings
+        self.max_age = self.settings.get("max_age", 60)
+        self.stream = BalanceStream.set_stream(self.settings.get("stream", {}))
+        self.balances = {}                  # Currency -> (free, used, total)
+        self.markets = {}                   # Currency -> markets that trade it as base or quote
+        self.subscribers = []               # Callables taking the deltas of every change
+        self.polled_at = None               # time.monotonic() of the last full snapshot
+        self.orders_version = None          # Version of the order store at the last full snapshot
+        # Polled snapshots come from the bot's loop, streamed ones from the stream's thread
+        self.lock = threading.Lock()
+
+    def add_market(self, market):
+        for currency in (market.base, market.quote):
+            self.markets.setdefault(currency, []).append(market)
+
+    def remove_market(self, market):
+        for currency in (market.base, market.quote):
+            self.markets[currency] = [other for other in self.markets.get(currency, []) if other is not market]
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def total(self, currency):
+        return self.balances.get(currency, (0, 0, 0))[2]
+
+    def due(self):
+        """ Whether the balance is worth a fetch_balance request. """
+        if self.stream.live:
+            return False
+        if self.polled_at is None or self.exchange.order_store.orders:
+            return True
+        if self.exchange.order_store.version != self.orders_version:
+            return True
+        return self.max_age is not None and time.monotonic() - self.polled_at >= self.max_age
+
+    def update(self, balance, partial=False):
+        """ Takes over a new balance and notifies the markets of the currencies that changed.
+
+        :param balance: ccxt balance structure
+        :param partial: whether balance only holds the currencies that changed, as some streams send them. Currencies
+            missing from a full snapshot have no balance anymore.
+        :return: set of the markets notified, the subscribers get the deltas as a dict of currency to
+            {"free": delta, "used": delta, "total": delta} of the currencies that changed
+        """
+        new = currency_balances(balance)
+        with self.lock:
+            if not partial:
+                self.polled_at = time.monotonic()
+                self.orders_version = self.exchange.order_store.version
+                for currency in self.balances:
+                    new.setdefault(currency, (0, 0, 0))
+            deltas = {}
+            for currency, values in new.items():
+                old = self.balances.get(currency, (0, 0, 0))
+                if values != old:
+                    deltas[currency] = {field: value - previous for field, value, previous in zip(FIELDS, values, old)}
+                    self.balances[currency] = values
+        notified = set()
+        if not deltas:
+            return notified
+        logger.debug("Balance changes on %s: %s", self.exchange.id, deltas)
+        for callback in self.subscribers:
+            callback(deltas)
+        for currency, delta in deltas.items():
+            for market in self.markets.get(currency, ()):
+                market.add_balance_delta(currency, delta)
+                notified.add(market)
+        return notified
+
+    def push(self, balance, partial=False):
+        """ Takes a balance from a stream's thread and fires the balance events of the markets it changed right away. """
+        for market in self.exchange.set_balance(balance, partial):
+            market.on_balance_data()
+
+    def start(self):
+        self.stream.start(self)
+
+    def stop(self):
+        self.stream.stop()
+
+    def serialize(self):
+        return self.settings
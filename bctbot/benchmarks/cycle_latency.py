@@ -0,0 +1,66 @@
+""" Compares the cycle latency of the sequential TradingBot.loop with the AsyncTradingEngine.
+
+Run from the bctbot folder:
+    python -m benchmarks.cycle_latency --exchanges 3 --markets 40 --latency 0.05 [--batch-tickers]
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from tradingbot import TradingBot
+from async_engine import AsyncTradingEngine
+from scheduler import Scheduler
+from benchmarks import mock_exchange
+
+
+def time_sync(bot, cycles):
+    start = time.perf_counter()
+    for _ in range(cycles):
+        bot.loop()
+    return (time.perf_counter() - start) / cycles
+
+
+def time_async(bot, cycles):
+    engine = AsyncTradingEngine(bot)
+
+    async def run():
+        # Client setup and teardown are one-off costs, only the cycles themselves are timed
+        await engine.start()
+        try:
+            start = time.perf_counter()
+            for _ in range(cycles):
+                await engine.cycle()
+            return (time.perf_counter() - start) / cycles
+        finally:
+            await engine.close()
+
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exchanges", type=int, default=3)
+    parser.add_argument("--markets", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per API call")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--batch-tickers", action="store_true", help="Let the mock exchanges support fetch_tickers")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    mock_exchange.register(args.exchanges)
+    settings = mock_exchange.mock_bot_settings(args.exchanges, args.markets, args.latency, args.batch_tickers)
+    bot = TradingBot(settings)
+    # Poll every market every cycle without waiting in between
+    bot.scheduler = Scheduler(bot.exchanges, base_interval=0, min_interval=0, max_interval=0)
+    bot.checkpoint = lambda: None
+
+    sync_latency = time_sync(bot, args.cycles)
+    async_latency = time_async(bot, args.cycles)
+    print(f"{args.exchanges} exchanges x {args.markets} markets, {args.latency * 1000:.0f} ms per call")
+    print(f"sync loop:   {sync_latency:.3f} s/cycle")
+    print(f"async loop:  {async_latency:.3f} s/cycle ({sync_latency / async_latency:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+""" Load tests TradingBot.loop against SimulatedExchanges while the number of markets grows.
+
+Reports per number of markets the wall time and CPU time of a cycle polling every market, and the memory the
+bot takes. The memory is traced while the bot is set up, which slows the setup down a few times. Run from the
+bctbot folder:
+    python -m benchmarks.load --exchanges 2 --markets 10 100 1000 10000 --latency 0.01 [--strategies]
+"""
+import argparse
+import gc
+import logging
+import time
+import tracemalloc
+
+from ccxt.base.errors import NetworkError
+
+from exchange import Exchange
+from scheduler import Scheduler
+from simulated_exchange import SimulatedExchange, simulated_symbols
+from tradingbot import TradingBot
+from utils import RetrySettings
+
+STRATEGY_SETTINGS = {
+    "buy_price_1": 0.0000049, "buy_price_2": 0.0000048, "buy_price_3": 0.0000047,
+    "buy_amount_percentage_1": 0.34, "buy_amount_percentage_2": 0.33, "buy_amount_percentage_3": 0.33,
+    "sell_price_1": 0.0000051, "sell_price_2": 0.0000052, "sell_price_3": 0.0000053,
+    "sell_amount_percentage_1": 0.5, "sell_amount_percentage_2": 0.25, "sell_amount_percentage_3": 0.25,
+    "total_buy_cost": 0.1
+}
+
+
+def load_test_settings(exchanges, markets, latency, error_rate, strategies=False, tickers_per_request=None):
+    """ Builds bot settings for several simulated exchanges, optionally with a range strategy on every market. """
+    market_settings = {"strategies": {"range_account_building_1": STRATEGY_SETTINGS}} if strategies else {}
+    settings = {}
+    for i in range(exchanges):
+        settings[f"simulated{i}"] = {
+            "ccxt_config": {"markets_count": markets, "latency": latency, "error_rate": error_rate, "seed": i,
+                            "rateLimit": 0, "initial_balance": {"ETH": STRATEGY_SETTINGS["total_buy_cost"] * markets}},
+            "tickers_per_request": tickers_per_request,
+            "traded_markets": {symbol: dict(market_settings) for symbol in simulated_symbols(markets)}
+        }
+    return settings
+
+
+def register(exchanges):
+    for i in range(exchanges):
+        Exchange.register_backend(f"simulated{i}", SimulatedExchange)
+
+
+def run(settings, cycles):
+    """ :return: dict with the setup time, cycle wall and CPU time and the memory of the bot """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    bot = TradingBot(settings)
+    setup = time.perf_counter() - start
+    memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Poll every market every cycle without waiting in between
+    bot.scheduler = Scheduler(bot.exchanges, base_interval=0, min_interval=0, max_interval=0)
+    bot.checkpoint = lambda: None
+    aborted = 0
+    requests = sum(exchange.requests for exchange in bot.exchanges.values())
+    start, start_cpu = time.perf_counter(), time.process_time()
+    for _ in range(cycles):
+        try:
+            bot.loop()
+        except (NetworkError, RetrySettings.PersistentErrorAfterRetries):
+            # Errors the bot doesn't retry (enough) stop it, here the next cycle just starts
+            aborted += 1
+    wall = (time.perf_counter() - start) / cycles
+    cpu = (time.process_time() - start_cpu) / cycles
+    return {
+        "setup": setup,
+        "cycle": wall,
+        "cpu": cpu,
+        "memory": memory,
+        "peak_memory": peak_memory,
+        "requests": (sum(exchange.requests for exchange in bot.exchanges.values()) - requests) / cycles,
+        "errors": sum(exchange.injected_errors for exchange in bot.exchanges.values()),
+        "aborted_cycles": aborted
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exchanges", type=int, default=2)
+    parser.add_argument("--markets", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="Numbers of markets per exchange to test")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of an API call failing")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--strategies", action="store_true", help="Run a range strategy on every market")
+    parser.add_argument("--tickers-per-request", type=int, default=None)
+    args = parser.parse_args()
+
+    # Retried errors and ignored strategy triggers would log a warning per market per cycle
+    logging.disable(logging.WARNING)
+    register(args.exchanges)
+    print(f"{args.exchanges} exchanges, {args.latency * 1000:.0f} ms per call, error rate {args.error_rate}")
+    print(f"{'markets':>8} {'setup s':>9} {'cycle s':>9} {'cpu s':>9} {'cpu %':>6} {'requests':>9} "
+          f"{'memory MB':>10} {'peak MB':>8} {'errors':>7} {'aborted':>8}")
+    for markets in args.markets:
+        settings = load_test_settings(args.exchanges, markets, args.latency, args.error_rate, args.strategies,
+                                      args.tickers_per_request)
+        result = run(settings, args.cycles)
+        print(f"{markets:>8} {result['setup']:>9.3f} {result['cycle']:>9.3f} {result['cpu']:>9.3f} "
+              f"{result['cpu'] / result['cycle'] * 100:>6.0f} {result['requests']:>9.0f} "
+              f"{result['memory'] / 2 ** 20:>10.1f} {result['peak_memory'] / 2 ** 20:>8.1f} "
+              f"{result['errors']:>7} {result['aborted_cycles']:>8}")
+
+
+if __name__ == "__main__":
+    main()
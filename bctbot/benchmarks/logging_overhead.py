@@ -0,0 +1,107 @@
+""" Measures how much logging adds to the cycle time of TradingBot.loop.
+
+Runs the same bot on SimulatedExchanges three times: with logging disabled, with the log files and console
+written synchronously from the trading thread without sampling (like the bot used to), and with the queued
+writer thread and sampling of logging_setup. Logs go to a temporary folder and the console output to devnull.
+Run from the bctbot folder:
+    python -m benchmarks.logging_overhead --markets 200 --cycles 20
+"""
+import argparse
+import logging
+import os
+import queue
+import tempfile
+import time
+
+import logging_setup
+from benchmarks import load
+from scheduler import Scheduler
+from tradingbot import TradingBot
+
+MODULE_LOGGERS = [name for name in logging_setup.LOGGING_CONFIG["loggers"] if name != "log_writer"]
+
+
+class BatchedFileHandler(logging_setup.BatchFlush, logging.FileHandler):
+    pass
+
+
+def output_handlers(folder, file_formatter, console, batched=False):
+    file_handler_class = BatchedFileHandler if batched else logging.FileHandler
+    handlers = []
+    for name, level in (("debug", logging.DEBUG), ("info", logging.INFO), ("error", logging.ERROR)):
+        handler = file_handler_class(os.path.join(folder, f"{name}.log"), encoding="utf-8")
+        handler.setLevel(level)
+        handler.setFormatter(file_formatter)
+        handlers.append(handler)
+    console_handler = (logging_setup.BatchedStreamHandler if batched else logging.StreamHandler)(console)
+    console_handler.setFormatter(logging.Formatter(logging_setup.LOGGING_CONFIG["formatters"]["normal"]["format"]))
+    handlers.append(console_handler)
+    return handlers
+
+
+def set_handlers(handlers):
+    for name in MODULE_LOGGERS:
+        logging.getLogger(name).handlers = list(handlers)
+
+
+def time_cycles(settings, cycles):
+    bot = TradingBot(settings)
+    # Poll every market every cycle without waiting in between
+    bot.scheduler = Scheduler(bot.exchanges, base_interval=0, min_interval=0, max_interval=0)
+    bot.checkpoint = lambda: None
+    start = time.perf_counter()
+    for _ in range(cycles):
+        bot.loop()
+    return (time.perf_counter() - start) / cycles
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exchanges", type=int, default=1)
+    parser.add_argument("--markets", type=int, default=200)
+    parser.add_argument("--cycles", type=int, default=20)
+    args = parser.parse_args()
+
+    load.register(args.exchanges)
+    settings = load.load_test_settings(args.exchanges, args.markets, 0, 0, strategies=True)
+    original_handlers = {name: logging.getLogger(name).handlers for name in MODULE_LOGGERS}
+    results = {}
+    with tempfile.TemporaryDirectory() as folder, open(os.devnull, "w") as console:
+        logging.disable(logging.CRITICAL)
+        results["disabled"] = time_cycles(settings, args.cycles)
+        logging.disable(logging.NOTSET)
+
+        handlers = output_handlers(folder, logging.Formatter(logging_setup.LOGGING_CONFIG["formatters"]["normal"]
+                                                             ["format"]), console)
+        set_handlers(handlers)
+        results["synchronous"] = time_cycles(settings, args.cycles)
+        for handler in handlers:
+            handler.close()
+
+        log_queue = queue.Queue(-1)
+        queue_handler = logging_setup.LazyQueueHandler(log_queue)
+        queue_handler.addFilter(logging_setup.SampleFilter())
+        handlers = output_handlers(folder, logging_setup.JsonFormatter(), console, batched=True)
+        listener = logging_setup.BatchingQueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        set_handlers([queue_handler])
+        results["queued"] = time_cycles(settings, args.cycles)
+        start = time.perf_counter()
+        backlog = log_queue.qsize()
+        listener.stop()
+        drain = time.perf_counter() - start
+        for handler in handlers:
+            handler.close()
+
+    for name, handlers in original_handlers.items():
+        logging.getLogger(name).handlers = handlers
+    print(f"{args.exchanges} exchanges x {args.markets} markets with a range strategy, {args.cycles} cycles")
+    for mode, latency in results.items():
+        overhead = latency - results["disabled"]
+        print(f"{mode:<12} {latency * 1000:8.2f} ms/cycle, logging adds {overhead * 1000:7.2f} ms "
+              f"({overhead / results['disabled'] * 100:.0f}%)")
+    print(f"queued records left to write after the last cycle: {backlog}, written in {drain:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
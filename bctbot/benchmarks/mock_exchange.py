@@ -0,0 +1,95 @@
+""" Network-free stand-ins for a ccxt exchange, used by the benchmarks.
+
+Every call sleeps for a fixed latency to mimic a round trip to the exchange, the sync exchange with
+time.sleep and the async one with asyncio.sleep. Both are registered under the names "mock0", "mock1", etc. fetch_tickers is only advertised in
+"has" when the settings ask for it.
+"""
+import asyncio
+import random
+import time
+
+import ccxt
+import ccxt.async_support as ccxt_async
+
+from exchange import Exchange
+
+
+def mock_markets(count):
+    markets = {}
+    for i in range(count):
+        base = f"C{i}"
+        markets[f"{base}/ETH"] = {"id": f"{base}-ETH", "symbol": f"{base}/ETH", "base": base, "quote": "ETH",
+                                  "active": True, "spot": True, "type": "spot",
+                                  "precision": {}, "limits": {}}
+    return markets
+
+
+def mock_balance():
+    return {"free": {"ETH": 10.0}, "used": {}, "total": {"ETH": 10.0}, "ETH": {"free": 10.0, "used": 0, "total": 10.0}}
+
+
+def mock_ticker(symbol):
+    return {"symbol": symbol, "last": round(random.uniform(0.000001, 0.00001), 8)}
+
+
+class MockExchange(ccxt.Exchange):
+    id = "mock"
+    latency = 0.05
+    markets_count = 50
+
+    def load_markets(self, reload=False, params={}):
+        time.sleep(self.latency)
+        self.set_markets(mock_markets(self.markets_count))
+        return self.markets
+
+    def fetch_balance(self, params={}):
+        time.sleep(self.latency)
+        return mock_balance()
+
+    def fetch_ticker(self, symbol, params={}):
+        time.sleep(self.latency)
+        return mock_ticker(symbol)
+
+    def fetch_tickers(self, symbols=None, params={}):
+        time.sleep(self.latency)
+        return {symbol: mock_ticker(symbol) for symbol in symbols or self.symbols}
+
+
+class AsyncMockExchange(ccxt_async.Exchange):
+    id = "mock"
+    latency = 0.05
+    markets_count = 50
+
+    async def load_markets(self, reload=False, params={}):
+        await asyncio.sleep(self.latency)
+        self.set_markets(mock_markets(self.markets_count))
+        return self.markets
+
+    async def fetch_balance(self, params={}):
+        await asyncio.sleep(self.latency)
+        return mock_balance()
+
+    async def fetch_ticker(self, symbol, params={}):
+        await asyncio.sleep(self.latency)
+        return mock_ticker(symbol)
+
+    async def fetch_tickers(self, symbols=None, params={}):
+        await asyncio.sleep(self.latency)
+        return {symbol: mock_ticker(symbol) for symbol in symbols or self.symbols}
+
+
+def mock_bot_settings(exchanges, markets, latency, batch_tickers=False):
+    """ Builds bot settings for several mock exchanges without strategies or rate limits. """
+    settings = {}
+    for i in range(exchanges):
+        settings[f"mock{i}"] = {
+            "ccxt_config": {"latency": latency, "markets_count": markets, "rateLimit": 0,
+                            "has": {"fetchTickers": batch_tickers}},
+            "traded_markets": {symbol: {} for symbol in mock_markets(markets)}
+        }
+    return settings
+
+
+def register(exchanges):
+    for i in range(exchanges):
+        Exchange.register_backend(f"mock{i}", MockExchange, AsyncMockExchange)
@@ -0,0 +1,93 @@
+""" Measures the memory and time the orders of a large grid take, and filtering them by side and status.
+
+A grid strategy with as many levels as orders is armed on a paper exchange, one buy per level below the price
+(and, with --sells, one sell per level above it). The memory of the orders is compared with objects holding the
+same attributes in a __dict__, which is how Order kept them before it had __slots__, both referencing the same
+values. Run from the bctbot folder:
+    python -m benchmarks.order_memory --orders 1000 10000 100000
+"""
+import argparse
+import logging
+import time
+import tracemalloc
+
+import backtest
+from order import Order
+
+
+class DictOrder:
+    """ The attributes of an Order in a __dict__. """
+
+
+def copy(order, cls):
+    """ :return: an instance of cls with the attributes of order, without running any constructor """
+    copied = cls.__new__(cls)
+    for field in Order.__slots__:
+        object.__setattr__(copied, field, getattr(order, field))
+    return copied
+
+
+def measure(function):
+    """ :return: (result, bytes allocated and kept by function, seconds it took) """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, allocated, seconds
+
+
+def grid(orders, sells):
+    levels = orders + 1
+    test = backtest.Backtest({"lower_price": 1, "upper_price": levels, "levels": levels, "spacing": "arithmetic",
+                              "total_buy_cost": levels, "active_levels": 5}, strategy_name="grid_1")
+    strategy = test.strategy
+    strategy.market.add_price(levels + 0.5)
+    strategy.arm_buy_levels()
+    if sells:
+        half = len(strategy.orders) // 2
+        for order in list(strategy.orders.values())[half:]:
+            strategy.disarm(order)
+            strategy.arm("sell", strategy.level_of(order)[1], amount=1)
+    # Some orders open on the exchange, as if they were in reach of the price
+    for order in list(strategy.orders.values())[::50]:
+        order.status = "open"
+    return strategy
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--sells", action="store_true", help="Arm sells on half of the levels")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'orders':>8}{'B/order':>9}{'dict B':>8}{'build us':>10}{'serialize us':>14}"
+          f"{'filter loop us':>16}{'filter table us':>17}")
+    for count in args.orders:
+        strategy, _, seconds = measure(lambda: grid(count, args.sells))
+        orders = strategy.orders.values()
+        order_bytes = measure(lambda: [copy(order, Order) for order in orders])[1]
+        dict_bytes = measure(lambda: [copy(order, DictOrder) for order in orders])[1]
+        _, _, serialize_seconds = measure(lambda: [order.serialize() for order in orders])
+
+        start = time.perf_counter()
+        for _ in range(10):
+            loop = [order for order in strategy.orders.values() if order.side == "buy" and order.status == "open"]
+        loop_seconds = (time.perf_counter() - start) / 10
+        start = time.perf_counter()
+        for _ in range(10):
+            table = strategy.orders.select(side="buy", status="open")
+        table_seconds = (time.perf_counter() - start) / 10
+        if {id(order) for order in loop} != {id(order) for order in table}:
+            raise AssertionError("The table selects other orders than the loop")
+        print(f"{len(orders):>8}{order_bytes / len(orders):>9.0f}{dict_bytes / len(orders):>8.0f}"
+              f"{seconds / len(orders) * 1e6:>10.1f}{serialize_seconds / len(orders) * 1e6:>14.2f}"
+              f"{loop_seconds * 1e6:>16.0f}{table_seconds * 1e6:>17.0f}")
+    print("B/order: bytes per Order, dict B: the same attributes in a __dict__, build us: arming the grid per order")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+""" Performance regression benchmarks replayed from tapes of the calls the bot made to its exchanges.
+
+Three benchmarks run on the recorded data, every one --repeat times, and the best of the runs is reported (the
+slower runs measure the noise of the machine more than the code):
+    cycle ms          TradingBot.loop over all cycles of the tapes, polling every market every cycle
+    transition us     a tick through Backtest.step of a RangeAccountBuilding strategy, with the prices of the tapes
+                      and a ladder spanning them, so the strategy keeps buying and selling
+    save_session ms   TradingBot.save_session of the bot after replaying the tapes
+With --baseline the results are compared with those saved by an earlier --save-baseline run, and the run fails
+(exit status 1) if one of them is more than --threshold slower. Baselines depend on the machine they were saved
+on, save them on the machine that runs the comparison.
+
+Tapes are recorded with run_bot.py --record-tapes FOLDER. Without --tapes a tape of a bot running range strategies
+on a simulated exchange is recorded to benchmarks/tapes first, if it isn't there yet (or with --record). Replays
+serve the calls without delay, --speed replays them with their recorded duration divided by speed instead.
+Run from the bctbot folder:
+    python -m benchmarks.regression --save-baseline benchmarks/baseline.json
+    python -m benchmarks.regression --baseline benchmarks/baseline.json --threshold 0.2
+    python -m benchmarks.regression --tapes tapes/binance.tape --speed 10
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import backtest
+import tape
+from benchmarks.load import STRATEGY_SETTINGS, load_test_settings, register
+from scheduler import Scheduler
+from tradingbot import TradingBot
+
+TAPES_FOLDER = os.path.join(os.path.dirname(__file__), "tapes")
+BENCHMARKS = ("cycle ms", "transition us", "save_session ms")
+
+
+def polling_every_cycle(bot):
+    bot.scheduler = Scheduler(bot.exchanges, base_interval=0, min_interval=0, max_interval=0)
+    bot.checkpoint = lambda: None
+    return bot
+
+
+def record(folder, markets, cycles):
+    """ Records a bot with a range strategy on every market of a simulated exchange.
+
+    :return: list of the paths of the tapes
+    """
+    register(1)
+    bot = polling_every_cycle(TradingBot(load_test_settings(1, markets, 0, 0, strategies=True)))
+    bot.record_tapes(folder)
+    try:
+        for _ in range(cycles):
+            bot.loop()
+    finally:
+        bot.stop_recording()
+    return [os.path.join(folder, f"{exch_name}.tape") for exch_name in bot.exchanges]
+
+
+def time_loop(tapes):
+    """ :return: (seconds per cycle, the bot after replaying the tapes) """
+    for recorded in tapes:
+        recorded.rewind()
+    bot = polling_every_cycle(TradingBot({recorded.exchange: copy.deepcopy(recorded.settings) for recorded in tapes}))
+    cycles = min(recorded.cycles for recorded in tapes)
+    start = time.perf_counter()
+    for _ in range(cycles):
+        bot.loop()
+    return (time.perf_counter() - start) / cycles, bot
+
+
+def time_save_session(bot, folder, times=5):
+    file_path = os.path.join(folder, "session.json")
+    seconds = []
+    for _ in range(times):
+        start = time.perf_counter()
+        bot.save_session(file_path)
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def tape_ticks(tapes, ticks):
+    """ :return: ticks prices of all markets on the tapes one after the other, scaled to start where the price of
+        the market before ended, repeated up to ticks prices """
+    series = [np.asarray(prices) for recorded in tapes for prices in recorded.prices().values() if len(prices) > 1]
+    if not series:
+        raise ValueError("The tapes hold no tickers to replay through a strategy")
+    scaled = [series[0]]
+    for prices in series[1:]:
+        scaled.append(prices * (scaled[-1][-1] / prices[0]))
+    prices = np.concatenate(scaled)
+    return np.resize(prices, ticks)
+
+
+def range_settings(prices):
+    """ Settings of a range strategy with its ladder spread over the prices and its buy trigger at their median. """
+    buy_prices = np.quantile(prices, [0.35, 0.25, 0.15])
+    sell_prices = np.quantile(prices, [0.65, 0.75, 0.85])
+    settings = dict(STRATEGY_SETTINGS, buy_trigger_percentage=float(np.median(prices) / buy_prices[0] - 1))
+    for i in range(3):
+        settings[f"buy_price_{i + 1}"] = float(buy_prices[i])
+        settings[f"sell_price_{i + 1}"] = float(sell_prices[i])
+    return settings
+
+
+def time_transitions(prices, settings):
+    """ :return: (seconds per tick, transitions made) """
+    test = backtest.Backtest(settings)
+    start = time.perf_counter()
+    for price in prices.tolist():
+        test.step(price)
+    return (time.perf_counter() - start) / len(prices), test.transitions
+
+
+def compare(results, baseline, threshold):
+    """ Prints the results next to the baseline.
+
+    :return: list of the names of the benchmarks more than threshold slower than their baseline
+    """
+    regressions = []
+    print(f"{'benchmark':<16}{'baseline':>10}{'now':>10}{'change':>9}")
+    for name in BENCHMARKS:
+        before = baseline.get(name)
+        if not before:
+            print(f"{name:<16}{'':>10}{results[name]:>10.3f}")
+            continue
+        change = results[name] / before - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<16}{before:>10.3f}{results[name]:>10.3f}{change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tapes", nargs="+", help="Tapes to replay, one per exchange of the bot")
+    parser.add_argument("--record", action="store_true", help="Record the simulated tape again")
+    parser.add_argument("--markets", type=int, default=100, help="Markets of the simulated tape")
+    parser.add_argument("--cycles", type=int, default=50, help="Cycles of the simulated tape")
+    parser.add_argument("--speed", type=float, help="Replay calls with their recorded duration divided by speed")
+    parser.add_argument("--ticks", type=int, default=20000, help="Ticks to replay through the range strategy")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", help="JSON file of a --save-baseline run to compare with")
+    parser.add_argument("--save-baseline", help="JSON file to save the results to")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown that fails the run, 0.2 for 20%%")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    paths = args.tapes
+    if not paths:
+        paths = [os.path.join(TAPES_FOLDER, "simulated0.tape")]
+        if args.record or not os.path.exists(paths[0]):
+            os.makedirs(TAPES_FOLDER, exist_ok=True)
+            paths = record(TAPES_FOLDER, args.markets, args.cycles)
+    tapes = [tape.replay(path, args.speed) for path in paths]
+    prices = tape_ticks(tapes, args.ticks)
+    settings = range_settings(prices)
+
+    runs = {name: [] for name in BENCHMARKS}
+    transitions = 0
+    with tempfile.TemporaryDirectory() as folder:
+        for _ in range(args.repeat):
+            try:
+                cycle, bot = time_loop(tapes)
+            except tape.TapeExhausted as e:
+                print(f"The replay went off the tape, record it again: {e}")
+                sys.exit(2)
+            runs["cycle ms"].append(cycle * 1e3)
+            runs["save_session ms"].append(time_save_session(bot, folder) * 1e3)
+            tick, transitions = time_transitions(prices, settings)
+            runs["transition us"].append(tick * 1e6)
+    results = {name: min(values) for name, values in runs.items()}
+
+    for recorded in tapes:
+        print(f"{recorded.file_path}: {recorded.cycles} cycles, {recorded.served_calls} of {len(recorded.calls)} "
+              f"calls replayed, {recorded.mismatches} with other arguments than recorded")
+    print(f"{len(prices)} ticks through the range strategy, {transitions} transitions")
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"tapes": paths, "results": results}, f, indent=4)
+    if regressions:
+        print(f"Slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
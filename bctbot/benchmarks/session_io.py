@@ -0,0 +1,77 @@
+""" Compares bytes written and time per cycle of the full JSON save_session with the journaled SessionStore.
+
+Every simulated cycle appends a new price to every market and moves one strategy to another state, which
+is roughly what a quiet cycle of the real loop changes. Run from the bctbot folder:
+    python -m benchmarks.session_io --markets 200 --cycles 50
+"""
+import argparse
+import copy
+import logging
+import os
+import random
+import tempfile
+import time
+
+from tradingbot import TradingBot
+from benchmarks import mock_exchange
+
+STRATEGY = {
+    "total_buy_cost": 1.5,
+    "buy_price_1": 0.000005, "buy_price_2": 0.0000048, "buy_price_3": 0.0000046,
+    "buy_amount_percentage_1": 0.34, "buy_amount_percentage_2": 0.33, "buy_amount_percentage_3": 0.33,
+    "sell_price_1": 0.0000055, "sell_price_2": 0.0000057, "sell_price_3": 0.000006,
+    "sell_amount_percentage_1": 0.5, "sell_amount_percentage_2": 0.25, "sell_amount_percentage_3": 0.25
+}
+
+
+def build_bot(markets, file_path):
+    mock_exchange.register(1)
+    settings = mock_exchange.mock_bot_settings(1, markets, latency=0)
+    for market_settings in settings["mock0"]["traded_markets"].values():
+        market_settings["strategies"] = {"range_account_building_1": copy.deepcopy(STRATEGY)}
+        market_settings["prices"] = [random.uniform(0.000001, 0.00001) for _ in range(500)]
+    return TradingBot(settings, file_path)
+
+
+def simulate_cycle(bot):
+    markets = list(bot.exchanges["mock0"].traded_markets.values())
+    for market in markets:
+        market.add_price(random.uniform(0.000001, 0.00001))
+    strategy = random.choice(markets).strategies["range_account_building_1"]
+    strategy.bought_counter += 0.1
+
+
+def run(bot, cycles, save):
+    start = time.perf_counter()
+    for _ in range(cycles):
+        simulate_cycle(bot)
+        save()
+    return (time.perf_counter() - start) / cycles
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--markets", type=int, default=200)
+    parser.add_argument("--cycles", type=int, default=50)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_path = os.path.join(folder, "session.json")
+        bot = build_bot(args.markets, file_path)
+        full_time = run(bot, args.cycles, bot.save_session)
+        full_bytes = os.path.getsize(file_path)
+
+        bot.checkpoint()
+        store = bot.session_store
+        store.bytes_written = 0
+        journal_time = run(bot, args.cycles, bot.checkpoint)
+        journal_bytes = store.bytes_written / args.cycles
+
+    print(f"{args.markets} markets, {args.cycles} cycles")
+    print(f"full save_session:  {full_bytes:>10.0f} bytes/cycle  {full_time * 1000:8.2f} ms/cycle")
+    print(f"journal checkpoint: {journal_bytes:>10.0f} bytes/cycle  {journal_time * 1000:8.2f} ms/cycle")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+""" Compares writing and loading full session snapshots as JSON and as msgpack.
+
+For every number of markets a bot with a strategy and a price history per market is saved as a snapshot of each
+format (SessionStore.compact) and loaded into a new bot (TradingBot.load_session), which must end up with the same
+session. Run from the bctbot folder:
+    python -m benchmarks.snapshot_io --markets 10 1000 10000 --prices 500
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.session_io import build_bot
+from session_store import SessionStore, SNAPSHOT_FORMATS
+from tradingbot import TradingBot
+
+
+def session(bot):
+    return {exch_name: exchange.serialize() for exch_name, exchange in bot.exchanges.items()}
+
+
+def measure(bot, snapshot_format, folder):
+    file_path = os.path.join(folder, f"{snapshot_format}.json")
+    bot.config_file_path = file_path
+    bot.session_store = SessionStore(file_path, snapshot_format=snapshot_format)
+    start = time.perf_counter()
+    bot.session_store.compact(bot)
+    save_time = time.perf_counter() - start
+    snapshot_path = bot.session_store.snapshot_path if snapshot_format == "msgpack" else file_path
+    size = os.path.getsize(snapshot_path)
+
+    loaded = TradingBot(snapshot_format=snapshot_format)
+    start = time.perf_counter()
+    loaded.load_session(file_path)
+    load_time = time.perf_counter() - start
+    if session(loaded) != session(bot):
+        raise AssertionError(f"The {snapshot_format} snapshot of {file_path} doesn't load the same session")
+    return save_time, load_time, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--markets", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--prices", type=int, default=500, help="Prices in the history of every market")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    print(f"{'markets':>8}{'format':>9}{'save s':>9}{'load s':>9}{'MB':>9}")
+    for markets in args.markets:
+        random.seed(markets)
+        with tempfile.TemporaryDirectory() as folder:
+            bot = build_bot(markets, os.path.join(folder, "config.json"))
+            for exchange in bot.exchanges.values():
+                for market in exchange.traded_markets.values():
+                    for _ in range(args.prices - len(market.prices)):
+                        market.add_price(random.uniform(0.000001, 0.00001))
+            for snapshot_format in SNAPSHOT_FORMATS:
+                save_time, load_time, size = measure(bot, snapshot_format, folder)
+                print(f"{markets:>8}{snapshot_format:>9}{save_time:>9.3f}{load_time:>9.3f}{size / 1e6:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+""" Compares the compiled StateMachine of the strategies with a transitions.Machine on the same strategies.
+
+First both replay the same random price walks on a paper exchange and must end up with the same states after every
+tick, then every trigger path of RangeAccountBuilding is timed in isolation:
+    no transition   balance_change_event in idle, which has no transition for it
+    conditions fail price_change_event in idle with the price above the buy trigger
+    transition      price_change_event moving idle -> buying -> idle, placing and canceling stubbed out, adding
+                    the prices included
+Run from the bctbot folder:
+    python -m benchmarks.state_machine --ticks 20000 --events 200000
+"""
+import argparse
+import functools
+import logging
+import time
+
+from transitions import Machine
+
+import backtest
+from benchmarks.load import STRATEGY_SETTINGS
+
+
+def bind_legacy_machine(strategy):
+    """ Drives strategy with a transitions.Machine, the way strategies did before their tables were compiled. """
+    machine = Machine(model=strategy, states=strategy.states, transitions=strategy.transitions,
+                      initial=strategy.state, ignore_invalid_triggers=True, after_state_change="record_transition")
+    # The strategy class has trigger methods of its own already, instance attributes take precedence over them
+    for name, event in machine.events.items():
+        setattr(strategy, name, functools.partial(event.trigger, strategy))
+    return machine
+
+
+def replay(prices, legacy):
+    test = backtest.Backtest(dict(STRATEGY_SETTINGS))
+    if legacy:
+        bind_legacy_machine(test.strategy)
+    states = []
+    for price in prices.tolist():
+        test.step(price)
+        states.append(test.strategy.state)
+    return states, len(test.exchange.fills)
+
+
+def check_equivalence(ticks, seeds):
+    for seed in range(seeds):
+        prices = backtest.random_walk(ticks, start=STRATEGY_SETTINGS["buy_price_1"], volatility=0.003, seed=seed)
+        compiled, legacy = replay(prices, False), replay(prices, True)
+        if compiled != legacy:
+            tick = next(i for i, (a, b) in enumerate(zip(compiled[0], legacy[0])) if a != b)
+            raise AssertionError(f"Seed {seed}: the machines disagree from tick {tick}")
+        print(f"seed {seed}: same {len(set(compiled[0]))} states visited and {compiled[1]} fills over {ticks} ticks")
+
+
+def time_events(strategy, events):
+    """ :return: microseconds per event of every trigger path """
+    buy_trigger = strategy.buy_trigger
+    strategy.place_orders = strategy.cancel_orders = lambda orders: None
+    strategy.market.add_price(buy_trigger * 1.1)
+    results = {}
+
+    start = time.perf_counter()
+    for _ in range(events):
+        strategy.balance_change_event()
+    results["no transition"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(events):
+        strategy.price_change_event()
+    results["conditions fail"] = time.perf_counter() - start
+
+    below, above = buy_trigger * 0.9, buy_trigger * 1.1
+    start = time.perf_counter()
+    for _ in range(events // 2):
+        strategy.market.add_price(below)
+        strategy.price_change_event()
+        strategy.market.add_price(above)
+        strategy.price_change_event()
+    results["transition"] = time.perf_counter() - start
+    assert strategy.state == "idle"
+    return {path: seconds / events * 1e6 for path, seconds in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ticks", type=int, default=20000)
+    parser.add_argument("--seeds", type=int, default=3)
+    parser.add_argument("--events", type=int, default=200000)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    check_equivalence(args.ticks, args.seeds)
+    compiled = time_events(backtest.Backtest(dict(STRATEGY_SETTINGS)).strategy, args.events)
+    legacy_strategy = backtest.Backtest(dict(STRATEGY_SETTINGS)).strategy
+    bind_legacy_machine(legacy_strategy)
+    legacy = time_events(legacy_strategy, args.events)
+    print(f"{'path':<16}{'Machine us':>12}{'compiled us':>13}{'speedup':>9}")
+    for path in compiled:
+        print(f"{path:<16}{legacy[path]:>12.2f}{compiled[path]:>13.2f}{legacy[path] / compiled[path]:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+""" Applies the changes made to the config file while the bot runs, rebuilding only what changed.
+
+The modification time of the config file is checked every cycle, and content the bot didn't write itself (as its
+JSON snapshot) is diffed against the config last applied, exchange by exchange, market by market and strategy by
+strategy:
+- added exchanges, markets and strategies are created, removed ones are dropped, their open orders are left on
+  the exchange,
+- changed ones are rebuilt from their live state with the changed settings on top, so they keep their orders and
+  state unless the change sets those as well,
+- an exchange whose own settings changed is rebuilt with the markets it loaded already.
+The price and balance histories in the file are never applied, the bot's own are more recent. Replacements are
+built before the live objects are dropped, so a change that fails leaves what it was meant to replace running.
+Changes are diffed against the config of the session store, which its snapshots keep current. Once all changes
+are applied the bot writes a new snapshot, the next change is diffed against it. When some fail the file isn't
+rewritten and the config last applied stays the one to diff against, so fixing the file applies them again.
+"""
+import os
+import time
+
+from superjson import json
+
+from session_store import SessionStore
+from strategies import Strategy
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+EXCHANGE_KEYS = ("traded_markets",)
+MARKET_KEYS = ("strategies", "prices", "balances")
+MISSING = object()
+
+
+def changes(old, new, skip=()):
+    """ :return: (dict of the keys new sets or changes, list of the keys it removes), without the keys to skip """
+    changed = {key: value for key, value in new.items() if key not in skip and old.get(key, MISSING) != value}
+    removed = [key for key in old if key not in skip and key not in new]
+    return changed, removed
+
+
+def overlay(settings, changed, removed):
+    for key in removed:
+        settings.pop(key, None)
+    settings.update(changed)
+    return settings
+
+
+class ConfigWatcher:
+
+    def __init__(self, bot):
+        """
+        :param bot: TradingBot, the config of its session store is the one it runs with, by default the config file
+            as it is now
+        """
+        self.bot = bot
+        self.file_path = bot.config_file_path
+        if bot.session_store.config is None:
+            with open(self.file_path, "rb") as f:
+                bot.session_store.config = f.read()
+        self.mtime = None                   # The first check compares the file with the applied config
+        self.counts = {}
+        self.failures = 0
+
+    def check(self):
+        """ Applies the config file if it changed since it was last applied. """
+        try:
+            mtime = os.stat(self.file_path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f"Can't check {self.file_path} for changes: {e!r}")
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        with open(self.file_path, "rb") as f:
+            snapshot = f.read()
+        session_store = self.bot.session_store
+        if snapshot == session_store.config or SessionStore.digest(snapshot) == session_store.snapshot_digest:
+            session_store.config = snapshot
+            return False
+        try:
+            old, new = json.loads(session_store.config.decode("utf-8")), json.loads(snapshot.decode("utf-8"))
+        except ValueError as e:
+            logger.error(f"Keeping the current config, the changed {self.file_path} can't be loaded: {e!r}")
+            return False
+        start = time.perf_counter()
+        self.counts = {}
+        self.failures = 0
+        self.apply(old, new)
+        counts = ", ".join(f"{count} {what}" for what, count in self.counts.items()) or "nothing to change"
+        if self.failures:
+            logger.error(f"{self.failures} changes to {self.file_path} failed, it's left as it is and diffed against "
+                         f"the config last applied once fixed: {counts}")
+            return True
+        session_store.config = snapshot
+        # The file lacks what the bot journaled since its last snapshot, the new snapshot has both
+        session_store.compact(self.bot)
+        logger.info(f"Applied the changes to {self.file_path} in {time.perf_counter() - start:.3f}s: {counts}")
+        return True
+
+    def count(self, what):
+        self.counts[what] = self.counts.get(what, 0) + 1
+
+    def failed(self, what, e):
+        self.failures += 1
+        logger.error(f"Can't apply the changes to {what}: {e!r}")
+
+    def apply(self, old, new):
+        for exch_name in old.keys() - new.keys():
+            if exch_name in self.bot.exchanges:
+                self.bot.remove_exchange(exch_name)
+                self.count("exchanges removed")
+        for exch_name, settings in new.items():
+            try:
+                self.apply_exchange(exch_name, old.get(exch_name), settings)
+            except Exception as e:
+                self.failed(exch_name, e)
+
+    def apply_exchange(self, exch_name, old, new):
+        exchange = self.bot.exchanges.get(exch_name)
+        if exchange is None or old is None:
+            self.bot.add_exchange(exch_name, new)
+            self.count("exchanges added")
+            return
+        changed, removed = changes(old, new, EXCHANGE_KEYS)
+        old_markets, new_markets = old.get("traded_markets", {}), new.get("traded_markets", {})
+        if changed or removed:
+            settings = overlay(exchange.serialize_settings(), changed, removed)
+            settings["traded_markets"] = {
+                symbol: self.market_settings(exchange, symbol, old_markets.get(symbol), market)
+                for symbol, market in new_markets.items()}
+            self.bot.add_exchange(exch_name, settings, (exchange.markets, exchange.currencies))
+            self.count("exchanges rebuilt")
+            return
+        for symbol in old_markets.keys() - new_markets.keys():
+            if symbol in exchange.traded_markets:
+                self.bot.remove_market(exchange, symbol)
+                self.count("markets removed")
+        for symbol, market in new_markets.items():
+            if old_markets.get(symbol) != market or symbol not in exchange.traded_markets:
+                try:
+                    self.apply_market(exchange, symbol, old_markets.get(symbol), market)
+                except Exception as e:
+                    self.failed(f"{symbol} on {exch_name}", e)
+
+    def market_settings(self, exchange, symbol, old, new):
+        """ Settings to rebuild a market with: its live state with the changes on top, or new if it's new. """
+        market = exchange.traded_markets.get(symbol)
+        if market is None or old is None:
+            return new
+        settings = overlay(market.serialize(), *changes(old, new, MARKET_KEYS))
+        old_strategies, new_strategies = old.get("strategies", {}), new.get("strategies", {})
+        settings["strategies"] = {name: self.strategy_settings(market, name, old_strategies.get(name), strategy)
+                                  for name, strategy in new_strategies.items()}
+        return settings
+
+    @staticmethod
+    def strategy_settings(market, name, old, new):
+        strategy = market.strategies.get(name)
+        if strategy is None or old is None:
+            return new
+        return overlay(strategy.serialize(), *changes(old, new))
+
+    def apply_market(self, exchange, symbol, old, new):
+        market = exchange.traded_markets.get(symbol)
+        if market is None or old is None:
+            self.bot.add_market(exchange, symbol, new)
+            self.count("markets added")
+            return
+        changed, removed = changes(old, new, MARKET_KEYS)
+        if changed or removed:
+            self.bot.add_market(exchange, symbol, self.market_settings(exchange, symbol, old, new))
+            self.count("markets rebuilt")
+            return
+        old_strategies, new_strategies = old.get("strategies", {}), new.get("strategies", {})
+        for name in old_strategies.keys() - new_strategies.keys():
+            strategy = market.strategies.pop(name, None)
+            if strategy is None:
+                continue
+            self.count("strategies removed")
+            open_orders = strategy.orders.select(status="open")
+            for order in open_orders:
+                exchange.order_store.forget(order.id)
+            if open_orders:
+                logger.warning(f"Removed {name} from {symbol} on {exchange.id}, leaving {len(open_orders)} open "
+                               f"orders: {', '.join(str(order.id) for order in open_orders)}")
+        for name, settings in new_strategies.items():
+            if old_strategies.get(name) == settings and name in market.strategies:
+                continue
+            added = name not in market.strategies
+            strategy = Strategy.set_strategy(name, market, self.strategy_settings(market, name,
+                                                                                   old_strategies.get(name), settings))
+            if strategy is None:
+                self.failed(f"{symbol} on {exchange.id}", ValueError(f"Unknown strategy {name}"))
+                continue
+            market.strategies[name] = strategy
+            self.count("strategies added" if added else "strategies rebuilt")
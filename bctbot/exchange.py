@@ -1,23 +1,88 @@
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 import ccxt
-from ccxt.base.errors import NetworkError
+import ccxt.async_support as ccxt_async
+from ccxt.base.errors import DDoSProtection, ExchangeNotAvailable, InvalidNonce, NetworkError
 from utils import retry, RetrySettings
+from balance_tracker import BalanceTracker
 from market import Market
+from market_cache import MarketCache
+from metrics import METRICS
+from order_store import OrderStore
+from rate_limiter import RateLimiter
 
 import logging_setup
+from logging_setup import Lazy
 logger = logging_setup.logging.getLogger(__name__)
 
+
+def api_endpoint(endpoint):
+    """ Routes a ccxt unified API method through Exchange.api_call. """
+    def call(self, *args, **kwargs):
+        return self.api_call(endpoint, *args, **kwargs)
+    call.__name__ = endpoint
+    return call
+
+
 class Exchange:
 
-    def __new__(cls, name, settings):
-        base_class = getattr(ccxt, name)
+    fetch_balance = api_endpoint("fetch_balance")
+    fetch_ticker = api_endpoint("fetch_ticker")
+    fetch_tickers = api_endpoint("fetch_tickers")
+    fetch_open_orders = api_endpoint("fetch_open_orders")
+    fetch_orders = api_endpoint("fetch_orders")
+    fetch_order = api_endpoint("fetch_order")
+    fetch_my_trades = api_endpoint("fetch_my_trades")
+    create_order = api_endpoint("create_order")
+    cancel_order = api_endpoint("cancel_order")
+    create_orders = api_endpoint("create_orders")
+    cancel_orders = api_endpoint("cancel_orders")
+    cancel_all_orders = api_endpoint("cancel_all_orders")
+
+    # Non-ccxt backends (mock or simulated exchanges), looked up before ccxt itself
+    backends = {}
+    async_backends = {}
+
+    def __new__(cls, name, settings, loaded_markets=None):
+        base_class = Exchange.backends.get(name) or getattr(ccxt, name)
         x = type(base_class.__name__, (Exchange, base_class), {})
         return super(Exchange, cls).__new__(x)
 
-    def __init__(self, name, settings):
-        ccxt_config = settings.get("ccxt_config", {})
-        super().__init__(ccxt_config)
-        self.markets = self.load_markets()
+    def __init__(self, name, settings, loaded_markets=None):
+        """
+
+        :param name: ccxt id of the exchange, or the name of a registered backend
+        :param settings: dict of the exchange's settings and traded markets
+        :param loaded_markets: optional (markets, currencies) another instance of the exchange loaded already, used
+            when they include all traded markets
+        """
+        self.exchange_name = name
+        self.api_calls = Counter()
+        self.throttle_lock = threading.Lock()
+        self.order_executor = None
+        self.recorder = None                # TapeRecorder of the calls to the exchange, see TradingBot.record_tapes
+        self.ccxt_config = settings.get("ccxt_config", {})
+        super().__init__(self.ccxt_config)
+        self.max_concurrent_requests = settings.get("max_concurrent_requests", 5)
+        self.tickers_per_request = settings.get("tickers_per_request", None)
+        self.orders_per_request = settings.get("orders_per_request", None)
+        self.trades_per_request = settings.get("trades_per_request", None)
+        self.fill_source = settings.get("fill_source", None)
+        self.market_cache_settings = settings.get("market_cache", {})
+        self.rate_limit_settings = settings.get("rate_limit", {})
+        self.balance_settings = settings.get("balance", {})
+        self.rate_limiter = self.set_rate_limiter()
+        self.market_cache = self.set_market_cache()
         self.traded_markets_settings = settings.get("traded_markets", {})
+        self.refresh_thread = None
+        self.refreshed_markets = None       # (markets, currencies) downloaded in the background, not set yet
+        self.init_markets(loaded_markets)
+        self.order_store = OrderStore(self, self.fill_source, self.trades_per_request)
+        self.balance_tracker = BalanceTracker(self, self.balance_settings)
         self.traded_markets = self.set_traded_markets()
 
     def set_traded_markets(self):
@@ -26,33 +91,328 @@ class Exchange:
         markets = {}
         for mkt_name, market_settings in self.traded_markets_settings.items():
             markets[mkt_name] = Market(mkt_name, self, market_settings)
+            self.balance_tracker.add_market(markets[mkt_name])
         return markets
 
+    def add_market(self, symbol, market_settings):
+        """ Starts trading a market, replacing the Market trading it so far once the new one is built: a market
+        that can't be built leaves the one trading untouched. The markets are only downloaded again if the symbol
+        isn't among those loaded. """
+        if symbol not in self.markets:
+            # Downloaded markets are filtered to the traded ones, the symbol isn't traded until its Market is built
+            self.traded_markets_settings[symbol] = market_settings
+            try:
+                self.refresh_markets()
+            finally:
+                self.traded_markets_settings.pop(symbol)
+        market = Market(symbol, self, market_settings)
+        if symbol in self.traded_markets:
+            self.detach_market(symbol)
+        self.traded_markets_settings[symbol] = market_settings
+        self.traded_markets[symbol] = market
+        self.balance_tracker.add_market(market)
+        return market
+
+    def detach_market(self, symbol):
+        market = self.traded_markets.pop(symbol)
+        self.traded_markets_settings.pop(symbol, None)
+        market.feed.stop()
+        self.balance_tracker.remove_market(market)
+        return market
+
+    def remove_market(self, symbol):
+        """ Stops trading a market, its open orders stay on the exchange. """
+        market = self.detach_market(symbol)
+        open_orders = [order for strategy in market.strategies.values()
+                       for order in strategy.orders.select(status="open")]
+        for order in open_orders:
+            self.order_store.forget(order.id)
+        if open_orders:
+            logger.warning(f"Stopped trading {symbol} on {self.id}, leaving {len(open_orders)} open orders: "
+                           f"{', '.join(str(order.id) for order in open_orders)}")
+        return market
+
+    def start_feeds(self):
+        self.balance_tracker.start()
+        for market in self.traded_markets.values():
+            market.feed.start(market)
+
+    def stop_feeds(self):
+        self.balance_tracker.stop()
+        for market in self.traded_markets.values():
+            market.feed.stop()
+
+    def shutdown(self):
+        """ Stops the streams and threads of an exchange the bot no longer trades on. """
+        self.stop_feeds()
+        if self.order_executor is not None:
+            self.order_executor.shutdown(wait=False)
+
+    def set_market_cache(self):
+        # Backends registered in code are local, there is nothing to download
+        enabled = self.exchange_name not in Exchange.backends
+        if not self.market_cache_settings.get("enabled", enabled):
+            return None
+        return MarketCache(self.exchange_name, self.market_cache_settings.get("folder", "market_cache"),
+                           self.market_cache_settings.get("ttl", 24 * 60 * 60))
+
+    def set_rate_limiter(self):
+        """ By default the rate limiter takes over ccxt's own rate limiting (one request per rateLimit ms). """
+        enabled = self.enableRateLimit and self.exchange_name not in Exchange.backends
+        if not self.rate_limit_settings.get("enabled", enabled):
+            return None
+        rate = self.rate_limit_settings.get("rate") or (1000 / self.rateLimit if self.rateLimit else None)
+        if not rate:
+            return None
+        return RateLimiter(rate, self.rate_limit_settings.get("burst", 1), self.rate_limit_settings.get("weights"),
+                           self.rate_limit_settings.get("lanes"))
+
+    def init_markets(self, loaded_markets=None):
+        """ Sets the markets from the cache if possible, only downloading them when there is no usable cache.
+
+        A stale cache is used as well, while a background thread downloads the markets again.
+        """
+        if loaded_markets is not None and all(symbol in loaded_markets[0] for symbol in self.traded_markets_settings):
+            self.set_markets(*loaded_markets)
+            return
+        cached = self.market_cache.load(self.traded_markets_settings) if self.market_cache else None
+        if cached is None:
+            self.refresh_markets()
+            return
+        markets, currencies, stale = cached
+        self.set_markets(markets, currencies)
+        logger.debug(f"Loaded {len(markets)} markets of {self.exchange_name} from {self.market_cache.file_path}")
+        if stale:
+            self.refresh_thread = threading.Thread(target=self.refresh_markets_in_background,
+                                                   name=f"markets {self.exchange_name}", daemon=True)
+            self.refresh_thread.start()
+
+    def refresh_markets(self):
+        """ Downloads the markets, only keeps those that are traded and caches them. """
+        self.use_markets(*self.download_markets())
+
+    def use_markets(self, markets, currencies):
+        """ Sets the downloaded markets that are traded and caches them. """
+        if self.traded_markets_settings:
+            markets = {symbol: market for symbol, market in markets.items() if symbol in self.traded_markets_settings}
+            codes = {code for market in markets.values() for code in (market["base"], market["quote"])}
+            currencies = {code: currency for code, currency in currencies.items() if code in codes}
+        # ccxt merges the currencies into those it has, which would keep all of them around
+        self.currencies = {}
+        self.set_markets(markets, currencies)
+        if self.market_cache:
+            self.market_cache.save(markets, currencies)
+
+    def refresh_markets_in_background(self):
+        """ Only downloads the markets, trading goes on with the cached ones until the bot swaps the new ones in
+        between two cycles (see apply_refreshed_markets). """
+        try:
+            self.refreshed_markets = self.download_markets()
+        except Exception as e:
+            logger.warning(f"Refreshing the markets of {self.exchange_name} failed, keeping the cached ones: {e!r}")
+
+    def apply_refreshed_markets(self):
+        """ Sets the markets a background refresh downloaded, if there are any. Called on the bot's thread between
+        cycles, so no order or strategy sees the markets halfway set. """
+        refreshed, self.refreshed_markets = self.refreshed_markets, None
+        if refreshed is None:
+            return
+        self.use_markets(*refreshed)
+        logger.info(f"Refreshed the stale markets cache of {self.exchange_name}")
+
+    def load_markets(self, reload=False, params={}):
+        # ccxt's unified methods call load_markets before every request, only actual downloads are metered
+        if self.markets and not reload:
+            return self.markets
+        self.use_markets(*self.download_markets(params))
+        return self.markets
+
     @retry(NetworkError, on_fail=RetrySettings.raise_retry_error)
-    def load_markets(self):
-        return super().load_markets()
+    def download_markets(self, params={}):
+        """ :return: (markets, currencies) loaded by a new instance of the exchange, which leaves the markets of
+            this one as they are while the download runs
+        """
+        client = type(self).__bases__[1](dict(self.ccxt_config))
+        self.metered_call("load_markets", client.load_markets, True, params)
+        return client.markets, client.currencies
+
+    def api_call(self, endpoint, *args, **kwargs):
+        return self.metered_call(endpoint, getattr(super(Exchange, self), endpoint), *args, **kwargs)
+
+    def metered_call(self, endpoint, method, *args, **kwargs):
+        """ Calls method, the endpoint of this exchange's API, through the rate limiter, and counts, times and
+        records the call. """
+        self.api_calls[endpoint] += 1
+        if self.rate_limiter is not None:
+            METRICS.observe("bctbot_rate_limit_wait_seconds", self.rate_limiter.acquire(endpoint),
+                            exchange=self.exchange_name, endpoint=endpoint)
+        start = time.perf_counter()
+        try:
+            response = method(*args, **kwargs)
+        except Exception as e:
+            METRICS.inc("bctbot_api_errors_total", exchange=self.exchange_name, endpoint=endpoint,
+                        error=e.__class__.__name__)
+            if self.recorder is not None:
+                self.recorder.record(endpoint, args, kwargs, time.perf_counter() - start, error=e)
+            raise
+        finally:
+            METRICS.observe("bctbot_api_request_seconds", time.perf_counter() - start,
+                            exchange=self.exchange_name, endpoint=endpoint)
+        if self.recorder is not None:
+            self.recorder.record(endpoint, args, kwargs, time.perf_counter() - start, response)
+        return response
+
+    def throttle(self, cost=None):
+        # The rate limiter already spaced out the calls
+        if self.rate_limiter is not None:
+            return
+        # Orders may be sent from several threads at once, every request waits for its own slot after the previous one
+        with self.throttle_lock:
+            super().throttle(cost)
+            self.lastRestRequestTimestamp = self.milliseconds()
+
+    def run_concurrently(self, function, items):
+        """ Calls function with every item from up to max_concurrent_requests threads.
+
+        The requests stay within the rate limit, as throttle lets them through one at a time.
+
+        :return: list of (item, result) in the order of items, the result being the exception if the call raised one
+        """
+        if self.order_executor is None:
+            self.order_executor = ThreadPoolExecutor(max_workers=self.max_concurrent_requests,
+                                                     thread_name_prefix=f"orders {self.exchange_name}")
+        futures = [self.order_executor.submit(function, item) for item in items]
+        results = []
+        for item, future in zip(items, futures):
+            try:
+                results.append((item, future.result()))
+            except Exception as e:
+                results.append((item, e))
+        return results
+
+    @staticmethod
+    def register_backend(name, backend_class, async_backend_class=None):
+        """ Makes a ccxt-compatible exchange class available under name, e.g. for testing without network.
+
+        :param name: name to use as exchange key in the bot settings
+        :param backend_class: synchronous class implementing the ccxt unified API
+        :param async_backend_class: optional asyncio counterpart used by the async engine
+        """
+        Exchange.backends[name] = backend_class
+        if async_backend_class is not None:
+            Exchange.async_backends[name] = async_backend_class
+
+    def create_async_client(self):
+        """ Creates the ccxt.async_support twin of this exchange, sharing its config and loaded markets. """
+        async_class = Exchange.async_backends.get(self.exchange_name) or getattr(ccxt_async, self.exchange_name)
+        # The async engine fires requests concurrently, so they need throttling: by the rate limiter of this exchange
+        # if it has one (see AsyncTradingEngine.request), by ccxt's own otherwise
+        client = async_class(dict(self.ccxt_config, enableRateLimit=self.rate_limiter is None))
+        client.set_markets(self.markets, self.currencies)
+        return client
 
     @retry(NetworkError, on_fail=RetrySettings.raise_retry_error)
     def get_balance(self):
-        self.balance = self.fetch_balance()
-        balance = {coin: value for coin, value in self.balance["free"].items() if value > 0.001}
-        logger.debug(f"Updated balance for {self.id}: {balance}")
+        self.set_balance(self.fetch_balance())
 
-    def serialize(self):
-        traded_markets = {}
-        for mkt_name, market in self.traded_markets.items():
-            traded_markets[mkt_name] = market.serialize()
+    def poll_balance(self):
+        """ Fetches the balance if it can have changed since it was last fetched, see BalanceTracker.due. """
+        if self.balance_tracker.due():
+            self.get_balance()
+
+    def set_balance(self, balance, partial=False):
+        """ Takes over a polled or streamed balance, partial if it only holds the currencies that changed.
+
+        :return: set of the markets whose base or quote balance changed
+        """
+        if partial and self.balance:
+            for field in ("free", "used", "total"):
+                self.balance.setdefault(field, {}).update(balance[field])
+            for currency in balance["total"]:
+                self.balance[currency] = {field: balance[field][currency] for field in ("free", "used", "total")}
+        else:
+            self.balance = balance
+        logger.debug("Updated balance for %s: %s", self.id,
+                     Lazy(lambda: {coin: value for coin, value in balance["free"].items() if value > 0.001}))
+        return self.balance_tracker.update(balance, partial)
+
+    def ticker_batches(self, symbols=None):
+        """ Splits the (traded) symbols into chunks the exchange accepts in a single fetch_tickers call. """
+        symbols = list(self.traded_markets) if symbols is None else list(symbols)
+        size = self.tickers_per_request or len(symbols) or 1
+        return [symbols[i:i + size] for i in range(0, len(symbols), size)]
+
+    def fetch_traded_prices(self, symbols=None):
+        """ Fetches the last price of every traded market, or the given symbols, with as few requests as possible.
+
+        :return: dict of symbol to last price, empty if the exchange can't fetch multiple tickers at once.
+            Markets missing from the result should fall back to Market.update_ticker.
+        """
+        if not self.has.get("fetchTickers"):
+            return {}
+        prices = {}
+        for batch in self.ticker_batches(symbols):
+            tickers = self.fetch_tickers_batch(batch)
+            batch = set(batch)
+            prices.update({symbol: ticker["last"] for symbol, ticker in tickers.items()
+                           if symbol in batch and ticker.get("last") is not None})
+        return prices
+
+    def order_batches(self, items):
+        """ Splits orders or order ids into chunks the exchange accepts in a single create_orders or cancel_orders call. """
+        size = self.orders_per_request or len(items) or 1
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    @retry((DDoSProtection, ExchangeNotAvailable, InvalidNonce), on_fail=RetrySettings.raise_retry_error)
+    def create_orders_batch(self, requests):
+        return self.create_orders(requests)
+
+    @retry(NetworkError, on_fail=RetrySettings.raise_retry_error)
+    def cancel_orders_batch(self, ids, symbol):
+        return self.cancel_orders(ids, symbol)
+
+    def poll_cost(self, markets_count):
+        """ Number of requests needed to fetch the balance and the tickers of markets_count markets. """
+        if self.has.get("fetchTickers"):
+            return 1 + math.ceil(markets_count / (self.tickers_per_request or markets_count or 1))
+        return 1 + markets_count
+
+    def no_tickers(self):
+        logger.warning(f"Fetching tickers in batch failed for {self.id}, falling back to single tickers")
+        return {}
+
+    @retry(NetworkError, on_fail=no_tickers)
+    def fetch_tickers_batch(self, symbols):
+        return self.fetch_tickers(symbols)
+
+    def serialize_settings(self):
+        """ Serializes the exchange's own settings, without its traded markets. """
         exchange = {
-            "ccxt_config": {
+            "ccxt_config": dict(self.ccxt_config, **{
                 "apiKey": self.apiKey,
                 "secret": self.secret,
                 "verbose": self.verbose,
                 "enableRateLimit": self.enableRateLimit
-            },
-            "traded_markets": traded_markets
+            }),
+            "max_concurrent_requests": self.max_concurrent_requests,
+            "tickers_per_request": self.tickers_per_request,
+            "orders_per_request": self.orders_per_request,
+            "trades_per_request": self.trades_per_request,
+            "fill_source": self.fill_source,
+            "market_cache": self.market_cache_settings,
+            "rate_limit": self.rate_limit_settings,
+            "balance": self.balance_tracker.serialize()
         }
         return exchange
 
+    def serialize(self):
+        traded_markets = {}
+        for mkt_name, market in self.traded_markets.items():
+            traded_markets[mkt_name] = market.serialize()
+        exchange = self.serialize_settings()
+        exchange["traded_markets"] = traded_markets
+        return exchange
+
     def __str__(self):
         markets = "\n  ".join([str(market) for market in self.traded_markets.values()])
         return f"{self.__class__.__name__}: {self.name}\n  " \
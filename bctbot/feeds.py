@@ -0,0 +1,308 @@
+import asyncio
+import json
+import random
+import threading
+
+import websockets
+from ccxt.base.errors import BaseError
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+
+class MarketDataFeed:
+    """ Source of prices for a Market.
+
+    A feed that isn't live leaves it to the bot's loop to poll the ticker over REST.
+    """
+
+    def __init__(self, settings=None):
+        self.settings = {} if settings is None else settings
+        self.market = None
+
+    @staticmethod
+    def set_feed(feed_settings):
+        feed_type = feed_settings.get("type", "rest")
+        if feed_type == "rest":
+            return RestFeed(feed_settings)
+        elif feed_type == "websocket":
+            return WebSocketFeed(feed_settings)
+        raise ValueError(f"Unknown market data feed: {feed_type}")
+
+    @property
+    def live(self):
+        return False
+
+    def start(self, market):
+        self.market = market
+
+    def stop(self):
+        pass
+
+    def serialize(self):
+        return self.settings
+
+
+class RestFeed(MarketDataFeed):
+    """ Polls the ticker over REST from the bot's loop. """
+
+    def __init__(self, settings=None):
+        super().__init__(dict({"type": "rest"}, **(settings or {})))
+
+
+class JsonTradeAdapter:
+    """ Translates between a WebSocket stream and the feed, for a plain JSON protocol:
+
+    sent:     {"op": "subscribe", "symbol": <market id>}
+    received: {"type": "trade", "symbol": <market id>, "price": <float>}
+              {"type": "book", "symbol": <market id>, "bid": <float>, "ask": <float>}
+
+    Exchange specific protocols are supported by subclassing and overriding subscribe_message and parse.
+    """
+
+    def subscribe_message(self, market):
+        return json.dumps({"op": "subscribe", "symbol": market.id})
+
+    def parse(self, message, market):
+        """ :return: dict with "price" and/or "bid" and "ask", or None if the message isn't for this market """
+        data = json.loads(message)
+        if data.get("symbol") != market.id:
+            return None
+        if data.get("type") == "trade":
+            return {"price": float(data["price"])}
+        if data.get("type") == "book":
+            return {"bid": float(data["bid"]), "ask": float(data["ask"])}
+        return None
+
+
+class WebSocketFeed(MarketDataFeed):
+    """ Streams trades (and optionally top of book) of a market over a WebSocket in a background thread.
+
+    Every trade goes into Market.on_market_data right away, which fires the price events of the strategies.
+    After every (re)connect the price is resynced over REST, so trades missed while disconnected don't go
+    unnoticed. While disconnected the feed isn't live, so the loop polls the ticker over REST instead.
+
+    settings:
+        url: WebSocket url to connect to
+        reconnect_delay: seconds to wait before the first reconnect, doubled up to max_reconnect_delay
+    """
+
+    adapters = {"json": JsonTradeAdapter}
+
+    def __init__(self, settings):
+        super().__init__(dict({"type": "websocket"}, **settings))
+        self.url = self.settings["url"]
+        self.adapter = self.adapters[self.settings.get("adapter", "json")]()
+        self.reconnect_delay = self.settings.get("reconnect_delay", 1)
+        self.max_reconnect_delay = self.settings.get("max_reconnect_delay", 30)
+        self.connected = False
+        self.reconnects = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def live(self):
+        return self.connected
+
+    def start(self, market):
+        super().start(market)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run_thread, name=self.name.lower(), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    @property
+    def name(self):
+        return f"Feed of {self.market.symbol}"
+
+    def subscribe_message(self):
+        return self.adapter.subscribe_message(self.market)
+
+    def on_message(self, message):
+        update = self.adapter.parse(message, self.market)
+        if update:
+            self.market.on_market_data(**update)
+
+    def run_thread(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            loop.close()
+
+    async def run(self):
+        delay = self.reconnect_delay
+        while not self.stopped.is_set():
+            try:
+                async with websockets.connect(self.url) as ws:
+                    await ws.send(self.subscribe_message())
+                    self.connected = True
+                    delay = self.reconnect_delay
+                    logger.info(f"{self.name} connected to {self.url}")
+                    self.resync()
+                    while not self.stopped.is_set():
+                        try:
+                            message = await asyncio.wait_for(ws.recv(), timeout=1)
+                        except asyncio.TimeoutError:
+                            continue
+                        self.on_message(message)
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                logger.warning(f"{self.name} disconnected: {e!r}, reconnecting in {delay:.1f}s")
+            finally:
+                self.connected = False
+            if self.stopped.is_set():
+                break
+            self.reconnects += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def resync(self):
+        """ Catches up on the price over REST after (re)connecting. """
+        try:
+            self.market.on_market_data(price=self.market.exchange.fetch_ticker(self.market.symbol)["last"])
+        except BaseError as e:
+            logger.warning(f"Resyncing {self.market.symbol} over REST failed: {e!r}")
+
+
+class BalanceStream:
+    """ Source of balance updates for the BalanceTracker of an exchange.
+
+    A stream that isn't live leaves it to the bot's loop to poll fetch_balance.
+    """
+
+    def __init__(self, settings=None):
+        self.settings = {} if settings is None else settings
+        self.tracker = None
+
+    @staticmethod
+    def set_stream(stream_settings):
+        stream_type = stream_settings.get("type", "rest")
+        if stream_type == "rest":
+            return BalanceStream(dict({"type": "rest"}, **stream_settings))
+        elif stream_type == "websocket":
+            return WebSocketBalanceStream(stream_settings)
+        elif stream_type == "ccxt":
+            return CcxtBalanceStream(stream_settings)
+        raise ValueError(f"Unknown balance stream: {stream_type}")
+
+    @property
+    def live(self):
+        return False
+
+    def start(self, tracker):
+        self.tracker = tracker
+
+    def stop(self):
+        pass
+
+    def serialize(self):
+        return self.settings
+
+
+class JsonBalanceAdapter:
+    """ Translates between a private WebSocket stream and the balance stream, for a plain JSON protocol:
+
+    sent:     {"op": "subscribe", "channel": "balance"}
+    received: {"type": "balance", "balances": {<currency>: {"free": <float>, "used": <float>, "total": <float>}}}
+              with only the currencies that changed
+
+    Exchange specific protocols, including their authentication, are supported by subclassing and overriding
+    subscribe_message and parse.
+    """
+
+    def subscribe_message(self, exchange):
+        return json.dumps({"op": "subscribe", "channel": "balance"})
+
+    def parse(self, message, exchange):
+        """ :return: ccxt balance structure of the currencies that changed, or None if the message isn't a balance """
+        data = json.loads(message)
+        if data.get("type") != "balance":
+            return None
+        balance = {"free": {}, "used": {}, "total": {}}
+        for currency, values in data["balances"].items():
+            for field in balance:
+                balance[field][currency] = float(values[field])
+        return balance
+
+
+class WebSocketBalanceStream(WebSocketFeed):
+    """ Streams the balance changes of an exchange account over a WebSocket into its BalanceTracker.
+
+    After every (re)connect the balance is resynced over REST, while disconnected the loop polls fetch_balance.
+    The settings are those of WebSocketFeed.
+    """
+
+    adapters = {"json": JsonBalanceAdapter}
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.tracker = None
+
+    def start(self, tracker):
+        self.tracker = tracker
+        super().start(None)
+
+    @property
+    def name(self):
+        return f"Balance stream of {self.tracker.exchange.id}"
+
+    def subscribe_message(self):
+        return self.adapter.subscribe_message(self.tracker.exchange)
+
+    def on_message(self, message):
+        balance = self.adapter.parse(message, self.tracker.exchange)
+        if balance:
+            self.tracker.push(balance, partial=True)
+
+    def resync(self):
+        try:
+            self.tracker.push(self.tracker.exchange.fetch_balance())
+        except BaseError as e:
+            logger.warning(f"Resyncing the balance of {self.tracker.exchange.id} over REST failed: {e!r}")
+
+
+class CcxtBalanceStream(WebSocketBalanceStream):
+    """ Watches the balance with ccxt.pro, for the exchanges it supports, logged in with the exchange's ccxt_config.
+
+    settings:
+        reconnect_delay, max_reconnect_delay: as for WebSocketFeed
+    """
+
+    def __init__(self, settings):
+        super().__init__(dict({"url": None}, **settings))
+
+    async def run(self):
+        import ccxt.pro
+        exchange = self.tracker.exchange
+        client = getattr(ccxt.pro, exchange.exchange_name)(dict(exchange.ccxt_config))
+        delay = self.reconnect_delay
+        watch = None
+        try:
+            while not self.stopped.is_set():
+                try:
+                    if not self.connected:
+                        self.resync()
+                        self.connected = True
+                    if watch is None:
+                        watch = asyncio.ensure_future(client.watch_balance())
+                    done, _ = await asyncio.wait({watch}, timeout=1)
+                    if not done:
+                        continue
+                    balance, watch = watch.result(), None
+                    delay = self.reconnect_delay
+                    self.tracker.push(balance)
+                except BaseError as e:
+                    watch, self.connected = None, False
+                    logger.warning(f"{self.name} disconnected: {e!r}, reconnecting in {delay:.1f}s")
+                    self.reconnects += 1
+                    await asyncio.sleep(delay * random.uniform(0.5, 1))
+                    delay = min(delay * 2, self.max_reconnect_delay)
+        finally:
+            self.connected = False
+            if watch is not None:
+                watch.cancel()
+            await client.close()
@@ -0,0 +1,89 @@
+""" Price levels of a grid strategy, spaced evenly or geometrically across a range.
+
+Levels are kept sorted, so the level a price falls in and the levels a price move crossed are found by bisection,
+whatever the number of levels. The levels that hold an order of a side are kept as sorted level indices as well,
+the orders nearest a price are a slice around the price's index.
+"""
+import bisect
+
+import numpy as np
+
+SPACINGS = ("arithmetic", "geometric")
+
+
+class Grid:
+
+    def __init__(self, lower_price, upper_price, levels, spacing="arithmetic"):
+        self.lower_price = lower_price
+        self.upper_price = upper_price
+        self.spacing = spacing
+        space = np.geomspace if spacing == "geometric" else np.linspace
+        # A list bisects a single price faster than searchsorted on the array
+        self.prices = space(lower_price, upper_price, levels).tolist()
+
+    def __len__(self):
+        return len(self.prices)
+
+    @staticmethod
+    def compile(settings):
+        """ Builds the grid from the lower_price, upper_price, levels and spacing of strategy settings.
+
+        :raise ValueError: if a setting is missing, the prices aren't positive and increasing, there are fewer than two
+            levels or the spacing is unknown
+        """
+        for key in ("lower_price", "upper_price", "levels"):
+            if key not in settings:
+                raise ValueError(f"The grid needs {key}")
+        lower_price, upper_price, levels = settings["lower_price"], settings["upper_price"], settings["levels"]
+        spacing = settings.get("spacing", "arithmetic")
+        if not 0 < lower_price < upper_price:
+            raise ValueError(f"The grid needs 0 < lower_price < upper_price, got {lower_price} and {upper_price}")
+        if int(levels) != levels or levels < 2:
+            raise ValueError(f"The grid needs a whole number of at least 2 levels, got {levels}")
+        if spacing not in SPACINGS:
+            raise ValueError(f"Unknown grid spacing {spacing}, use one of {SPACINGS}")
+        return Grid(lower_price, upper_price, int(levels), spacing)
+
+    def index(self, price):
+        """ Number of levels at or below price: levels below the index are buy levels, the others sell levels. """
+        return bisect.bisect_right(self.prices, price)
+
+    def in_range(self, price):
+        return self.lower_price <= price <= self.upper_price
+
+    def serialize(self):
+        return {"lower_price": self.lower_price, "upper_price": self.upper_price, "levels": len(self.prices),
+                "spacing": self.spacing}
+
+
+class ArmedLevels:
+    """ Sorted indices of the levels that hold an order of one side. """
+
+    def __init__(self, indices=()):
+        self.indices = sorted(indices)
+
+    def __contains__(self, index):
+        i = bisect.bisect_left(self.indices, index)
+        return i < len(self.indices) and self.indices[i] == index
+
+    def __len__(self):
+        return len(self.indices)
+
+    def add(self, index):
+        if index not in self:
+            bisect.insort(self.indices, index)
+
+    def remove(self, index):
+        i = bisect.bisect_left(self.indices, index)
+        if i < len(self.indices) and self.indices[i] == index:
+            del self.indices[i]
+
+    def below(self, index, count):
+        """ The count armed levels nearest below index. """
+        i = bisect.bisect_left(self.indices, index)
+        return self.indices[max(0, i - count):i]
+
+    def above(self, index, count):
+        """ The count armed levels nearest at or above index. """
+        i = bisect.bisect_left(self.indices, index)
+        return self.indices[i:i + count]
@@ -0,0 +1,333 @@
+""" Fixed size history of timestamped values, e.g. the prices of a market, with rolling indicators.
+
+The entries live in NumPy arrays used as a ring buffer, which only grow up to the configured size as entries
+come in. Rolling indicators are created by the first query for a window and from then on updated with every
+new entry, so querying them never rescans the history:
+    market.prices.sma(50), market.prices.ema(20), market.prices.volatility(100), market.prices.max(500)
+"""
+import base64
+import collections
+import math
+import time
+import zlib
+
+import numpy as np
+
+COLUMNS = ("timestamp", "value", "volume")
+MISSING_TIMESTAMP = np.iinfo(np.int64).min      # Entries loaded from sessions before timestamps were kept
+
+
+def compress(array):
+    # Prices hardly compress, the lowest level saves most of the time and loses little on timestamps and volumes
+    return zlib.compress(array.tobytes(), 1)
+
+
+def encode(array):
+    return base64.b64encode(compress(array)).decode("ascii")
+
+
+def decode(data, dtype):
+    """ Decodes a column of a packed (bytes) or serialized (base64 text) history. """
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    return np.frombuffer(zlib.decompress(data), dtype=dtype)
+
+
+class RollingIndicator:
+    """ Statistic over the last window entries of a history, updated with every entry added to it. """
+
+    # Running sums slowly pick up rounding errors, so they are recomputed after this many windows of updates
+    resync_windows = 100
+
+    def __init__(self, history, window):
+        if window < 1 or window > history.size:
+            raise ValueError(f"Window must be between 1 and the history size {history.size}, got {window}")
+        self.window = window
+        self.reset(history)
+
+    def reset(self, history):
+        raise NotImplementedError
+
+    def add(self, history, value):
+        """ Called with each new value before it's added to the history. """
+        raise NotImplementedError
+
+
+class SimpleMovingAverage(RollingIndicator):
+
+    def reset(self, history):
+        values = history.values()[-self.window:]
+        self.count = len(values)
+        self.total = float(values.sum())
+        self.updates = 0
+
+    def add(self, history, value):
+        if self.updates >= self.resync_windows * self.window:
+            self.reset(history)
+        if self.count == self.window:
+            self.total -= history[-self.window]
+        else:
+            self.count += 1
+        self.total += value
+        self.updates += 1
+
+    @property
+    def value(self):
+        return self.total / self.count if self.count else None
+
+
+class ExponentialMovingAverage(RollingIndicator):
+    """ EMA with alpha 2 / (window + 1), starting at the first value. """
+
+    def reset(self, history):
+        self.alpha = 2 / (self.window + 1)
+        self.value = None
+        for value in history.values():
+            self.add(history, value)
+
+    def add(self, history, value):
+        self.value = value if self.value is None else self.value + self.alpha * (value - self.value)
+
+
+class Volatility(RollingIndicator):
+    """ Standard deviation of the last window log returns. """
+
+    @staticmethod
+    def log_return(previous, value):
+        return math.log(value / previous) if previous > 0 and value > 0 else 0.0
+
+    def reset(self, history):
+        if self.window + 1 > history.size:
+            raise ValueError(f"Volatility over {self.window} returns needs a history size of {self.window + 1}")
+        values = history.values()[-(self.window + 1):]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            returns = np.log(values[1:] / values[:-1])
+        returns[~np.isfinite(returns)] = 0.0
+        self.count = len(returns)
+        self.total = float(returns.sum())
+        self.squares = float((returns ** 2).sum())
+        self.updates = 0
+
+    def add(self, history, value):
+        if not len(history):
+            return
+        if self.updates >= self.resync_windows * self.window:
+            self.reset(history)
+        new = self.log_return(history[-1], value)
+        if self.count == self.window:
+            old = self.log_return(history[-self.window - 1], history[-self.window])
+            self.total -= old
+            self.squares -= old ** 2
+        else:
+            self.count += 1
+        self.total += new
+        self.squares += new ** 2
+        self.updates += 1
+
+    @property
+    def value(self):
+        if self.count < 2:
+            return None
+        mean = self.total / self.count
+        return math.sqrt(max(0.0, self.squares / self.count - mean ** 2))
+
+
+class RollingExtreme(RollingIndicator):
+    """ Minimum or maximum of the last window values, from a monotonic queue of candidates. """
+
+    def __init__(self, history, window, maximum):
+        self.maximum = maximum
+        super().__init__(history, window)
+
+    def reset(self, history):
+        self.candidates = collections.deque()    # (index, value), from oldest to newest
+        values = history.values()[-self.window:]
+        first = history.added - len(values)
+        for i, value in enumerate(values.tolist()):
+            self.push(first + i, value)
+
+    def push(self, index, value):
+        candidates = self.candidates
+        if self.maximum:
+            while candidates and candidates[-1][1] <= value:
+                candidates.pop()
+        else:
+            while candidates and candidates[-1][1] >= value:
+                candidates.pop()
+        candidates.append((index, value))
+        while candidates[0][0] <= index - self.window:
+            candidates.popleft()
+
+    def add(self, history, value):
+        self.push(history.added, value)
+
+    @property
+    def value(self):
+        return self.candidates[0][1] if self.candidates else None
+
+
+class History:
+    """ Ring buffer of (timestamp, value, volume) entries that keeps the last size entries.
+
+    Indexing and iterating give the values, oldest first, so a history can be used like the list of prices
+    it replaces: history[-1] is the last price.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.data = np.empty((min(size, 64), len(COLUMNS)))
+        self.start = 0          # Index in data of the oldest entry
+        self.length = 0
+        self.added = 0          # Number of entries ever added, including those dropped since
+        self.indicators = {}
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.values().tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.values()[index].tolist()
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("history index out of range")
+        return float(self.data[(self.start + index) % len(self.data), 1])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.length}/{self.size} entries)"
+
+    def add(self, value, timestamp=None, volume=0.0):
+        for indicator in self.indicators.values():
+            indicator.add(self, value)
+        if self.length == len(self.data) and len(self.data) < self.size:
+            self.grow()
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.length < len(self.data):
+            self.data[(self.start + self.length) % len(self.data)] = (timestamp, value, volume)
+            self.length += 1
+        else:
+            self.data[self.start] = (timestamp, value, volume)
+            self.start = (self.start + 1) % len(self.data)
+        self.added += 1
+
+    def extend(self, values, timestamps=None, volumes=None):
+        timestamps = [math.nan] * len(values) if timestamps is None else timestamps
+        volumes = [0.0] * len(values) if volumes is None else volumes
+        for value, timestamp, volume in zip(values, timestamps, volumes):
+            self.add(value, timestamp, volume)
+
+    def grow(self):
+        data = self.rows()
+        self.data = np.empty((min(self.size, 2 * len(self.data)), len(COLUMNS)))
+        self.data[:len(data)] = data
+        self.start = 0
+
+    def rows(self, count=None):
+        """ :return: array of the last count (timestamp, value, volume) entries, oldest first """
+        count = self.length if count is None else min(count, self.length)
+        if count == 0:
+            return np.empty((0, len(COLUMNS)))
+        first = (self.start + self.length - count) % len(self.data)
+        end = first + count
+        if end <= len(self.data):
+            return self.data[first:end].copy()
+        return np.concatenate([self.data[first:], self.data[:end - len(self.data)]])
+
+    def values(self):
+        return self.rows()[:, 1]
+
+    def timestamps(self):
+        return self.rows()[:, 0]
+
+    def tail(self, count):
+        """ :return: (values, timestamps, volumes) lists of the last count entries """
+        rows = self.rows(count)
+        return rows[:, 1].tolist(), rows[:, 0].tolist(), rows[:, 2].tolist()
+
+    def indicator(self, key, factory):
+        indicator = self.indicators.get(key)
+        if indicator is None:
+            indicator = self.indicators[key] = factory()
+        return indicator.value
+
+    def sma(self, window):
+        return self.indicator(("sma", window), lambda: SimpleMovingAverage(self, window))
+
+    def ema(self, window):
+        return self.indicator(("ema", window), lambda: ExponentialMovingAverage(self, window))
+
+    def volatility(self, window):
+        return self.indicator(("volatility", window), lambda: Volatility(self, window))
+
+    def min(self, window):
+        return self.indicator(("min", window), lambda: RollingExtreme(self, window, maximum=False))
+
+    def max(self, window):
+        return self.indicator(("max", window), lambda: RollingExtreme(self, window, maximum=True))
+
+    def pack(self):
+        """ Compact form for binary session snapshots: every column compressed on its own.
+
+        Timestamps are stored as differences in milliseconds, which compress to almost nothing when the
+        entries come in at a steady pace.
+        """
+        rows = self.rows()
+        timestamps = np.where(np.isnan(rows[:, 0]), MISSING_TIMESTAMP, np.round(rows[:, 0] * 1000))
+        timestamps = timestamps.astype("<i8")
+        return {
+            "size": self.size,
+            "rows": len(rows),
+            "timestamps": compress(np.diff(timestamps, prepend=np.int64(0))),
+            "values": compress(rows[:, 1].astype("<f8")),
+            "volumes": compress(rows[:, 2].astype("<f8"))
+        }
+
+    def serialize(self):
+        """ Compact form for the session file: the packed columns base64 encoded. """
+        packed = self.pack()
+        for column in ("timestamps", "values", "volumes"):
+            packed[column] = base64.b64encode(packed[column]).decode("ascii")
+        return packed
+
+    @classmethod
+    def from_rows(cls, rows, size):
+        """ Builds a history of the last size (timestamp, value, volume) rows at once, without adding them one by
+        one. The buffer gets the capacity adding them would have grown it to. """
+        history = cls(size)
+        rows = rows[len(rows) - min(len(rows), size):]
+        capacity = len(history.data)
+        while capacity < len(rows):
+            capacity = min(size, 2 * capacity)
+        history.data = np.empty((capacity, len(COLUMNS)))
+        history.data[:len(rows)] = rows
+        history.length = history.added = len(rows)
+        return history
+
+    @classmethod
+    def load(cls, data=None, size=None):
+        """ Restores a history from its serialized form, a list of values (older sessions) or another history.
+
+        :param size: number of entries to keep, by default the size of the serialized history
+        """
+        if isinstance(data, History):
+            if size is None or size == data.size:
+                return data
+            history = cls(size)
+            history.extend(*data.tail(size))
+            return history
+        if isinstance(data, dict):
+            size = data["size"] if size is None else size
+            count = min(data["rows"], size)
+            rows = np.empty((count, len(COLUMNS)))
+            if count:
+                timestamps = np.cumsum(decode(data["timestamps"], "<i8"))[-count:]
+                rows[:, 0] = np.where(timestamps == MISSING_TIMESTAMP, np.nan, timestamps / 1000)
+                rows[:, 1] = decode(data["values"], "<f8")[-count:]
+                rows[:, 2] = decode(data["volumes"], "<f8")[-count:]
+            return cls.from_rows(rows, size)
+        history = cls(10000 if size is None else size)
+        history.extend(list(data or [])[-history.size:])
+        return history
@@ -0,0 +1,106 @@
+""" Buy and sell ladders of a strategy, compiled once from its settings.
+
+The settings describe every rung with numbered keys, e.g. buy_price_1 and buy_amount_percentage_1, as many as
+needed. Those keys are parsed and validated once; from then on the rungs of each side are parallel arrays in
+the order of their numbers, so recalculating a ladder of hundreds of rungs is a few array operations.
+"""
+import re
+
+import numpy as np
+
+RUNG_KEY = re.compile(r"^(buy|sell)_(price|amount_percentage)_(\d+)$")
+SIDES = ("buy", "sell")
+
+
+class Rungs:
+    """ The rungs of one side of a ladder, ordered by number. """
+
+    def __init__(self, side, numbers, prices, percentages):
+        self.side = side
+        self.numbers = numbers
+        self.prices = np.asarray(prices, dtype=float)
+        self.percentages = np.asarray(percentages, dtype=float)
+        # Every rung takes its percentage of what the rungs before it leave, so the share of the whole amount
+        # every rung takes and the part left after all rungs are fixed
+        left = np.cumprod(np.concatenate(([1.0], 1 - self.percentages)))
+        self.shares = left[:-1] * self.percentages
+        self.left = float(left[-1])
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def internal_ids(self):
+        return [f"{self.side}_order_{number}" for number in self.numbers]
+
+
+class Ladder:
+
+    def __init__(self, buy, sell):
+        self.buy = buy
+        self.sell = sell
+
+    @staticmethod
+    def is_rung_key(key):
+        return RUNG_KEY.match(key) is not None
+
+    @staticmethod
+    def compile(settings):
+        """ Builds the ladder from the rung keys of strategy settings, other keys are ignored.
+
+        :raise ValueError: if a rung misses its price or percentage, a price isn't positive, a percentage isn't
+            between 0 and 1, the percentages of a side add up to more than 1, or a side has no rungs
+        """
+        rungs = {side: {} for side in SIDES}
+        for key, value in settings.items():
+            match = RUNG_KEY.match(key)
+            if match:
+                side, field, number = match.groups()
+                rungs[side].setdefault(int(number), {})[field] = value
+        compiled = {}
+        for side in SIDES:
+            if not rungs[side]:
+                raise ValueError(f"The ladder needs at least one {side} rung, e.g. {side}_price_1 and "
+                                 f"{side}_amount_percentage_1")
+            numbers = sorted(rungs[side])
+            for number in numbers:
+                rung = rungs[side][number]
+                for field in ("price", "amount_percentage"):
+                    if field not in rung:
+                        raise ValueError(f"{side}_{field}_{number} is missing")
+                if not rung["price"] > 0:
+                    raise ValueError(f"{side}_price_{number} must be positive, got {rung['price']}")
+                if not 0 <= rung["amount_percentage"] <= 1:
+                    raise ValueError(f"{side}_amount_percentage_{number} must be between 0 and 1, "
+                                     f"got {rung['amount_percentage']}")
+            percentages = [rungs[side][number]["amount_percentage"] for number in numbers]
+            if sum(percentages) > 1 + 1e-9:
+                raise ValueError(f"The {side} amount percentages add up to {sum(percentages)}, more than 1")
+            compiled[side] = Rungs(side, numbers, [rungs[side][number]["price"] for number in numbers], percentages)
+        return Ladder(compiled["buy"], compiled["sell"])
+
+    def sell_amounts(self, amount_to_sell):
+        """ Every sell rung sells its percentage of what the rungs before it leave.
+
+        :return: (amount per sell rung, amount left after all rungs)
+        """
+        return amount_to_sell * self.sell.shares, amount_to_sell * self.sell.left
+
+    def serialize(self):
+        settings = {}
+        for rungs in (self.buy, self.sell):
+            for number, price, percentage in zip(rungs.numbers, rungs.prices.tolist(), rungs.percentages.tolist()):
+                settings[f"{rungs.side}_price_{number}"] = price
+                settings[f"{rungs.side}_amount_percentage_{number}"] = percentage
+        return settings
+
+
+class Refill:
+    """ Divides what's left to buy over the buy rungs from the last rung back, each up to its initial cost. """
+
+    def __init__(self, initial_costs):
+        self.initial_costs = np.asarray(initial_costs, dtype=float)
+        # What the rungs after every rung take when they're refilled completely
+        self.after = np.cumsum(self.initial_costs[::-1])[::-1] - self.initial_costs
+
+    def costs(self, to_divide):
+        return np.minimum(np.maximum(to_divide - self.after, 0), self.initial_costs)
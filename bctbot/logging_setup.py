@@ -1,4 +1,133 @@
+""" Logging configuration of the bot.
+
+Module loggers only put their records on a queue, a background thread writes them to the log files and the
+console, so formatting and disk IO don't hold up trading. The log files hold one JSON object per line.
+
+Noisy messages that repeat every cycle can be sampled by passing extra={"sample": n}: only every n-th record
+from that line of code is logged. Pass arguments as logger.debug("... %s", value) instead of formatting them
+into an f-string in hot paths, so nothing is formatted when the level is disabled.
+"""
+import atexit
+import copy
+import datetime
+import json
 import logging.config
+import logging.handlers
+import os
+import queue
+
+# Next to the bot's modules, wherever it is started from
+LOG_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "log")
+
+# Attributes every LogRecord has, anything else on a record was passed through extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "sample",
+                                                                                    "json_line"}
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats records as a single line JSON object, including any fields passed through extra. """
+
+    def format(self, record):
+        # Every log file formats the same record, only the first one has to do the work
+        if getattr(record, "json_line", None):
+            return record.json_line
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "message": record.getMessage()
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        record.json_line = json.dumps(entry, default=str)
+        return record.json_line
+
+
+class SampleFilter(logging.Filter):
+    """ Lets through only every n-th record of a line of code that was logged with extra={"sample": n}. """
+
+    def __init__(self):
+        super().__init__()
+        self.counts = {}
+
+    def filter(self, record):
+        every = getattr(record, "sample", None)
+        if not every:
+            return True
+        key = (record.name, record.lineno)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        return count % every == 0
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ Puts records on the queue without formatting them, the writer thread's handlers do that. """
+
+    def prepare(self, record):
+        # The message is rendered here since its arguments may change once the caller moves on
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class Lazy:
+    """ Defers a costly log argument, e.g. logger.debug("Metrics: %s", Lazy(scheduler.metrics)), until the
+    record is actually logged. """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+
+# Messages logged for every market every cycle are sampled at this rate
+TICK_SAMPLE = 10
+
+class BatchFlush:
+    """ Handler mixin that leaves flushing after every record to BatchingQueueListener, which flushes once the
+    queue runs empty. """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchedStreamHandler(BatchFlush, logging.StreamHandler):
+    pass
+
+
+class BatchedRotatingFileHandler(BatchFlush, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class BatchedTimedRotatingFileHandler(BatchFlush, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                getattr(handler, "flush_batch", handler.flush)()
+            return self.queue.get(block)
+
+
+LOG_QUEUE = queue.Queue(-1)
+
+
 LOGGING_CONFIG = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -7,13 +136,26 @@ LOGGING_CONFIG = {
             'format': '%(asctime)s | %(levelname)s | %(name)s | %(funcName)s >>  %(message)s',
             'datefmt': '%Y-%m-%d %H:%M:%S'
         },
+        'json': {
+            '()': JsonFormatter
+        },
+    },
+    'filters': {
+        'sample': {
+            '()': SampleFilter
+        },
     },
     'handlers': {
+        'queue': {
+            '()': LazyQueueHandler,
+            'queue': LOG_QUEUE,
+            'filters': ['sample']
+        },
         'debug_log': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
-            'formatter': 'normal',
-            'filename': 'log/debug.log',
+            '()': BatchedTimedRotatingFileHandler,
+            'formatter': 'json',
+            'filename': os.path.join(LOG_FOLDER, 'debug.log'),
             'when': 'H',
             'interval': 1,
             'backupCount': 0,
@@ -21,9 +163,9 @@ LOGGING_CONFIG = {
         },
         'info_log': {
             'level': 'INFO',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
-            'formatter': 'normal',
-            'filename': 'log/info.log',
+            '()': BatchedTimedRotatingFileHandler,
+            'formatter': 'json',
+            'filename': os.path.join(LOG_FOLDER, 'info.log'),
             'when': 'H',
             'interval': 1,
             'backupCount': 0,
@@ -31,9 +173,9 @@ LOGGING_CONFIG = {
         },
         'error_log': {
             'level': 'ERROR',
-            'class': 'logging.handlers.RotatingFileHandler',
-            'formatter': 'normal',
-            'filename': 'log/error.log',
+            '()': BatchedRotatingFileHandler,
+            'formatter': 'json',
+            'filename': os.path.join(LOG_FOLDER, 'error.log'),
             'maxBytes': 5000,
             'backupCount': 0,
             'encoding': 'utf-8'
@@ -41,45 +183,134 @@ LOGGING_CONFIG = {
         'log_console': {
             'level': 'DEBUG',
             'formatter': 'normal',
-            'class': 'logging.StreamHandler',
+            '()': BatchedStreamHandler,
             'stream': 'ext://sys.stdout'
         }
     },
     'loggers': {
-        '__main__': {
+        # Holds the handlers the writer thread passes the queued records to
+        'log_writer': {
             'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
             'level': 'DEBUG',
+            'propagate': False
+        },
+        '__main__': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
         },
         'tradingbot': {
-            'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
         'exchange': {
-            'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'market_cache': {
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
         'market': {
-            'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
         'strategies': {
-            'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
         'order': {
-            'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
-        'transitions': {
-            'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
+        'order_store': {
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
+        'balance_tracker': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'config_watcher': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'tape': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'async_engine': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'scheduler': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'session_store': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'rate_limiter': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'metrics': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'supervisor': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'profiler': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'utils': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'feeds': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        'ws_mock_server': {
+            'handlers': ['queue'],
+            'level': 'DEBUG',
+        },
+        # transitions traces every trigger and condition at DEBUG, only its state changes are worth logging
+        'transitions': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+        },
         'ccxt': {
-            'handlers': ['debug_log', 'info_log', 'error_log', 'log_console'],
+            'handlers': ['queue'],
             'level': 'INFO',
         }
     }
 }
 logging.config.dictConfig(LOGGING_CONFIG)
+WRITER_HANDLERS = logging.getLogger('log_writer').handlers
+log_listener = BatchingQueueListener(LOG_QUEUE, *WRITER_HANDLERS, respect_handler_level=True)
+log_listener.start()
+# Writes out what's still queued when the bot exits
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+
+def log_to_queue(log_queue):
+    """ Sends the log records of this process to log_queue instead of writing them itself, e.g. to the
+    multiprocessing queue of a supervisor writing the log files for all its worker processes. """
+    log_listener.stop()
+    atexit.unregister(log_listener.stop)
+    for name in LOGGING_CONFIG['loggers']:
+        for handler in logging.getLogger(name).handlers:
+            if isinstance(handler, LazyQueueHandler):
+                handler.queue = log_queue
+
+
+def listen_to_queue(log_queue):
+    """ Writes the records other processes put on log_queue with the log files and console of this process. """
+    listener = BatchingQueueListener(log_queue, *WRITER_HANDLERS, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -1,7 +1,9 @@
-from collections import deque
+import threading
 from ccxt.base.errors import NetworkError
 from utils import retry, RetrySettings
 from strategies import Strategy
+from feeds import MarketDataFeed
+from history import History
 
 import logging_setup
 logger = logging_setup.logging.getLogger(__name__)
@@ -16,14 +18,39 @@ class Market:
         self.id = self.market_data["id"]
         self.base = self.market_data["base"]
         self.quote = self.market_data["quote"]
-        self.prices = market_settings.get("prices", deque([], maxlen=500))
-        self.balances = market_settings.get("balances", deque([], maxlen=100))
+        self.price_history_size = market_settings.get("price_history_size", 10000)
+        self.balance_history_size = market_settings.get("balance_history_size", 1000)
+        self.prices = History.load(market_settings.get("prices"), self.price_history_size)
+        self.balances = History.load(market_settings.get("balances"), self.balance_history_size)
+        self.prices_added = 0               # Number of prices appended since startup, used to persist only new ones
+        self.balances_added = 0
+        self.serialized_added = {}          # prices_added and balances_added as of the last serialize
+        self.balance_deltas = {}            # Currency -> changes of the base and quote balance not dispatched yet
+        self.balance_dispatched = False
         self.active = market_settings.get("active", True)
+        self.open_orders = None             # Snapshot of the open orders on the exchange, None when outdated
+        self.open_orders_by_id = {}
+        self.orders_outdated = True         # Whether the order store has to catch up with the fills of this market
+        self.bid = None
+        self.ask = None
+        # Streaming feeds deliver data from their own thread, the lock keeps the events of a market in order
+        self.lock = threading.RLock()
+        self.feed = MarketDataFeed.set_feed(market_settings.get("feed", {}))
         self.strategies = self.set_strategies()
 
+    def add_balance_delta(self, currency, delta):
+        """ Called by the balance tracker of the exchange when the balance of the base or quote changed. """
+        with self.lock:
+            deltas = self.balance_deltas.setdefault(currency, dict.fromkeys(delta, 0))
+            for field, value in delta.items():
+                deltas[field] += value
 
     def update_balance(self):
-        return self.exchange.balance.get(self.base, 0)
+        """ Adds the base balance to the history when it changed. """
+        if self.base in self.balance_deltas:
+            self.balances.add(self.exchange.balance_tracker.total(self.base))
+            self.balances_added += 1
+        return self.last_balance
 
     def set_strategies(self):
         if not self.strategies_settings:
@@ -49,42 +76,132 @@ class Market:
 
     @retry(NetworkError, tries=RetrySettings.tries, delay=RetrySettings.delay, backoff=RetrySettings.backoff, on_fail=deactivate)
     def update_ticker(self):
-        price = self.exchange.fetch_ticker(self.symbol)["last"]
-        self.prices.append(price)
-        logger.debug(f"Updated ticker: {self.symbol}, {self.exchange.id}, last price: {self.last_price:.8f}")
+        self.add_price(self.exchange.fetch_ticker(self.symbol)["last"])
+
+    def add_price(self, price, timestamp=None, volume=0.0):
+        self.prices.add(price, timestamp, volume)
+        self.prices_added += 1
+        logger.debug("Updated ticker: %s, %s, last price: %.8f", self.symbol, self.exchange.id, price,
+                     extra={"sample": logging_setup.TICK_SAMPLE})
+
+    def on_market_data(self, price=None, bid=None, ask=None, volume=0.0):
+        """ Handles data pushed by a streaming feed and fires the price events right away. """
+        with self.lock:
+            if bid is not None:
+                self.bid, self.ask = bid, ask
+            if price is not None:
+                self.add_price(price, volume=volume)
+                self.dispatch_price_event()
 
     def price_changed(self):
         if len(self.prices) < 2:
             return True
         return self.prices[-2] != self.last_price
 
+    def on_balance_data(self):
+        """ Handles a balance change pushed by a stream and fires the balance events right away. """
+        with self.lock:
+            self.invalidate_open_orders()
+            self.update_balance()
+            self.dispatch_balance_event()
+
     def balance_changed(self):
-        if len(self.balances) < 2:
-            return True
-        return self.balances[-2] != self.last_balance
+        # The first balance event after startup catches up with whatever filled in the meantime
+        return bool(self.balance_deltas) or not self.balance_dispatched
+
+    def dispatch_balance_event(self):
+        if self.balance_changed():
+            self.balance_deltas = {}
+            self.balance_dispatched = True
+            for strategy in self.strategies.values():
+                strategy.balance_change_event()
+
+    def dispatch_price_event(self):
+        if self.price_changed():
+            for strategy in self.strategies.values():
+                strategy.price_change_event()
 
     def cancel_all_orders(self):
-        orders = self.exchange.fetch_open_orders(self.symbol)
-        for order in orders:
-            self.exchange.cancel_order(order["id"], self.symbol, {
-                "type": order["side"]})
+        """ Cancels every open order of this market with as few requests as the exchange allows.
+
+        Without cancelAllOrders or cancelOrders support the orders are canceled concurrently, raising the first
+        error once all of them are tried.
+        """
+        if self.exchange.has.get("cancelAllOrders"):
+            self.exchange.cancel_all_orders(self.symbol)
+            self.invalidate_open_orders()
+            return
+        orders = self.fetch_open_orders()
+        self.invalidate_open_orders()
+        if self.exchange.has.get("cancelOrders"):
+            for ids in self.exchange.order_batches([order["id"] for order in orders]):
+                self.exchange.cancel_orders(ids, self.symbol)
+            return
+        results = self.exchange.run_concurrently(
+            lambda order: self.exchange.cancel_order(order["id"], self.symbol, {"type": order["side"]}), orders)
+        for order, result in results:
+            if isinstance(result, Exception):
+                raise result
 
     def fetch_open_orders(self):
-        return self.exchange.fetch_open_orders(self.symbol)
-
-    def serialize(self):
-        strategies = {}
-        for strategy_name, strategy in self.strategies.items():
-            strategies[strategy_name] = strategy.serialize()
+        """ Returns the open orders of this market, only fetching them when the snapshot is outdated. """
+        if self.open_orders is None:
+            self.open_orders = self.exchange.fetch_open_orders(self.symbol)
+            self.open_orders_by_id = {order["id"]: order for order in self.open_orders}
+        return self.open_orders
+
+    def invalidate_open_orders(self):
+        """ Marks the open orders snapshot and the fills of the orders as outdated, e.g. at a new cycle or after
+        placing or canceling orders. """
+        self.open_orders = None
+        self.open_orders_by_id = {}
+        self.orders_outdated = True
+
+    def refresh_orders(self):
+        """ Brings the orders of this market up to date in the order store of the exchange, once until outdated. """
+        if self.orders_outdated:
+            # Also after a failure, the market is deactivated then
+            self.orders_outdated = False
+            self.fetch_fills()
+
+    @retry(NetworkError, on_fail=deactivate)
+    def fetch_fills(self):
+        self.exchange.order_store.refresh(self)
+
+    def order_is_open(self, order_id):
+        self.fetch_open_orders()
+        return order_id in self.open_orders_by_id
+
+    def serialize_settings(self):
+        """ Serializes the market's own settings, without its strategies and price and balance history. """
         market = {
-            "strategies": strategies,
-            "prices": self.prices,
-            "balances": self.balances,
-            "active": self.active
+            "active": self.active,
+            "feed": self.feed.serialize(),
+            "price_history_size": self.price_history_size,
+            "balance_history_size": self.balance_history_size
         }
         return market
 
+    def serialize(self, packed=False):
+        """ Serializes the market under its lock, as feeds add prices from their own threads.
+
+        :param packed: keep the histories as raw bytes (History.pack) for binary snapshots
+        """
+        with self.lock:
+            strategies = {}
+            for strategy_name, strategy in self.strategies.items():
+                strategies[strategy_name] = strategy.serialize()
+            market = {
+                "strategies": strategies,
+                "prices": self.prices.pack() if packed else self.prices.serialize(),
+                "balances": self.balances.pack() if packed else self.balances.serialize()
+            }
+            market.update(self.serialize_settings())
+            self.serialized_added = {"prices": self.prices_added, "balances": self.balances_added}
+        return market
+
     def __str__(self):
         strategies = "\n  ".join([str(strategy) for strategy in self.strategies])
-        return f"{self.__class__.__name__}: {self.symbol}, {self.last_price:.8f}, active: {self.active}\n" \
+        last_price = f"{self.last_price:.8f}" if self.last_price is not None else "no price yet"
+        return f"{self.__class__.__name__}: {self.symbol}, {last_price}, active: {self.active}\n" \
                f"{strategies}"
\ No newline at end of file
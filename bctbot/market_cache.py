@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import time
+
+import ccxt
+
+from utils import atomic_write
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+
+class MarketCache:
+    """ Keeps the market metadata of an exchange on disk, so a restart doesn't have to download it again.
+
+    A cached entry is only used when it was written by the same ccxt version, its checksum matches and it holds
+    all the symbols asked for. Entries older than ttl seconds are still used, but reported as stale so the
+    exchange can refresh them in the background.
+    """
+
+    def __init__(self, exchange_name, folder="market_cache", ttl=24 * 60 * 60):
+        self.exchange_name = exchange_name
+        self.folder = folder
+        self.ttl = ttl
+        self.file_path = os.path.join(folder, f"{exchange_name}.markets.json")
+
+    @staticmethod
+    def digest(markets, currencies):
+        data = json.dumps([markets, currencies], sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha1(data).hexdigest()
+
+    def load(self, symbols):
+        """ :return: (markets, currencies, stale), or None if there is no valid cache for these symbols """
+        try:
+            with open(self.file_path, encoding="utf-8") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable market cache {self.file_path}: {e!r}")
+            return None
+        markets, currencies = cache.get("markets", {}), cache.get("currencies", {})
+        if cache.get("ccxt_version") != ccxt.__version__:
+            logger.info(f"Ignoring market cache {self.file_path} of ccxt {cache.get('ccxt_version')}")
+            return None
+        if cache.get("sha1") != self.digest(markets, currencies):
+            logger.warning(f"Ignoring corrupt market cache {self.file_path}")
+            return None
+        missing = [symbol for symbol in symbols if symbol not in markets]
+        if missing:
+            logger.info(f"Market cache {self.file_path} lacks {missing}")
+            return None
+        stale = time.time() - cache.get("saved", 0) > self.ttl
+        return markets, currencies, stale
+
+    def save(self, markets, currencies):
+        os.makedirs(self.folder, exist_ok=True)
+        cache = {
+            "exchange": self.exchange_name,
+            "ccxt_version": ccxt.__version__,
+            "saved": time.time(),
+            "sha1": self.digest(markets, currencies),
+            "markets": markets,
+            "currencies": currencies
+        }
+        atomic_write(self.file_path, json.dumps(cache, default=str))
+        logger.debug(f"Cached {len(markets)} markets of {self.exchange_name} in {self.file_path}")
@@ -0,0 +1,221 @@
+""" Counters and latency histograms of the bot, in the Prometheus text format.
+
+Everything is recorded in the module-wide METRICS registry:
+    bctbot_cycles_total, bctbot_cycle_seconds                   cycles and their duration
+    bctbot_cycle_phase_seconds{phase}                           time per phase of a cycle, see PhaseTimer
+    bctbot_api_request_seconds{exchange, endpoint}              latency of every ccxt call
+    bctbot_api_errors_total{exchange, endpoint, error}          ccxt calls that raised
+    bctbot_rate_limit_wait_seconds{exchange, endpoint}          time spent waiting for the rate limiter
+    bctbot_retries_total{exchange, function}                    retries of the retry decorators
+    bctbot_state_transitions_total{exchange, market, strategy, state}
+
+Serve them to Prometheus with serve(port), or write them to a file on SIGUSR1 with install_dump_signal(path).
+"""
+import bisect
+import copy
+import http.server
+import os
+import signal
+import threading
+import time
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HELP = {
+    "bctbot_cycles_total": "Cycles of the trading loop",
+    "bctbot_cycle_seconds": "Duration of a cycle of the trading loop, without sleeping",
+    "bctbot_cycle_phase_seconds": "Time spent per phase of a cycle of the trading loop",
+    "bctbot_api_request_seconds": "Latency of the ccxt calls per exchange and endpoint",
+    "bctbot_api_errors_total": "ccxt calls that raised, per exchange, endpoint and error",
+    "bctbot_rate_limit_wait_seconds": "Time ccxt calls waited for the rate limiter of their exchange",
+    "bctbot_retries_total": "Retries after a failed call, per exchange and function",
+    "bctbot_state_transitions_total": "State changes of the strategies, per state entered"
+}
+
+
+class Histogram:
+    """ Observation counts per bucket upper bound, plus their count and sum. """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # The last one counts the observations above all buckets
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+
+def format_labels(labels, **extra):
+    labels = labels + tuple(extra.items())
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    """ Registry of counters, gauges and histograms, each kept per combination of label values. """
+
+    def __init__(self):
+        self.counters = {}          # name -> {labels: value}
+        self.gauges = {}            # name -> {labels: value}
+        self.histograms = {}        # name -> {labels: Histogram}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counters = self.counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histograms = self.histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        """ :return: all metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for name, counters in sorted(self.counters.items()):
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} counter"]
+                lines += [f"{name}{format_labels(labels)} {value}" for labels, value in sorted(counters.items())]
+            for name, gauges in sorted(self.gauges.items()):
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} gauge"]
+                lines += [f"{name}{format_labels(labels)} {value}" for labels, value in sorted(gauges.items())]
+            for name, histograms in sorted(self.histograms.items()):
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} histogram"]
+                for labels, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, file_path):
+        folder = os.path.dirname(file_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        logger.info(f"Dumped the metrics to {file_path}")
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """ Copy of all metrics, e.g. to send them to another process. """
+        with self.lock:
+            return copy.deepcopy({"counters": self.counters, "gauges": self.gauges, "histograms": self.histograms})
+
+    def merge(self, snapshot, **labels):
+        """ Adds the metrics of a snapshot, with labels added to all of them. """
+        extra = tuple(labels.items())
+        with self.lock:
+            for kind in ("counters", "gauges"):
+                for name, values in snapshot[kind].items():
+                    metrics = getattr(self, kind).setdefault(name, {})
+                    for key, value in values.items():
+                        key = tuple(sorted(key + extra))
+                        metrics[key] = metrics.get(key, 0) + value if kind == "counters" else value
+            for name, histograms in snapshot["histograms"].items():
+                metrics = self.histograms.setdefault(name, {})
+                for key, histogram in histograms.items():
+                    key = tuple(sorted(key + extra))
+                    if key not in metrics:
+                        metrics[key] = Histogram(histogram.buckets)
+                    metrics[key].merge(histogram)
+
+    def replace(self, other):
+        """ Takes over all metrics of another registry at once, so a render never sees half of them. """
+        with self.lock:
+            self.counters, self.gauges, self.histograms = other.counters, other.gauges, other.histograms
+
+
+METRICS = Metrics()
+
+
+class PhaseTimer:
+    """ Stopwatch splitting a cycle into phases: every call to phase() ends the running phase and starts the next.
+
+    The time of every phase, summed over the cycle, is recorded by stop().
+    """
+
+    def __init__(self, metrics=METRICS):
+        self.metrics = metrics
+        self.start = self.lap = time.perf_counter()
+        self.current = None
+        self.times = {}
+
+    def phase(self, name):
+        now = time.perf_counter()
+        if self.current is not None:
+            self.times[self.current] = self.times.get(self.current, 0) + now - self.lap
+        self.current, self.lap = name, now
+
+    def stop(self):
+        self.phase(None)
+        for name, seconds in self.times.items():
+            self.metrics.observe("bctbot_cycle_phase_seconds", seconds, phase=name)
+        self.metrics.observe("bctbot_cycle_seconds", self.lap - self.start)
+        self.metrics.inc("bctbot_cycles_total")
+        return self.times
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = METRICS.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """ Serves the metrics on http://host:port/metrics from a background thread. """
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def install_dump_signal(file_path):
+    """ Dumps the metrics to file_path whenever the process receives SIGUSR1 (not available on Windows). """
+    if not hasattr(signal, "SIGUSR1"):
+        logger.warning("SIGUSR1 isn't available on this platform, metrics can't be dumped on a signal")
+        return
+    # The handler interrupts the main thread wherever it is, possibly holding the metrics or logging locks, so the
+    # dump runs on a thread of its own
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=METRICS.dump, args=(file_path,),
+                                                                         name="metrics dump").start())
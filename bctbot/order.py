@@ -1,13 +1,31 @@
-from ccxt.base.errors import NetworkError, DDoSProtection, ExchangeNotAvailable, InvalidNonce, InvalidOrder, RequestTimeout, OrderNotFound
+from ccxt.base.errors import NetworkError, DDoSProtection, ExchangeError, ExchangeNotAvailable, InvalidNonce, InvalidOrder, \
+    NotSupported, RequestTimeout, OrderNotFound
 
 from utils import retry, RetrySettings
 
 import logging_setup
 logger = logging_setup.logging.getLogger(__name__)
 
+def group_by(items, key):
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
+
+
 class Order():
+    # Strategies of grids keep thousands of orders, without a __dict__ each takes about half the memory
+    __slots__ = ("exchange", "market", "side", "type", "price", "_amount", "_cost", "initial_cost", "internal_id",
+                 "_id", "_status", "timestamp", "filled", "filled_cost", "fees", "settled_amount", "settled_cost",
+                 "table")
+    # Serialized in this order, as the __dict__ of orders was before
+    FIELDS = ("side", "type", "price", "cost", "initial_cost", "internal_id", "id", "status", "timestamp", "filled",
+              "filled_cost", "fees", "settled_amount", "settled_cost")
 
-    def __init__(self, exchange, market, side, type, price, amount=0, cost=0, initial_cost=None, internal_id=None, id=None, status="potential"):
+    def __init__(self, exchange, market, side, type, price, amount=0, cost=0, initial_cost=None, internal_id=None, id=None,
+                 status="potential", timestamp=None, filled=0, filled_cost=0, fees=None, settled_amount=0,
+                 settled_cost=0):
+        self.table = None                   # OrderTable of the strategy holding the order, if any
         self.exchange = exchange            # Exchange object
         self.market = market                # Market object
         self.side = side                    # "buy" or "sell"
@@ -19,9 +37,37 @@ class Order():
         self.internal_id = internal_id      # id used by the trading bot
         self.id = id                        # id given from exchange
         self.status = status                # status: ('potential', 'open', 'filled', 'canceled')
+        self.timestamp = timestamp          # time the exchange created the order, in ms
+        # Fills as reported by the exchange, and the part of them the strategy has accounted for
+        self.filled = filled
+        self.filled_cost = filled_cost
+        self.fees = {} if fees is None else fees
+        self.settled_amount = settled_amount
+        self.settled_cost = settled_cost
 
         # self.last_response = {}
-        logger.debug(f"Initializing an order: {self}")
+        if self.status == "open" and self.id is not None:
+            self.track()
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        if self.table is not None:
+            self.table.status_changed(self, value)
+        self._status = value
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        if self.table is not None:
+            self.table.id_changed(self, value)
+        self._id = value
 
     @property
     def amount(self):
@@ -60,11 +106,7 @@ class Order():
         try:
             response = self.exchange.create_order(self.market.symbol, self.type, self.side, self.amount, self.price)
             # self.last_response = response
-            # Update this Orders' instance attributes with the updated attributes from the response
-            self.amount = response["amount"]
-            self.id = response["id"]
-            self.status = response["status"]            # 'open' if successful
-            logger.info(f"Placed order: {self}")
+            self.on_placed(response)
         except InvalidOrder as e:
             if self.amount == 0:
                 logger.error(f"Amount can't be 0. {self}")
@@ -79,40 +121,188 @@ class Order():
     def cancel_order(self):
         try:
             response = self.exchange.cancel_order(self.id, self.market.symbol, {"type": self.side})
+            self.market.invalidate_open_orders()
         except OrderNotFound as e:
             # Check first if the order is not filled by checking change in balance
             logging_setup.logging.exception(str(e))
             self.status = "canceled"
+            self.exchange.order_store.forget(self.id)
+            self.market.invalidate_open_orders()
+        else:
+            self.on_canceled(response)
+
+    def order_request(self):
+        """ The order as an entry of a create_orders batch. """
+        return {"symbol": self.market.symbol, "type": self.type, "side": self.side, "amount": self.amount,
+                "price": self.price}
+
+    def on_placed(self, response):
+        # Update this Orders' instance attributes with the updated attributes from the response
+        self.exchange.order_store.forget(self.id)
+        self.amount = response["amount"]
+        self.id = response["id"]
+        # Orders filled right away stay open to the bot until their fills are taken from the order store
+        self.status = "open" if response.get("status") in (None, "open", "closed") else response["status"]
+        self.timestamp = response.get("timestamp")
+        self.filled = self.filled_cost = self.settled_amount = self.settled_cost = 0
+        self.fees = {}
+        self.track()
+        self.market.invalidate_open_orders()
+        logger.info(f"Placed order: {self}")
+
+    def track(self):
+        self.exchange.order_store.track(self.id, self.market.symbol, self.side, self.amount, self.price,
+                                        self.timestamp)
+
+    def on_canceled(self, response):
+        """ :return: whether the response confirms the order is canceled """
+        # Unified ccxt responses raise on failure instead of reporting it
+        success = True
+        # kucoin: response["success"]
+        if "success" in response.keys():
+            success = response["success"]
+        # cryptopia: response["info"]["Success"]
+        elif "info" in response.keys() and isinstance(response["info"], dict) and "Success" in response["info"].keys():
+            success = response["info"]["Success"]
+
+        if success:
+            self.status = "canceled"
+            self.exchange.order_store.forget(self.id)
+            logger.info(f"Order canceled: {self}")
         else:
-            # kucoin: response["success"]
-            if "success" in response.keys():
-                success = response["success"]
-            # cryptopia: response["info"]["Success"]
-            elif "info" in response.keys() and "Success" in response["info"].keys():
-                success = response["info"]["Success"]
-
-            if success:
-                self.status = "canceled"
-                logger.info(f"Order canceled: {self}")
+            logger.info(f"Something went wrong canceling order: {self}")
+        return success
+
+    @staticmethod
+    def place_orders(orders):
+        """ Places orders at once instead of one round trip after the other.
+
+        Orders go out in create_orders batches on exchanges that support them, and are sent concurrently within
+        the rate limit on other exchanges. Every order is updated with its own result.
+
+        :return: list of (order, error), with error None for the orders that were placed
+        """
+        results = []
+        for exchange, orders in group_by(orders, lambda order: order.exchange).items():
+            if exchange.has.get("createOrders"):
+                for batch in exchange.order_batches(orders):
+                    results.extend(Order.place_batch(exchange, batch))
             else:
-                logger.info(f"Something went wrong canceling order: {self}")
+                results.extend(Order.run_concurrently(exchange, Order.place_order, orders))
+        for order, error in results:
+            if error is not None:
+                logger.error(f"Placing order failed: {order}: {error!r}")
+        return results
 
-    def order_filled(self):
-        if self.status in ["potential", "filled", "canceled"]:
-            return False
-        elif self.status == "open" and self.order_in_open_orders():
-            return False
-        self.status = "filled"
-        return True
+    @staticmethod
+    def place_batch(exchange, orders):
+        try:
+            responses = exchange.create_orders_batch([order.order_request() for order in orders])
+        except NotSupported:
+            return Order.run_concurrently(exchange, Order.place_order, orders)
+        except RequestTimeout:
+            # The orders may or may not have been created, like for a single order this needs a look at the exchange
+            error = RetrySettings.PersistentErrorAfterRetries("Just handle the RequestTimeout for create_orders manually...")
+            return [(order, error) for order in orders]
+        except Exception as e:
+            return [(order, e) for order in orders]
+        results = []
+        for order, response in zip(orders, responses):
+            # Orders of a batch are rejected one by one, in place of raising the error of a single create_order
+            if not response or response.get("id") is None or response.get("status") == "rejected":
+                info = response.get("info") if response else None
+                results.append((order, InvalidOrder(f"{exchange.id} rejected the order: {info}")))
+                continue
+            order.on_placed(response)
+            results.append((order, None))
+        return results
+
+    @staticmethod
+    def cancel_orders(orders):
+        """ Cancels orders at once, in cancel_orders batches per market where the exchange supports them and
+        concurrently otherwise.
+
+        Orders a batch response doesn't mention are looked up in the open orders: those no longer open are canceled.
+
+        :return: list of (order, error), with error None for the orders that were canceled
+        """
+        results = []
+        for market, orders in group_by(orders, lambda order: order.market).items():
+            exchange = market.exchange
+            if exchange.has.get("cancelOrders"):
+                for batch in exchange.order_batches(orders):
+                    results.extend(Order.cancel_batch(exchange, market, batch))
+            else:
+                results.extend(Order.run_concurrently(exchange, Order.cancel_order, orders))
+        results = [(order, ExchangeError(f"{order.exchange.id} didn't cancel the order"))
+                   if error is None and order.status != "canceled" else (order, error) for order, error in results]
+        for order, error in results:
+            if error is not None:
+                logger.error(f"Canceling order failed: {order}: {error!r}")
+        return results
+
+    @staticmethod
+    def cancel_batch(exchange, market, orders):
+        try:
+            responses = exchange.cancel_orders_batch([order.id for order in orders], market.symbol)
+        except NotSupported:
+            return Order.run_concurrently(exchange, Order.cancel_order, orders)
+        except ExchangeError as e:
+            # Some of the orders may be filled or canceled already, the open orders tell which are left
+            logger.warning(f"Canceling a batch of orders on {exchange.id} failed: {e!r}")
+            responses = []
+        except Exception as e:
+            return [(order, e) for order in orders]
+        canceled = {response.get("id"): response for response in responses or [] if isinstance(response, dict)}
+        results = []
+        market.invalidate_open_orders()
+        for order in orders:
+            try:
+                if order.id in canceled:
+                    order.on_canceled(canceled[order.id])
+                elif not market.order_is_open(order.id):
+                    order.status = "canceled"
+                    exchange.order_store.forget(order.id)
+                    logger.info(f"Order canceled: {order}")
+                results.append((order, None))
+            except Exception as e:
+                results.append((order, e))
+        return results
 
-    @retry(NetworkError, on_fail=deactivate_market)
-    def order_in_open_orders(self):
-        response = self.exchange.fetch_open_orders(self.market.symbol)
-        logger.info(response)
-        for order in response:
-            if order["id"] == self.id:
-                return True
-        return False
+    @staticmethod
+    def run_concurrently(exchange, method, orders):
+        return [(order, result if isinstance(result, Exception) else None)
+                for order, result in exchange.run_concurrently(method, orders)]
+
+    def take_fills(self):
+        """ Updates the status and fills of an open order from the order store, which catches up with the exchange
+        once per cycle.
+
+        :return: (amount, cost) filled since the last call, the amount of buy orders net of fees paid in the base
+            currency
+        """
+        if self.status != "open":
+            return 0, 0
+        self.market.refresh_orders()
+        state = self.exchange.order_store.get(self.id)
+        if state is None:
+            return 0, 0
+        self.filled, self.filled_cost, self.fees = state.filled, state.cost, dict(state.fees)
+        if state.status == "closed":
+            self.status = "filled"
+        elif state.status in ("canceled", "expired", "rejected"):
+            self.status = "canceled"
+            logger.info(f"Order {state.status} on the exchange: {self}")
+        if self.status != "open":
+            self.exchange.order_store.forget(self.id)
+        amount = self.filled - (self.fees.get(self.market.base, 0) if self.side == "buy" else 0)
+        new_amount, new_cost = amount - self.settled_amount, self.filled_cost - self.settled_cost
+        self.settled_amount, self.settled_cost = amount, self.filled_cost
+        return new_amount, new_cost
+
+    @property
+    def average(self):
+        return self.filled_cost / self.filled if self.filled else None
 
     # Used before placing an order?
     def order_valid(self):
@@ -126,18 +316,9 @@ class Order():
         return True
 
     def serialize(self):
-        order = {}
-        for k, v in self.__dict__.items():
-            if k == "_amount":
-                continue
-            elif k == "exchange":
-                v = v.id
-            elif k == "market":
-                v = v.symbol
-            elif k == "_cost":
-                k = "cost"
-                v = self.cost
-            order[k] = v
+        order = {"exchange": self.exchange.id, "market": self.market.symbol}
+        for field in self.FIELDS:
+            order[field] = getattr(self, field)
         return order
 
     def __str__(self):
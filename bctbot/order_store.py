@@ -0,0 +1,170 @@
+""" Local state of the orders the bot placed, kept up to date with the fills the exchange reports.
+
+Every order the bot places is tracked by its exchange order id with its status, filled amount, cost and fees.
+Per market, the store catches up with the cheapest source the exchange has:
+    trades       fetch_my_trades since the last trade seen, so only new fills are downloaded
+    orders       fetch_orders since the oldest open order, which reports canceled and expired orders as well
+    open_orders  orders that are no longer open are looked up with fetch_order, or taken as filled without it
+A market without open tracked orders costs no request at all.
+
+Trades don't tell when the exchange cancels or expires an order. The trades source compares the tracked orders
+with the open orders snapshot the market shares (Market.fetch_open_orders): an order that left it without trades
+closing it is looked up with fetch_order, or taken as canceled without it. So only orders that changed cost a
+request of their own.
+"""
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+SOURCES = ("trades", "orders", "open_orders")
+
+
+def add_fee(fees, fee):
+    if fee and fee.get("cost"):
+        fees[fee["currency"]] = fees.get(fee["currency"], 0) + fee["cost"]
+
+
+class OrderState:
+    """ What the exchange reported about an order, built up from scratch from its trades or order structure. """
+
+    def __init__(self, id, symbol, side, amount, price, timestamp=None):
+        self.id = id
+        self.symbol = symbol
+        self.side = side
+        self.amount = amount
+        self.price = price
+        self.timestamp = timestamp      # Creation time on the exchange in ms, None if unknown
+        self.status = "open"
+        self.filled = 0.0
+        self.cost = 0.0
+        self.fees = {}                  # Currency -> fees paid
+        self.trade_ids = set()
+
+    @property
+    def average(self):
+        return self.cost / self.filled if self.filled else None
+
+    def add_trade(self, trade):
+        # Trades are fetched since the timestamp of the last one, which comes back every time
+        if trade["id"] in self.trade_ids:
+            return
+        self.trade_ids.add(trade["id"])
+        self.filled += trade["amount"]
+        self.cost += trade["cost"] if trade.get("cost") is not None else trade["amount"] * trade["price"]
+        add_fee(self.fees, trade.get("fee"))
+        if self.filled >= self.amount * (1 - 1e-9):
+            self.status = "closed"
+
+    def update(self, order):
+        """ Takes over a ccxt order structure, e.g. from fetch_orders or fetch_order. """
+        self.status = order.get("status") or self.status
+        if order.get("filled") is not None:
+            self.filled = order["filled"]
+        if order.get("cost") is not None:
+            self.cost = order["cost"]
+        elif order.get("average") is not None:
+            self.cost = self.filled * order["average"]
+        fees = {}
+        for fee in order.get("fees") or [order.get("fee")]:
+            add_fee(fees, fee)
+        self.fees = fees
+
+    def assume_filled(self):
+        self.status = "closed"
+        self.filled = self.amount
+        self.cost = self.amount * self.price
+
+
+class OrderStore:
+    """ Tracked orders of an exchange, keyed by exchange order id. """
+
+    def __init__(self, exchange, source=None, trades_per_request=None):
+        self.exchange = exchange
+        self.source = source or self.default_source()
+        if self.source not in SOURCES:
+            raise ValueError(f"Unknown fill source {self.source}, use one of {SOURCES}")
+        self.trades_per_request = trades_per_request
+        self.orders = {}
+        self.symbols = {}               # Symbol -> {id: OrderState} of its tracked orders
+        self.cursors = {}               # Symbol -> timestamp of the last trade seen
+        self.version = 0                # Counts the orders tracked and forgotten, e.g. to tell the balance may differ
+
+    def default_source(self):
+        if self.exchange.has.get("fetchMyTrades"):
+            return "trades"
+        if self.exchange.has.get("fetchOrders"):
+            return "orders"
+        return "open_orders"
+
+    def track(self, id, symbol, side, amount, price, timestamp=None):
+        """ Starts tracking an order, an order tracked already keeps the fills seen so far. """
+        if id in self.orders:
+            return
+        self.version += 1
+        self.orders[id] = self.symbols.setdefault(symbol, {})[id] = OrderState(id, symbol, side, amount, price,
+                                                                                 timestamp)
+
+    def forget(self, id):
+        state = self.orders.pop(id, None)
+        if state is not None:
+            del self.symbols[state.symbol][id]
+            self.version += 1
+
+    def get(self, id):
+        return self.orders.get(id)
+
+    def refresh(self, market):
+        """ Catches up with the fills of the open tracked orders of a market. """
+        states = [state for state in self.symbols.get(market.symbol, {}).values() if state.status == "open"]
+        if not states:
+            return
+        getattr(self, f"refresh_from_{self.source}")(market, states)
+
+    @staticmethod
+    def oldest(states):
+        """ Creation time of the oldest of states, None if any of them is unknown. """
+        timestamps = [state.timestamp for state in states]
+        return None if None in timestamps else min(timestamps)
+
+    def refresh_from_trades(self, market, states):
+        symbol = market.symbol
+        # Taken before the trades, so the trades of an order that closed before the snapshot are among them
+        market.fetch_open_orders()
+        since = self.cursors.get(symbol, self.oldest(states))
+        while True:
+            trades = self.exchange.fetch_my_trades(symbol, since, self.trades_per_request)
+            previous = since
+            for trade in trades:
+                state = self.orders.get(trade.get("order"))
+                if state is not None:
+                    state.add_trade(trade)
+                if trade.get("timestamp") is not None:
+                    since = trade["timestamp"] if since is None else max(since, trade["timestamp"])
+            # A full page means there may be more, unless all of it had the same timestamp
+            if not self.trades_per_request or len(trades) < self.trades_per_request or since == previous:
+                break
+        if since is not None:
+            self.cursors[symbol] = since
+        logger.debug("Fetched %s trades of %s on %s", len(trades), symbol, self.exchange.id)
+        for state in states:
+            if state.status != "open" or market.order_is_open(state.id):
+                continue
+            # Left the open orders without trades filling it
+            if self.exchange.has.get("fetchOrder"):
+                state.update(self.exchange.fetch_order(state.id, symbol))
+            else:
+                state.status = "canceled"
+
+    def refresh_from_orders(self, market, states):
+        for order in self.exchange.fetch_orders(market.symbol, self.oldest(states)):
+            state = self.orders.get(order["id"])
+            if state is not None:
+                state.update(order)
+
+    def refresh_from_open_orders(self, market, states):
+        for state in states:
+            if market.order_is_open(state.id):
+                continue
+            if self.exchange.has.get("fetchOrder"):
+                state.update(self.exchange.fetch_order(state.id, market.symbol))
+            else:
+                state.assume_filled()
@@ -0,0 +1,134 @@
+""" The orders of a strategy, with their prices, sides and statuses in columns.
+
+Strategies use the table like the dict of orders by internal id it replaces. Next to the Order objects it keeps a
+structured NumPy array with a row per order, so filtering a book of thousands of orders by side and status is a
+few array comparisons instead of a loop over the orders:
+    strategy.orders.prices(status="open")        # prices of the open orders
+    strategy.orders.select(side="sell", status="filled")
+Tables of fewer than VECTORIZE_FROM orders, like the few rungs of a ladder, are filtered with a loop, which costs
+less than the NumPy calls at that size.
+Orders are found by internal id and by exchange id in O(1). An order tells its table when its status or exchange
+id changes, so the columns and the index of exchange ids never go stale.
+"""
+from collections.abc import MutableMapping
+
+import numpy as np
+
+SIDES = {"buy": 0, "sell": 1}
+STATUSES = {"potential": 0, "open": 1, "filled": 2, "canceled": 3}
+OTHER_STATUS = len(STATUSES)        # Code of any other status, like "expired" or "rejected" from ccxt
+COLUMNS = [("price", "<f8"), ("side", "i1"), ("status", "i1")]
+VECTORIZE_FROM = 64
+
+
+def status_code(status):
+    return STATUSES.get(status, OTHER_STATUS)
+
+
+class OrderTable(MutableMapping):
+    """ Orders by internal id, in the order they were added. Deleting an order moves the last row into its place. """
+
+    def __init__(self, orders=None):
+        self.rows = []              # Orders, one per row of columns
+        self.positions = {}         # Internal id -> row
+        self.by_exchange_id = {}    # Exchange id -> order
+        self.columns = np.zeros(16, dtype=COLUMNS)
+        for internal_id, order in (orders or {}).items():
+            self[internal_id] = order
+
+    def __getitem__(self, internal_id):
+        return self.rows[self.positions[internal_id]]
+
+    def __setitem__(self, internal_id, order):
+        """ :raise ValueError: if internal_id isn't the internal id of order """
+        if internal_id != order.internal_id:
+            raise ValueError(f"Order {order.internal_id} can't be stored as {internal_id}")
+        if internal_id in self.positions:
+            del self[internal_id]
+        row = len(self.rows)
+        if row == len(self.columns):
+            self.columns = np.concatenate([self.columns, np.zeros(row, dtype=COLUMNS)])
+        self.columns[row] = (order.price, SIDES[order.side], status_code(order.status))
+        self.rows.append(order)
+        self.positions[internal_id] = row
+        if order.id is not None:
+            self.by_exchange_id[order.id] = order
+        order.table = self
+
+    def __delitem__(self, internal_id):
+        row = self.positions.pop(internal_id)
+        order = self.rows[row]
+        last = self.rows.pop()
+        if last is not order:
+            self.rows[row] = last
+            self.columns[row] = self.columns[len(self.rows)]
+            self.positions[last.internal_id] = row
+        if self.by_exchange_id.get(order.id) is order:
+            del self.by_exchange_id[order.id]
+        order.table = None
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, internal_id):
+        return internal_id in self.positions
+
+    def values(self):
+        rows = self.rows
+        return [rows[row] for row in self.positions.values()]
+
+    def items(self):
+        rows = self.rows
+        return [(internal_id, rows[row]) for internal_id, row in self.positions.items()]
+
+    def by_id(self, id):
+        """ :return: the order with exchange id id, or None """
+        return self.by_exchange_id.get(id)
+
+    def status_changed(self, order, status):
+        """ Called by an order before its status changes. """
+        self.columns["status"][self.positions[order.internal_id]] = status_code(status)
+
+    def id_changed(self, order, id):
+        """ Called by an order before its exchange id changes. """
+        if self.by_exchange_id.get(order.id) is order:
+            del self.by_exchange_id[order.id]
+        if id is not None:
+            self.by_exchange_id[id] = order
+
+    def mask(self, side=None, status=None):
+        columns = self.columns[:len(self.rows)]
+        mask = np.ones(len(columns), dtype=bool)
+        if side is not None:
+            mask &= columns["side"] == SIDES[side]
+        if status is not None:
+            code = status_code(status)
+            mask &= columns["status"] == code
+            if code == OTHER_STATUS:
+                # Other statuses share their code, the orders themselves tell them apart
+                rows = self.rows
+                for row in np.flatnonzero(mask).tolist():
+                    mask[row] = rows[row].status == status
+        return mask
+
+    def select(self, side=None, status=None):
+        """ :return: list of the orders of side and status, either None for any """
+        rows = self.rows
+        if len(rows) < VECTORIZE_FROM:
+            return [order for order in rows
+                    if (side is None or order.side == side) and (status is None or order.status == status)]
+        return [rows[row] for row in np.flatnonzero(self.mask(side, status)).tolist()]
+
+    def prices(self, side=None, status=None):
+        """ :return: list of the prices of the orders of side and status, either None for any """
+        if len(self.rows) < VECTORIZE_FROM:
+            return [order.price for order in self.select(side, status)]
+        return self.columns["price"][:len(self.rows)][self.mask(side, status)].tolist()
+
+    def count(self, side=None, status=None):
+        if len(self.rows) < VECTORIZE_FROM:
+            return len(self.select(side, status))
+        return int(np.count_nonzero(self.mask(side, status)))
@@ -0,0 +1,202 @@
+""" In-memory exchange that implements the parts of the ccxt unified API the bot uses, without any network.
+
+Prices are set from outside with set_price, e.g. by a backtest replaying historical data. Open limit orders
+fill completely as soon as the price reaches them: buy orders when the price is at or below their price,
+sell orders when it's at or above. Funds are reserved while an order is open and a fee in the quote
+currency is charged on fills. Every fill is a trade, available through fetch_my_trades.
+
+Register it in the Exchange factory with Exchange.register_backend("paper", PaperExchange) and configure it
+through its ccxt_config, e.g. {"symbols": ["ADB/ETH"], "initial_balance": {"ETH": 10}, "fee": 0.001}.
+"""
+import bisect
+import itertools
+
+import ccxt
+from ccxt.base.errors import ExchangeError, InsufficientFunds, InvalidOrder, OrderNotFound
+
+
+def paper_markets(symbols):
+    markets = {}
+    for symbol in symbols:
+        base, quote = symbol.split("/")
+        markets[symbol] = {"id": symbol.replace("/", "-"), "symbol": symbol, "base": base, "quote": quote,
+                           "active": True, "spot": True, "type": "spot", "precision": {}, "limits": {}}
+    return markets
+
+
+class PaperExchange(ccxt.Exchange):
+    id = "paper"
+    symbols_config = []
+    initial_balance = {}
+    fee = 0.001
+
+    def __init__(self, config={}):
+        config = dict(config)
+        # "symbols" is a ccxt attribute derived from the markets, so it's configured under another name here
+        self.symbols_config = config.pop("symbols", self.symbols_config)
+        super().__init__(config)
+        self.free = dict(self.initial_balance)
+        self.used = {}
+        self.prices = {}
+        self.orders = {}
+        # Open orders per symbol, sorted by price, so a price update only looks at the orders it crosses
+        self.open_buys = {}
+        self.open_sells = {}
+        self.order_ids = itertools.count(1)
+        self.trade_ids = itertools.count(1)
+        self.fills = []
+        self.trades = {}            # Symbol -> trades in order of their timestamp
+        self.trade_timestamps = {}  # Symbol -> timestamps of its trades, to find those since a timestamp
+        self.last_timestamp = 0
+
+    def describe(self):
+        return self.deep_extend(super().describe(), {"has": {"fetchTickers": True, "fetchOpenOrders": True, "createOrders": True,
+                                                             "cancelOrders": True, "cancelAllOrders": True,
+                                                             "fetchOrders": True, "fetchOrder": True,
+                                                             "fetchMyTrades": True}})
+
+    def now(self):
+        # Orders and trades are fetched since a timestamp, so their timestamps never go back
+        self.last_timestamp = max(self.last_timestamp, self.milliseconds())
+        return self.last_timestamp
+
+    def load_markets(self, reload=False, params={}):
+        self.set_markets(paper_markets(self.symbols_config))
+        return self.markets
+
+    def set_price(self, symbol, price, timestamp=None):
+        """ Updates the price of a symbol and fills the open orders it reaches.
+
+        :return: list of orders filled by this price update
+        """
+        self.prices[symbol] = price
+        filled = []
+        buys = self.open_buys.get(symbol, [])
+        # Buy orders fill when the price is at or below them: the highest prices are at the end
+        while buys and buys[-1][0] >= price:
+            filled.append(self.fill(buys.pop()[2], timestamp))
+        sells = self.open_sells.get(symbol, [])
+        while sells and sells[0][0] <= price:
+            filled.append(self.fill(sells.pop(0)[2], timestamp))
+        return filled
+
+    def fill(self, order, timestamp=None):
+        base, quote = order["symbol"].split("/")
+        cost = order["amount"] * order["price"]
+        # Fees are always paid in the quote currency, so the full amount bought can be sold again
+        if order["side"] == "buy":
+            self.used[quote] = self.used.get(quote, 0) - cost
+            self.free[base] = self.free.get(base, 0) + order["amount"]
+            self.free[quote] = self.free.get(quote, 0) - cost * self.fee
+        else:
+            self.used[base] = self.used.get(base, 0) - order["amount"]
+            self.free[quote] = self.free.get(quote, 0) + cost * (1 - self.fee)
+        order.update({"status": "closed", "filled": order["amount"], "remaining": 0, "cost": cost,
+                      "average": order["price"], "lastTradeTimestamp": timestamp,
+                      "fee": {"currency": quote, "cost": cost * self.fee}})
+        self.fills.append(order)
+        trade_timestamp = self.now()
+        self.trades.setdefault(order["symbol"], []).append({
+            "id": str(next(self.trade_ids)), "order": order["id"], "symbol": order["symbol"], "side": order["side"],
+            "type": order["type"], "price": order["price"], "amount": order["amount"], "cost": cost,
+            "fee": dict(order["fee"]), "timestamp": trade_timestamp})
+        self.trade_timestamps.setdefault(order["symbol"], []).append(trade_timestamp)
+        return order
+
+    def fetch_balance(self, params={}):
+        currencies = set(self.free) | set(self.used)
+        balance = {"free": {}, "used": {}, "total": {}}
+        for currency in currencies:
+            free, used = self.free.get(currency, 0), self.used.get(currency, 0)
+            balance[currency] = {"free": free, "used": used, "total": free + used}
+            balance["free"][currency], balance["used"][currency], balance["total"][currency] = free, used, free + used
+        return balance
+
+    def fetch_ticker(self, symbol, params={}):
+        return {"symbol": symbol, "last": self.prices.get(symbol)}
+
+    def fetch_tickers(self, symbols=None, params={}):
+        symbols = self.prices.keys() if symbols is None else symbols
+        return {symbol: self.fetch_ticker(symbol) for symbol in symbols if symbol in self.prices}
+
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        if type != "limit":
+            raise InvalidOrder(f"{self.id} only supports limit orders")
+        if amount <= 0 or price is None or price <= 0:
+            raise InvalidOrder(f"{self.id} order amount and price must be positive")
+        base, quote = symbol.split("/")
+        currency, reserved = (quote, amount * price) if side == "buy" else (base, amount)
+        if self.free.get(currency, 0) < reserved * (1 - 1e-9):
+            raise InsufficientFunds(f"{self.id} has {self.free.get(currency, 0)} {currency}, needs {reserved}")
+        self.free[currency] = self.free.get(currency, 0) - reserved
+        self.used[currency] = self.used.get(currency, 0) + reserved
+        order = {"id": str(next(self.order_ids)), "symbol": symbol, "type": type, "side": side, "price": price,
+                 "amount": amount, "filled": 0, "remaining": amount, "status": "open", "fee": None,
+                 "timestamp": self.now()}
+        self.orders[order["id"]] = order
+        book = self.open_buys if side == "buy" else self.open_sells
+        bisect.insort(book.setdefault(symbol, []), (price, int(order["id"]), order))
+        if symbol in self.prices:
+            self.set_price(symbol, self.prices[symbol])
+        return dict(order)
+
+    def cancel_order(self, id, symbol=None, params={}):
+        order = self.orders.get(id)
+        if order is None or order["status"] != "open":
+            raise OrderNotFound(f"{self.id} has no open order {id}")
+        book = self.open_buys if order["side"] == "buy" else self.open_sells
+        book[order["symbol"]].remove((order["price"], int(order["id"]), order))
+        base, quote = order["symbol"].split("/")
+        currency, reserved = (quote, order["amount"] * order["price"]) if order["side"] == "buy" \
+            else (base, order["amount"])
+        self.used[currency] -= reserved
+        self.free[currency] = self.free.get(currency, 0) + reserved
+        order["status"] = "canceled"
+        return dict(order)
+
+    # The batch methods call the single order methods of this class, so subclasses see a batch as one request
+    def create_orders(self, orders, params={}):
+        """ Creates every order it can, the others come back as rejected like on exchanges with batch orders. """
+        results = []
+        for order in orders:
+            try:
+                results.append(PaperExchange.create_order(self, order["symbol"], order["type"], order["side"],
+                                                          order["amount"], order.get("price")))
+            except ExchangeError as e:
+                results.append({"id": None, "status": "rejected", "info": str(e)})
+        return results
+
+    def cancel_orders(self, ids, symbol=None, params={}):
+        """ Cancels the orders that are open and skips the others, like cancel_order would raise for them. """
+        return [PaperExchange.cancel_order(self, id, symbol) for id in ids
+                if self.orders.get(id, {}).get("status") == "open"]
+
+    def cancel_all_orders(self, symbol=None, params={}):
+        ids = [order["id"] for order in PaperExchange.fetch_open_orders(self, symbol)]
+        return PaperExchange.cancel_orders(self, ids, symbol)
+
+    def fetch_open_orders(self, symbol=None, since=None, limit=None, params={}):
+        symbols = list(self.open_buys.keys() | self.open_sells.keys()) if symbol is None else [symbol]
+        return [dict(entry[2]) for symbol in symbols
+                for entry in self.open_buys.get(symbol, []) + self.open_sells.get(symbol, [])]
+
+    def fetch_order(self, id, symbol=None, params={}):
+        if id not in self.orders:
+            raise OrderNotFound(f"{self.id} has no order {id}")
+        return dict(self.orders[id])
+
+    def fetch_orders(self, symbol=None, since=None, limit=None, params={}):
+        orders = [dict(order) for order in self.orders.values() if (symbol is None or order["symbol"] == symbol)
+                  and (since is None or order["timestamp"] >= since)]
+        return orders[:limit] if limit else orders
+
+    def fetch_my_trades(self, symbol=None, since=None, limit=None, params={}):
+        if symbol is None:
+            trades = sorted((trade for trades in self.trades.values() for trade in trades),
+                            key=lambda trade: trade["timestamp"])
+            first = 0 if since is None else next((i for i, trade in enumerate(trades) if trade["timestamp"] >= since),
+                                                  len(trades))
+        else:
+            trades = self.trades.get(symbol, [])
+            first = 0 if since is None else bisect.bisect_left(self.trade_timestamps.get(symbol, []), since)
+        return [dict(trade) for trade in trades[first:first + limit if limit else None]]
@@ -0,0 +1,76 @@
+""" Sampling profiler for the trading loop, writing stacks for flame graphs.
+
+A background thread takes the call stack of the profiled thread at a fixed interval, which costs the profiled
+thread next to nothing. The samples are written in the collapsed format of flamegraph.pl, which speedscope
+and most other flame graph tools read as well: one line per distinct stack, frames from the outermost to the
+innermost separated by semicolons, followed by the number of samples:
+    run_bot.py:main;tradingbot.py:loop;exchange.py:get_balance 42
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+
+def frame_name(frame):
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+class SamplingProfiler:
+    """ Samples one thread, the one starting the profiler by default, for a number of cycles of the bot. """
+
+    def __init__(self, output, cycles, interval=0.005, thread_id=None):
+        self.output = output
+        self.cycles = cycles
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread_id = threading.get_ident() if self.thread_id is None else self.thread_id
+        self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.thread.start()
+        logger.info(f"Profiling the next {self.cycles} cycles into {self.output}")
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def cycle_done(self):
+        """ Counts down the cycles to profile, writing the samples after the last one.
+
+        :return: True when the profiler is done
+        """
+        self.cycles -= 1
+        if self.cycles > 0:
+            return False
+        self.stop()
+        self.write()
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self):
+        folder = os.path.dirname(self.output)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self.output, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Wrote {sum(self.samples.values())} profile samples to {self.output}")
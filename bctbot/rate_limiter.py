@@ -0,0 +1,121 @@
+""" Client-side rate limiting of all requests to an exchange, so the bot slows itself down before the exchange does.
+
+Every call of the ccxt unified API through Exchange.api_call takes tokens from a bucket shared by all threads
+calling that exchange. Calls that have to wait are served by priority lane first and in order of arrival within
+a lane, so placing and canceling orders doesn't queue up behind a burst of ticker polls.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+LANES = ("orders", "account", "market_data")        # Highest priority first
+ENDPOINT_LANES = {
+    "create_order": "orders",
+    "cancel_order": "orders",
+    "create_orders": "orders",
+    "cancel_orders": "orders",
+    "cancel_all_orders": "orders",
+    "fetch_balance": "account",
+    "fetch_open_orders": "account",
+    "fetch_orders": "account",
+    "fetch_order": "account",
+    "fetch_my_trades": "account",
+    "fetch_ticker": "market_data",
+    "fetch_tickers": "market_data",
+    "load_markets": "market_data"
+}
+
+
+class LaneMetrics:
+
+    def __init__(self):
+        self.queued = 0         # Requests waiting right now
+        self.requests = 0
+        self.waited = 0.0       # Total seconds waited
+        self.max_wait = 0.0
+
+    def record(self, waited):
+        self.requests += 1
+        self.waited += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def serialize(self):
+        return {"queued": self.queued,
+                "requests": self.requests,
+                "average_wait": self.waited / self.requests if self.requests else 0.0,
+                "max_wait": self.max_wait}
+
+
+class RateLimiter:
+    """ Weighted token bucket with priority lanes, shared by every request to an exchange.
+
+    The bucket holds at most burst tokens and refills at rate tokens per second. A request takes the weight
+    configured for its endpoint, 1 by default. Endpoints are in the lanes of ENDPOINT_LANES unless configured
+    otherwise; unknown endpoints go in the lowest lane.
+    """
+
+    def __init__(self, rate, burst=1, weights=None, lanes=None):
+        if rate <= 0 or burst <= 0:
+            raise ValueError(f"Rate and burst must be positive, got {rate} and {burst}")
+        self.rate = rate
+        self.burst = burst
+        self.weights = dict(weights or {})
+        self.lanes = dict(ENDPOINT_LANES, **(lanes or {}))
+        unknown = set(self.lanes.values()) - set(LANES)
+        if unknown:
+            raise ValueError(f"Unknown rate limiter lanes {unknown}, use {LANES}")
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+        self.waiting = []       # Heap of (lane priority, arrival number) of the requests waiting for tokens
+        self.arrivals = itertools.count()
+        self.lane_metrics = {lane: LaneMetrics() for lane in LANES}
+
+    def weight(self, endpoint):
+        # A request can never take more tokens than the bucket holds
+        return min(self.weights.get(endpoint, 1), self.burst)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, endpoint=None):
+        """ Blocks until the request to endpoint may go out, after the requests ahead of it.
+
+        :return: seconds waited
+        """
+        lane = self.lanes.get(endpoint, LANES[-1])
+        weight = self.weight(endpoint)
+        metrics = self.lane_metrics[lane]
+        start = time.monotonic()
+        with self.condition:
+            ticket = (LANES.index(lane), next(self.arrivals))
+            heapq.heappush(self.waiting, ticket)
+            metrics.queued += 1
+            while True:
+                self.refill(time.monotonic())
+                first = self.waiting[0] == ticket
+                if first and self.tokens >= weight:
+                    break
+                # Only the first in line knows how long to wait, the others wait until it's served
+                self.condition.wait((weight - self.tokens) / self.rate if first else None)
+            heapq.heappop(self.waiting)
+            self.tokens -= weight
+            metrics.queued -= 1
+            self.condition.notify_all()
+        waited = time.monotonic() - start
+        metrics.record(waited)
+        if waited > 1:
+            logger.debug(f"{endpoint} waited {waited:.2f}s for the rate limit")
+        return waited
+
+    def metrics(self):
+        """ Queue depth and wait times per lane, and the tokens left in the bucket. """
+        with self.condition:
+            self.refill(time.monotonic())
+            lanes = {lane: metrics.serialize() for lane, metrics in self.lane_metrics.items()}
+            return {"tokens": self.tokens, "lanes": lanes}
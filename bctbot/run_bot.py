@@ -1,6 +1,9 @@
 import sys
 import argparse
+import signal
 from tradingbot import TradingBot
+import metrics
+from supervisor import Supervisor
 
 import logging_setup as log_setup
 logger = log_setup.logging.getLogger(__name__)
@@ -9,17 +12,52 @@ logger = log_setup.logging.getLogger(__name__)
 def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", help="Specify a config file")
+    parser.add_argument("-m", "--mode", choices=["sync", "async"], default="sync",
+                        help="Poll exchanges one call at a time (sync) or concurrently (async)")
+    parser.add_argument("--snapshot-format", choices=["json", "msgpack"], default="json",
+                        help="Save the session into the config file (json) or into a binary <config>.snapshot file")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on localhost at this port")
+    parser.add_argument("--metrics-dump", default="log/metrics.prom",
+                        help="File to dump the metrics to when the bot receives SIGUSR1")
+    parser.add_argument("--profile", type=int, metavar="CYCLES", help="Profile this many cycles from the start")
+    parser.add_argument("--profile-output", default="log/profile.folded",
+                        help="File for the profile, in the collapsed stack format of flame graph tools")
+    parser.add_argument("--record-tapes", metavar="FOLDER",
+                        help="Record the calls to every exchange to FOLDER/<exchange>.tape, to replay them offline")
+    parser.add_argument("--supervisor", action="store_true",
+                        help="Run every exchange, or shard of an exchange's markets, in a worker process of its own")
+    parser.add_argument("--markets-per-shard", type=int,
+                        help="Split exchanges with more markets into several shards in supervisor mode")
+    parser.add_argument("--shards-folder", default="shards",
+                        help="Folder for the session files of the shards in supervisor mode")
     return parser.parse_args(args)
 
 
 def main():
     parser = parse_args(sys.argv[1:])
-    t = TradingBot()
     bot_config = parser.config if parser.config else "trading_bot_config.json"
     logger.info(f"Loding config from: {bot_config}")
+    metrics.install_dump_signal(parser.metrics_dump)
+    if parser.metrics_port:
+        metrics.serve(parser.metrics_port)
+    if parser.supervisor:
+        supervisor = Supervisor(bot_config, parser.shards_folder, parser.markets_per_shard, parser.mode,
+                                snapshot_format=parser.snapshot_format,
+                                profile=(parser.profile, parser.profile_output) if parser.profile else None,
+                                tapes_folder=parser.record_tapes)
+        signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+        supervisor.run()
+        return
+    t = TradingBot(snapshot_format=parser.snapshot_format)
     t.load_session(bot_config)
-    while t.active:
-        t.loop()
+    if parser.profile:
+        t.profile(parser.profile, parser.profile_output)
+    if parser.record_tapes:
+        t.record_tapes(parser.record_tapes)
+    try:
+        t.run(parser.mode)
+    finally:
+        t.stop_recording()
 
 
 if __name__ == "__main__":
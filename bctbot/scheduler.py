@@ -0,0 +1,156 @@
+import math
+import time
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+
+class MarketSchedule:
+
+    def __init__(self, market, interval, deadline):
+        self.market = market
+        self.interval = interval
+        self.deadline = deadline
+        self.polls = 0
+        self.missed_deadlines = 0
+        self.first_poll = None
+        self.last_poll = None
+
+    def poll_rate(self):
+        """ Effective number of polls per minute since the first poll. """
+        if self.polls < 2:
+            return 0
+        return (self.polls - 1) * 60 / (self.last_poll - self.first_poll)
+
+
+class RequestBudget:
+    """ Token bucket refilled at the rate the exchange's ccxt rateLimit allows (one request per rateLimit ms). """
+
+    def __init__(self, exchange, burst_seconds):
+        if exchange.rateLimit:
+            self.rate = 1000 / exchange.rateLimit
+            self.capacity = max(exchange.poll_cost(1), self.rate * burst_seconds)
+        else:
+            self.rate = self.capacity = math.inf
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Scheduler:
+    """ Decides which markets to poll when, instead of polling every market on a fixed cadence.
+
+    Every market has its own deadline. After each poll the next deadline is set by how close the price is
+    to a price one of its strategies acts on (see Strategy.watch_prices): min_interval when the price is within
+    near_distance (relative), max_interval when it's farther than far_distance and in between otherwise.
+    Markets without a price or strategy prices are polled every base_interval.
+
+    Polls are limited per exchange by a request budget drawn from ccxt's rateLimit. Markets that can't be
+    afforded stay due and are counted as missed deadlines once polled late.
+    """
+
+    def __init__(self, exchanges, base_interval=10, min_interval=2, max_interval=60,
+                 near_distance=0.01, far_distance=0.1):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.near_distance = near_distance
+        self.far_distance = far_distance
+        now = time.monotonic()
+        self.exchanges = exchanges
+        self.budgets = {}
+        self.schedules = {}
+        for exch_name, exchange in exchanges.items():
+            self.add_exchange(exch_name, exchange, now)
+
+    def add_exchange(self, exch_name, exchange, now=None):
+        """ Schedules the markets of an exchange, due right away. The exchange has to be in exchanges as well. """
+        now = time.monotonic() if now is None else now
+        self.budgets[exch_name] = RequestBudget(exchange, self.base_interval)
+        self.schedules[exch_name] = {symbol: MarketSchedule(market, self.base_interval, now)
+                                     for symbol, market in exchange.traded_markets.items()}
+
+    def remove_exchange(self, exch_name):
+        self.budgets.pop(exch_name, None)
+        self.schedules.pop(exch_name, None)
+
+    def add_market(self, exch_name, market, now=None):
+        now = time.monotonic() if now is None else now
+        self.schedules[exch_name][market.symbol] = MarketSchedule(market, self.base_interval, now)
+
+    def remove_market(self, exch_name, symbol):
+        self.schedules[exch_name].pop(symbol, None)
+
+    def due(self, now=None):
+        """ Returns the markets to poll now per exchange name, earliest deadline first, within budget. """
+        now = time.monotonic() if now is None else now
+        due = {}
+        for exch_name, exchange in self.exchanges.items():
+            schedules = sorted((schedule for schedule in self.schedules[exch_name].values() if schedule.deadline <= now),
+                               key=lambda schedule: schedule.deadline)
+            if not schedules:
+                continue
+            budget = self.budgets[exch_name]
+            budget.refill(now)
+            count = len(schedules)
+            while count and exchange.poll_cost(count) > budget.tokens:
+                count -= 1
+            if count < len(schedules):
+                logger.debug(f"Request budget of {exchange.id} only allows polling {count} of {len(schedules)} due markets")
+            if count:
+                budget.tokens -= exchange.poll_cost(count)
+                due[exch_name] = [schedule.market for schedule in schedules[:count]]
+        return due
+
+    def reschedule(self, exch_name, market, now=None):
+        """ Records a poll of the market and sets its next deadline. """
+        now = time.monotonic() if now is None else now
+        schedule = self.schedules[exch_name][market.symbol]
+        # Allow some slack for the time the cycle itself takes before calling a deadline missed
+        if now - schedule.deadline > max(1, schedule.interval * 0.1):
+            schedule.missed_deadlines += 1
+        schedule.polls += 1
+        schedule.first_poll = now if schedule.first_poll is None else schedule.first_poll
+        schedule.last_poll = now
+        schedule.interval = self.interval(market)
+        schedule.deadline = now + schedule.interval
+
+    def interval(self, market):
+        price = market.last_price
+        watch_prices = [p for strategy in market.strategies.values() for p in strategy.watch_prices() if p]
+        if not price or not watch_prices:
+            return self.base_interval
+        distance = min(abs(price - p) for p in watch_prices) / price
+        if distance <= self.near_distance:
+            return self.min_interval
+        if distance >= self.far_distance:
+            return self.max_interval
+        fraction = (distance - self.near_distance) / (self.far_distance - self.near_distance)
+        return self.min_interval + fraction * (self.max_interval - self.min_interval)
+
+    def time_until_next(self, now=None):
+        """ Seconds until the next market can be polled, by deadline and by request budget. """
+        now = time.monotonic() if now is None else now
+        waits = []
+        for exch_name, schedules in self.schedules.items():
+            if not schedules:
+                continue
+            wait = min(schedule.deadline for schedule in schedules.values()) - now
+            budget = self.budgets[exch_name]
+            budget.refill(now)
+            shortage = self.exchanges[exch_name].poll_cost(1) - budget.tokens
+            if shortage > 0:
+                wait = max(wait, shortage / budget.rate)
+            waits.append(wait)
+        return max(0, min(waits, default=self.base_interval))
+
+    def metrics(self):
+        """ Polling metrics per market, keyed by (exchange name, symbol). """
+        return {(exch_name, symbol): {"interval": schedule.interval,
+                                      "polls": schedule.polls,
+                                      "missed_deadlines": schedule.missed_deadlines,
+                                      "polls_per_minute": schedule.poll_rate()}
+                for exch_name, schedules in self.schedules.items() for symbol, schedule in schedules.items()}
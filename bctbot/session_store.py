@@ -0,0 +1,193 @@
+import hashlib
+import json as std_json
+import os
+
+from superjson import json
+
+import snapshot as binary_snapshot
+from history import History
+from utils import atomic_write
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+
+SNAPSHOT_FORMATS = ("json", "msgpack")
+
+
+class SessionStore:
+    """ Persists a TradingBot session as a snapshot plus an append-only journal of changes.
+
+    Every save only appends what changed since the previous save: new prices and balances of a market,
+    and the settings of exchanges, markets and strategies whose serialized form differs from what was
+    written last. After compact_every saves, or when no journal exists yet, the full session is written
+    as a new snapshot and the journal starts over.
+
+    The first journal line holds the hash of the snapshot it belongs to, so a journal left behind by a
+    crash during compaction is recognized as outdated instead of being replayed twice.
+
+    JSON snapshots replace the config file. msgpack snapshots (see snapshot.py) go to <config file>.snapshot
+    and leave the config file as it was written, they are a fraction of the size and much faster to write and
+    load. A binary snapshot, when there is one, is loaded instead of the config file.
+    """
+
+    def __init__(self, file_path, compact_every=360, snapshot_format="json"):
+        """ :raise ValueError: if snapshot_format isn't one of SNAPSHOT_FORMATS """
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f"Unknown snapshot format {snapshot_format}, use one of {SNAPSHOT_FORMATS}")
+        self.file_path = file_path
+        self.snapshot_path = file_path + ".snapshot"
+        self.journal_path = file_path + ".journal"
+        self.snapshot_format = snapshot_format
+        self.compact_every = compact_every
+        self.saves_since_compaction = 0
+        self.written = {}               # record key -> serialized record last written
+        self.history_written = {}       # (exchange, market, history) -> number of entries already written
+        self.bytes_written = 0
+        self.snapshot_digest = None     # sha1 of the snapshot last loaded or written
+        self.config = None              # Bytes of the config file the session is based on, kept in binary snapshots
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def save(self, bot):
+        """ Writes the changes of the bot's session since the last save, or compacts if it's time to. """
+        if self.saves_since_compaction >= self.compact_every or not os.path.exists(self.journal_path):
+            self.compact(bot)
+            return
+        lines = [std_json.dumps(record) + "\n" for record in self.changes(bot)]
+        self.saves_since_compaction += 1
+        if not lines:
+            return
+        data = "".join(lines).encode("utf-8")
+        with open(self.journal_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.bytes_written += len(data)
+        logger.debug(f"Appended {len(lines)} changes ({len(data)} bytes) to {self.journal_path}")
+
+    def compact(self, bot):
+        """ Atomically writes the full session as the new snapshot and starts a new journal. """
+        if self.snapshot_format == "msgpack":
+            snapshot = binary_snapshot.dumps(bot.exchanges, self.config)
+            self.bytes_written += atomic_write(self.snapshot_path, snapshot)
+        else:
+            session_settings = {exch_name: exchange.serialize() for exch_name, exchange in bot.exchanges.items()}
+            snapshot = json.dumps(session_settings, pretty=True).encode("utf-8")
+            self.bytes_written += atomic_write(self.file_path, snapshot)
+            self.config = snapshot
+            # A binary snapshot left from running with msgpack would be loaded instead
+            if os.path.exists(self.snapshot_path):
+                os.remove(self.snapshot_path)
+        self.snapshot_digest = self.digest(snapshot)
+        header = std_json.dumps({"op": "snapshot", "sha1": self.snapshot_digest}) + "\n"
+        self.bytes_written += atomic_write(self.journal_path, header)
+        # Everything is in the snapshot now, so only changes from here on need to go into the journal
+        self.written = {}
+        for _ in self.changes(bot):
+            pass
+        # Prices streamed in since a market was serialized aren't in the snapshot, they go into the next save
+        self.history_written = {(exch_name, mkt_name, history): added
+                                for exch_name, exchange in bot.exchanges.items()
+                                for mkt_name, market in exchange.traded_markets.items()
+                                for history, added in market.serialized_added.items()}
+        self.saves_since_compaction = 0
+        logger.debug(f"Compacted session into {self.file_path}")
+
+    def changes(self, bot):
+        """ Yields journal records for everything that changed since it was last yielded. """
+        for exch_name, exchange in bot.exchanges.items():
+            yield from self.changed_record("exchange", [exch_name], exchange.serialize_settings())
+            for mkt_name, market in exchange.traded_markets.items():
+                # Feeds add prices and fire strategy events from their own threads under the market's lock
+                with market.lock:
+                    records = list(self.market_changes([exch_name, mkt_name], market))
+                yield from records
+
+    def market_changes(self, path, market):
+        yield from self.changed_record("market", path, market.serialize_settings())
+        yield from self.new_history(path, "prices", market.prices, market.prices_added)
+        yield from self.new_history(path, "balances", market.balances, market.balances_added)
+        for strat_name, strategy in market.strategies.items():
+            yield from self.changed_record("strategy", path + [strat_name], strategy.serialize())
+
+    def changed_record(self, op, path, data):
+        key = (op,) + tuple(path)
+        record = {"op": op, "path": path, "data": data}
+        serialized = std_json.dumps(record, sort_keys=True, default=list)
+        if self.written.get(key) != serialized:
+            self.written[key] = serialized
+            yield record
+
+    def new_history(self, path, history, values, added):
+        """ Yields a record with the entries appended to a price or balance history since the last save. """
+        key = tuple(path) + (history,)
+        # Everything up to startup was loaded from the snapshot and journal, so it's already written
+        written = self.history_written.get(key, 0)
+        self.history_written[key] = added
+        if added == written:
+            return
+        values, timestamps, volumes = values.tail(added - written)
+        yield {"op": history, "path": path, "values": values, "timestamps": timestamps, "volumes": volumes}
+
+    def load(self):
+        """ Loads the snapshot and replays the journal on top of it.
+
+        :return: bot settings dict to initialize a TradingBot with
+        :raise ValueError: if the snapshot can't be loaded
+        """
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = f.read()
+            bot_settings, self.config = binary_snapshot.loads(snapshot)
+        else:
+            with open(self.file_path, "rb") as f:
+                snapshot = f.read()
+            bot_settings = json.loads(snapshot.decode("utf-8"))
+            self.config = snapshot
+        self.snapshot_digest = self.digest(snapshot)
+        if not os.path.exists(self.journal_path):
+            return bot_settings
+        with open(self.journal_path, "rb") as f:
+            lines = f.read().splitlines()
+        header = std_json.loads(lines[0]) if lines else {}
+        if header.get("sha1") != self.snapshot_digest:
+            logger.info(f"Ignoring {self.journal_path}, it doesn't belong to the current snapshot")
+            return bot_settings
+        replayed = 0
+        valid_size = len(lines[0]) + 1
+        for line in lines[1:]:
+            try:
+                record = std_json.loads(line)
+            except ValueError:
+                # Only the last line can be incomplete, when the bot stopped while appending to the journal.
+                # Cut it off so that new records don't get appended to it.
+                logger.warning(f"Dropping incomplete journal record in {self.journal_path}")
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(valid_size)
+                break
+            self.replay(bot_settings, record)
+            valid_size += len(line) + 1
+            replayed += 1
+        logger.debug(f"Replayed {replayed} journal records from {self.journal_path}")
+        return bot_settings
+
+    @staticmethod
+    def replay(bot_settings, record):
+        op, path = record["op"], record["path"]
+        exchange = bot_settings.setdefault(path[0], {})
+        if op == "exchange":
+            exchange.update(record["data"])
+            return
+        market = exchange.setdefault("traded_markets", {}).setdefault(path[1], {})
+        if op == "market":
+            market.update(record["data"])
+        elif op in ("prices", "balances"):
+            history = market.get(op)
+            if not isinstance(history, History):
+                history = market[op] = History.load(history, market.get(f"{op[:-1]}_history_size"))
+            history.extend(record["values"], record.get("timestamps"), record.get("volumes"))
+        elif op == "strategy":
+            market.setdefault("strategies", {})[path[2]] = record["data"]
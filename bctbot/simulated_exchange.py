@@ -0,0 +1,123 @@
+""" PaperExchange that behaves like a remote exchange, to load test the bot with many markets without network.
+
+Every call takes a configurable latency and fails with a configurable probability with one of the errors the bot
+retries on, and prices follow a random walk that takes a step every time a ticker is fetched. Register it in the
+Exchange factory with Exchange.register_backend("simulated", SimulatedExchange) and configure it through its
+ccxt_config, e.g.:
+    {"markets_count": 1000, "latency": 0.05, "error_rate": 0.01, "initial_balance": {"ETH": 100}, "seed": 1}
+"""
+import functools
+import math
+import random
+import time
+
+from ccxt.base.errors import DDoSProtection, NetworkError, RequestTimeout
+
+from paper_exchange import PaperExchange
+
+
+def simulated_symbols(count, quote="ETH"):
+    return [f"C{i}/{quote}" for i in range(count)]
+
+
+def simulated_call(method):
+    """ Adds the latency and error injection of the exchange to a ccxt unified API method. """
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        self.simulate_request(method.__name__)
+        return method(self, *args, **kwargs)
+    return call
+
+
+class SimulatedExchange(PaperExchange):
+    id = "simulated"
+    markets_count = 10
+    latency = 0.0
+    error_rate = 0.0
+    errors = ["NetworkError", "DDoSProtection", "RequestTimeout"]
+    start_price = 0.000005
+    volatility = 0.002
+    seed = None
+
+    error_classes = {"NetworkError": NetworkError, "DDoSProtection": DDoSProtection, "RequestTimeout": RequestTimeout}
+
+    def __init__(self, config={}):
+        super().__init__(config)
+        if not self.symbols_config:
+            self.symbols_config = simulated_symbols(self.markets_count)
+        self.random = random.Random(self.seed)
+        self.requests = 0
+        self.injected_errors = 0
+
+    def simulate_request(self, endpoint):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.injected_errors += 1
+            error = self.random.choice(self.errors)
+            raise self.error_classes[error](f"{self.id} {endpoint}: simulated {error}")
+
+    def step_price(self, symbol):
+        """ Moves the price of symbol one random walk step, filling the open orders it reaches. """
+        price = self.prices.get(symbol)
+        price = self.start_price if price is None else price * math.exp(self.random.gauss(0, self.volatility))
+        self.set_price(symbol, price, self.milliseconds())
+        return price
+
+    @simulated_call
+    def load_markets(self, reload=False, params={}):
+        return super().load_markets(reload, params)
+
+    @simulated_call
+    def fetch_balance(self, params={}):
+        return super().fetch_balance(params)
+
+    @simulated_call
+    def fetch_ticker(self, symbol, params={}):
+        self.step_price(symbol)
+        return super().fetch_ticker(symbol, params)
+
+    @simulated_call
+    def fetch_tickers(self, symbols=None, params={}):
+        symbols = self.symbols if symbols is None else symbols
+        for symbol in symbols:
+            self.step_price(symbol)
+        # Bypasses the simulated fetch_ticker, the whole batch is a single request
+        return {symbol: PaperExchange.fetch_ticker(self, symbol) for symbol in symbols}
+
+    @simulated_call
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        return super().create_order(symbol, type, side, amount, price, params)
+
+    @simulated_call
+    def cancel_order(self, id, symbol=None, params={}):
+        return super().cancel_order(id, symbol, params)
+
+    @simulated_call
+    def create_orders(self, orders, params={}):
+        return super().create_orders(orders, params)
+
+    @simulated_call
+    def cancel_orders(self, ids, symbol=None, params={}):
+        return super().cancel_orders(ids, symbol, params)
+
+    @simulated_call
+    def cancel_all_orders(self, symbol=None, params={}):
+        return super().cancel_all_orders(symbol, params)
+
+    @simulated_call
+    def fetch_open_orders(self, symbol=None, since=None, limit=None, params={}):
+        return super().fetch_open_orders(symbol, since, limit, params)
+
+    @simulated_call
+    def fetch_order(self, id, symbol=None, params={}):
+        return super().fetch_order(id, symbol, params)
+
+    @simulated_call
+    def fetch_orders(self, symbol=None, since=None, limit=None, params={}):
+        return super().fetch_orders(symbol, since, limit, params)
+
+    @simulated_call
+    def fetch_my_trades(self, symbol=None, since=None, limit=None, params={}):
+        return super().fetch_my_trades(symbol, since, limit, params)
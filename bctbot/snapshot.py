@@ -0,0 +1,78 @@
+""" Binary session snapshots, packed with msgpack.
+
+A snapshot holds the same tree of settings as the JSON session file, except that price and balance histories keep
+their compressed columns as raw bytes (History.pack) instead of base64 text, and it records the schema version
+it was written with and the config file the session was last based on:
+    {"schema": 1, "config": <bytes of the config file>, "exchanges": {<exchange name>: <Exchange.serialize()>}}
+
+Snapshots of older schema versions are upgraded on load by the migrations registered for each version, every
+migration takes the snapshot dict of its version and returns it in the layout of the next one:
+
+    @migration(1)
+    def split_fees(snapshot):
+        ...
+        return snapshot
+"""
+import msgpack
+
+SCHEMA_VERSION = 1
+MIGRATIONS = {}         # Schema version -> function upgrading a snapshot of that version to the next one
+
+
+def migration(version):
+    """ Registers the decorated function as the migration of snapshots of version to version + 1. """
+    def register(function):
+        MIGRATIONS[version] = function
+        return function
+    return register
+
+
+def default(value):
+    # NumPy scalars, e.g. indicators or prices a strategy computed with NumPy
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Can't pack {value.__class__.__name__} into a session snapshot")
+
+
+def session_state(exchanges):
+    """ :return: dict of exchange name to its serialized settings, with the histories of its markets packed """
+    state = {}
+    for exch_name, exchange in exchanges.items():
+        traded_markets = {symbol: market.serialize(packed=True) for symbol, market in exchange.traded_markets.items()}
+        state[exch_name] = dict(exchange.serialize_settings(), traded_markets=traded_markets)
+    return state
+
+
+def dumps(exchanges, config=None):
+    """ :param config: bytes of the config file the session is based on, to tell changes made to it later """
+    snapshot = {"schema": SCHEMA_VERSION, "config": config, "exchanges": session_state(exchanges)}
+    return msgpack.packb(snapshot, use_bin_type=True, default=default)
+
+
+def migrate(snapshot):
+    """ :raise ValueError: if the snapshot is newer than this version of the bot or can't be upgraded """
+    version = snapshot.get("schema")
+    if not isinstance(version, int) or version > SCHEMA_VERSION:
+        raise ValueError(f"Unknown session snapshot schema {version!r}, this bot reads up to {SCHEMA_VERSION}")
+    while version < SCHEMA_VERSION:
+        if version not in MIGRATIONS:
+            raise ValueError(f"No migration for session snapshots of schema {version}")
+        snapshot = MIGRATIONS[version](snapshot)
+        version += 1
+        snapshot["schema"] = version
+    return snapshot
+
+
+def loads(data):
+    """ :return: (bot settings dict to initialize a TradingBot with, bytes of the config file the session is
+        based on or None)
+    :raise ValueError: if data isn't a snapshot of a known schema
+    """
+    try:
+        snapshot = msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise ValueError(f"Corrupt session snapshot: {e!r}") from e
+    if not isinstance(snapshot, dict):
+        raise ValueError("Corrupt session snapshot: not a map")
+    snapshot = migrate(snapshot)
+    return snapshot["exchanges"], snapshot.get("config")
@@ -0,0 +1,124 @@
+""" Transition tables of strategies, compiled once per strategy class.
+
+Strategies describe their states and transitions the way the transitions library does, and behave the same: the
+first transition of a trigger from the current state whose conditions pass and whose unless conditions fail runs
+its before callbacks, the on_exit_<source> and on_enter_<dest> methods, its after callbacks and the machine's
+after_state_change callback. A dest of None makes an internal transition without exit and enter callbacks. Every
+state gets a to_<state> trigger that always moves there, and triggers that have no transition from the current
+state are ignored.
+
+The table maps (trigger, state) straight to the candidate transitions and every callback is looked up on the class
+once, so a trigger costs a dict lookup and the calls of its conditions.
+"""
+
+
+def listify(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+class Transition:
+    __slots__ = ("source", "dest", "conditions", "unless", "before", "after")
+
+    def __init__(self, source, dest, conditions, unless, before, after):
+        self.source = source
+        self.dest = dest
+        self.conditions = conditions
+        self.unless = unless
+        self.before = before
+        self.after = after
+
+
+class StateMachine:
+
+    def __init__(self, states, table, on_enter, on_exit, after_state_change):
+        self.states = states
+        self.table = table                              # (trigger, state) -> [Transition]
+        self.on_enter = on_enter                        # state -> callback or None
+        self.on_exit = on_exit
+        self.after_state_change = after_state_change
+        self.triggers = sorted({trigger for trigger, _ in table})
+
+    @staticmethod
+    def compile(cls, after_state_change=None):
+        """ Builds the table of a class from its states and transitions class attributes.
+
+        :raise ValueError: if a transition names an unknown state or a method the class doesn't have
+        """
+        states = list(cls.states)
+
+        def method(name, trigger):
+            function = getattr(cls, name, None)
+            if not callable(function):
+                raise ValueError(f"{cls.__name__} has no method {name} for its {trigger} transitions")
+            return function
+
+        def check_state(state, trigger):
+            if state not in states:
+                raise ValueError(f"{cls.__name__} has no state {state} for its {trigger} transitions")
+
+        table = {}
+        for transition in cls.transitions:
+            trigger = transition["trigger"]
+            dest = transition["dest"]
+            if dest is not None:
+                check_state(dest, trigger)
+            sources = states if transition["source"] == "*" else listify(transition["source"])
+            for source in sources:
+                check_state(source, trigger)
+                table.setdefault((trigger, source), []).append(Transition(
+                    source, dest,
+                    [method(name, trigger) for name in listify(transition.get("conditions"))],
+                    [method(name, trigger) for name in listify(transition.get("unless"))],
+                    [method(name, trigger) for name in listify(transition.get("before"))],
+                    [method(name, trigger) for name in listify(transition.get("after"))]))
+        for dest in states:
+            for source in states:
+                table.setdefault((f"to_{dest}", source), []).append(Transition(source, dest, [], [], [], []))
+        on_enter = {state: getattr(cls, f"on_enter_{state}", None) for state in states}
+        on_exit = {state: getattr(cls, f"on_exit_{state}", None) for state in states}
+        return StateMachine(states, table, on_enter, on_exit,
+                            method(after_state_change, "all") if after_state_change else None)
+
+    @staticmethod
+    def trigger_method(trigger):
+        # Looked up on the model, so subclasses dispatch with their own table
+        def fire(model):
+            return model.machine.trigger(model, trigger)
+        fire.__name__ = trigger
+        return fire
+
+    def set_state(self, model, state):
+        """ :raise ValueError: if state is unknown """
+        if state not in self.on_enter:
+            raise ValueError(f"{model.__class__.__name__} has no state {state}")
+        model.state = state
+
+    def trigger(self, model, trigger):
+        """ :return: whether a transition was made """
+        transitions = self.table.get((trigger, model.state))
+        if transitions is None:
+            return False
+        for transition in transitions:
+            if all(condition(model) for condition in transition.conditions) and \
+                    not any(condition(model) for condition in transition.unless):
+                self.execute(model, transition)
+                return True
+        return False
+
+    def execute(self, model, transition):
+        for callback in transition.before:
+            callback(model)
+        if transition.dest is not None:
+            on_exit = self.on_exit[transition.source]
+            if on_exit is not None:
+                on_exit(model)
+            model.state = transition.dest
+            on_enter = self.on_enter[transition.dest]
+            if on_enter is not None:
+                on_enter(model)
+        for callback in transition.after:
+            callback(model)
+        if self.after_state_change is not None:
+            self.after_state_change(model)
@@ -1,19 +1,74 @@
-from transitions import Machine
+from grid import Grid, ArmedLevels
+from ladder import Ladder, Refill
 from order import Order
+from order_table import OrderTable
+from state_machine import StateMachine
+from metrics import METRICS
 
 import logging_setup
 logger = logging_setup.logging.getLogger(__name__)
 
 class Strategy:
 
+    states = []
+    transitions = []
+
+    def __init_subclass__(cls, **kwargs):
+        # The transitions are compiled once per strategy class, with a method for every trigger
+        super().__init_subclass__(**kwargs)
+        cls.machine = StateMachine.compile(cls, after_state_change="record_transition")
+        for trigger in cls.machine.triggers:
+            if trigger not in cls.__dict__:
+                setattr(cls, trigger, StateMachine.trigger_method(trigger))
+
     def __init__(self, market, strategy_settings):
         self.market = market
         self.strategy_settings = strategy_settings
+        self.name = self.__class__.__name__
 
     @staticmethod
     def set_strategy(strategy_name, market, strategy_settings):
         if strategy_name.startswith("range_account_building"):
-            return RangeAccountBuilding(market, strategy_settings)
+            strategy = RangeAccountBuilding(market, strategy_settings)
+        elif strategy_name.startswith("grid"):
+            strategy = GridTrading(market, strategy_settings)
+        else:
+            return None
+        strategy.name = strategy_name
+        return strategy
+
+    def record_transition(self, *args, **kwargs):
+        METRICS.inc("bctbot_state_transitions_total", exchange=self.market.exchange.exchange_name,
+                    market=self.market.symbol, strategy=self.name, state=self.state)
+
+    def watch_prices(self):
+        """ Prices this strategy acts on, the scheduler polls the market more often when the price gets near. """
+        return self.orders.prices(status="open")
+
+    @staticmethod
+    def check_orders(results):
+        """ Raises the first failure of a batch of orders, once all other orders have their results. """
+        for order, error in results:
+            if error is not None:
+                raise error
+
+    def place_orders(self, orders):
+        self.check_orders(Order.place_orders(list(orders)))
+
+    def cancel_orders(self, orders):
+        self.check_orders(Order.cancel_orders(list(orders)))
+
+    def thresholds(self):
+        """ Prices at which this strategy can act, whether its orders are open or not. """
+        return self.orders.prices() + self.watch_prices()
+
+    def load_order(self, order):
+        """ Restores an order saved in a session. """
+        return Order(self.market.exchange, self.market, order["side"], order["type"], order["price"],
+                     cost=order["cost"], initial_cost=order["initial_cost"], internal_id=order["internal_id"],
+                     id=order["id"], status=order["status"], timestamp=order.get("timestamp"),
+                     filled=order.get("filled", 0), filled_cost=order.get("filled_cost", 0), fees=order.get("fees"),
+                     settled_amount=order.get("settled_amount", 0), settled_cost=order.get("settled_cost", 0))
 
     def serialize(self):
         orders = {}
@@ -51,6 +106,9 @@ class RangeAccountBuilding(Strategy):
          "conditions": ["price_below_buy_trigger"], "before": ["place_buy_orders"]},
 
         {"trigger": "balance_change_event", "source": "selling", "dest": "sold",
+         "conditions": ["any_sell_order_filled"]},
+
+        {"trigger": "balance_change_event", "source": "bought_all", "dest": "sold",
          "conditions": ["any_sell_order_filled"]}
 
     ]
@@ -68,15 +126,22 @@ class RangeAccountBuilding(Strategy):
             * Any number of buy and/or sell orders *
         """
         super().__init__(market, strategy_settings)
+        # The rungs only live in the ladder, compiled once, the other settings become attributes
+        self.ladder = Ladder.compile(strategy_settings)
         for key, value in self.strategy_settings.items():
-            setattr(self, key, value)
+            if not Ladder.is_rung_key(key):
+                setattr(self, key, value)
 
         self.bought_counter = strategy_settings.get("bought_counter", 0)
         self.amount_to_sell = strategy_settings.get("amount_to_sell", 0)
         self.orders = self.prepare_orders(strategy_settings.get("orders", {}))
-        self.buy_trigger = self.set_buy_trigger()
-        self.machine = Machine(model=self, states=self.states, transitions=self.transitions,
-                               initial=strategy_settings.get("state", "idle"))
+        # The orders of each side in the order of the ladder's rungs
+        self.buy_orders = [self.orders[internal_id] for internal_id in self.ladder.buy.internal_ids()]
+        self.sell_orders = [self.orders[internal_id] for internal_id in self.ladder.sell.internal_ids()]
+        self.refill = Refill([order.initial_cost for order in self.buy_orders])
+        self.buy_trigger_percentage = strategy_settings.get("buy_trigger_percentage", 0.25)
+        self.buy_trigger = self.set_buy_trigger(self.buy_trigger_percentage)
+        self.machine.set_state(self, strategy_settings.get("state", "idle"))
 
     def serialize(self):
         strategy = super().serialize()
@@ -84,14 +149,16 @@ class RangeAccountBuilding(Strategy):
             "total_buy_cost": self.total_buy_cost,
             "bought_counter": self.bought_counter,
             "amount_to_sell": self.amount_to_sell,
+            "buy_trigger_percentage": self.buy_trigger_percentage,
             "state": self.state
         }
-        for k, v in self.__dict__.items():
-            if k.startswith(("buy_price_", "buy_amount_percentage_", "sell_price_", "sell_amount_percentage_")):
-                settings[k] = v
+        settings.update(self.ladder.serialize())
         strategy.update(settings)
         return strategy
 
+    def watch_prices(self):
+        return super().watch_prices() + [self.buy_trigger]
+
     def set_buy_trigger(self, percentage=0.25):
         """ Calculates the price trigger for when to place the buy orders.
 
@@ -99,92 +166,79 @@ class RangeAccountBuilding(Strategy):
         :return: trigger price (float)
         """
 
-        buy_1 = self.orders["buy_order_1"].price
-        sell_1 = self.orders["sell_order_1"].price
+        buy_1 = float(self.ladder.buy.prices[0])
+        sell_1 = float(self.ladder.sell.prices[0])
         diff = sell_1 - buy_1
         dist = diff * percentage
         return sell_1 - dist
 
     def prepare_orders(self, orders):
-        if orders:
-            orders_objects = {}
-            for internal_id, order in orders.items():
-                orders_objects[internal_id] = Order(self.market.exchange, self.market, order["side"], order["type"],
-                                                    order["price"], cost=order["cost"], initial_cost=order["initial_cost"],
-                                                    internal_id=order["internal_id"], id=order["id"], status=order["status"])
-            return orders_objects
-
-        for key, value in self.strategy_settings.items():
-            if "price" in key:
-                side = key.split("_")[0]
-                number = key.split("_")[-1]
-                cost = self.strategy_settings["total_buy_cost"] * self.strategy_settings[side + "_amount_percentage_" + number]
-                price = self.strategy_settings[side + "_price_" + number]
-                internal_id = side + "_order_" + number
-                orders[internal_id] = Order(self.market.exchange, self.market, side, "limit", price, cost=cost, internal_id=internal_id)
-        return orders
+        """ Creates an order for every rung of the ladder, restoring those saved in a session. """
+        orders_objects = {internal_id: self.load_order(order) for internal_id, order in orders.items()}
+
+        for rungs in (self.ladder.buy, self.ladder.sell):
+            costs = (self.total_buy_cost * rungs.percentages).tolist()
+            for internal_id, price, cost in zip(rungs.internal_ids(), rungs.prices.tolist(), costs):
+                if internal_id not in orders_objects:
+                    orders_objects[internal_id] = Order(self.market.exchange, self.market, rungs.side, "limit", price,
+                                                        cost=cost, internal_id=internal_id)
+        rung_ids = set(self.ladder.buy.internal_ids() + self.ladder.sell.internal_ids())
+        for internal_id in list(orders_objects):
+            if internal_id not in rung_ids:
+                logger.warning(f"Dropping {orders_objects.pop(internal_id)}, the ladder has no rung for it anymore")
+        return OrderTable(orders_objects)
 
     # Conditionals
     def price_below_buy_trigger(self):
         return self.market.last_price < self.buy_trigger
 
-    def price_above_trigger(self):
+    def price_above_buy_trigger(self):
         return self.market.last_price > self.buy_trigger
 
+    # Every order filled since the last check is accounted for with the amount and cost it actually filled,
+    # partial fills included
     def any_buy_order_filled(self):
-        for order in self.orders.values():
-            if order.side == "buy" and order.order_filled():
-                self.update_bought_counter(order)
-                self.update_amount_to_sell(order)
-                return True
-        return False
+        filled = False
+        for order in self.buy_orders:
+            amount, cost = order.take_fills()
+            if amount > 0:
+                self.update_bought_counter(order, cost)
+                self.update_amount_to_sell(order, amount)
+                filled = True
+        return filled
 
     def any_sell_order_filled(self):
-        for order in self.orders.values():
-            if order.side == "sell" and order.order_filled():
-                self.update_bought_counter(order)
-                return True
-        return False
+        filled = False
+        for order in self.sell_orders:
+            amount, cost = order.take_fills()
+            if amount > 0:
+                self.update_bought_counter(order, cost)
+                filled = True
+        return filled
 
     def all_buy_orders_filled(self):
-        for order in self.orders.values():
-            if order.side == "buy" and not order.status == "filled":
-                return False
-        return True
+        return all(order.status == "filled" for order in self.buy_orders)
 
     def all_sell_orders_filled(self):
-        for order in self.orders.values():
-            if order.side == "sell" and not order.status == "filled":
-                return False
-        return True
+        return all(order.status == "filled" for order in self.sell_orders)
 
     # Unless
     def any_sell_order_open(self):
-        for order in self.orders.values():
-            if order.side == "sell" and order.status == "open":
-                return True
-        return False
+        return any(order.status == "open" for order in self.sell_orders)
 
     # Before transitions
+    # The whole ladder is placed or canceled at once, so the price can't run through it halfway
     def place_buy_orders(self):
-        for order in self.orders.values():
-            if order.side == "buy":
-                order.place_order()
+        self.place_orders(order for order in self.buy_orders if order.status == "potential" and order.amount > 0)
 
     def cancel_buy_orders(self):
-        for order in self.orders.values():
-            if order.side == "buy":
-                order.cancel_order()
+        self.cancel_orders(order for order in self.buy_orders if order.status == "open")
 
     def place_sell_orders(self):
-        for order in self.orders.values():
-            if order.side == "sell":
-                order.place_order()
+        self.place_orders(order for order in self.sell_orders if order.status == "potential" and order.amount > 0)
 
     def cancel_sell_orders(self):
-        for order in self.orders.values():
-            if order.side == "sell":
-                order.cancel_order()
+        self.cancel_orders(order for order in self.sell_orders if order.status == "open")
 
     # on_enter methods
     def on_enter_bought(self):
@@ -210,33 +264,253 @@ class RangeAccountBuilding(Strategy):
     # After transitions
 
     # Other methods
-    def update_bought_counter(self, order):
+    def update_bought_counter(self, order, cost):
         if order.side == "buy":
-            self.bought_counter += order.cost
+            self.bought_counter += cost
         elif order.side == "sell":
-            self.bought_counter -= order.cost
+            self.bought_counter -= cost
 
-    def update_amount_to_sell(self, order):
+    def update_amount_to_sell(self, order, amount):
         if order.side == "buy":
-            self.amount_to_sell += order.amount
+            self.amount_to_sell += amount
 
     def recalculate_sell_orders(self):
-        for internal_id, order in self.orders.items():
-            if order.side == "sell":
-                number = internal_id.split("_")[-1]
-                sell_amount_percentage = getattr(self, "sell_amount_percentage_" + number)
-                order.amount = self.amount_to_sell * sell_amount_percentage
-                order.status = "potential"
-                self.amount_to_sell -= order.amount
+        amounts, self.amount_to_sell = self.ladder.sell_amounts(self.amount_to_sell)
+        for order, amount in zip(self.sell_orders, amounts.tolist()):
+            order.amount = amount
+            order.status = "potential"
 
     def recalculate_buy_orders(self):
-        to_divide = self.total_buy_cost - self.bought_counter
-        buy_orders = {name: order for name, order in self.orders.items() if order.side == "buy"}
-        for elem in sorted(buy_orders.items(), reverse=True):
-            name, order = elem[0], elem[1]
-            if to_divide >= order.initial_cost:
-                order.cost = order.initial_cost
-            else:
-                order.cost = to_divide
+        costs = self.refill.costs(self.total_buy_cost - self.bought_counter)
+        for order, cost in zip(self.buy_orders, costs.tolist()):
+            order.cost = cost
             order.status = "potential"
-            to_divide -= order.cost
+
+
+class GridTrading(Strategy):
+    """ Buys and sells across a grid of price levels: every filled buy arms a sell one level up, every filled sell
+    arms a buy one level down.
+
+    Only the active_levels armed levels nearest the price on each side have an order on the exchange, the others
+    wait until the price comes near, so a grid can have hundreds of levels. The levels the price is between are
+    found by bisection, a price event that doesn't cross a level costs nothing more.
+    """
+
+    states = ["idle", "running", "out_of_range"]
+    transitions = [
+        {"trigger": "price_change_event", "source": "idle", "dest": "running",
+         "conditions": ["price_in_range"], "before": ["arm_buy_levels"]},
+
+        {"trigger": "price_change_event", "source": "running", "dest": "out_of_range",
+         "unless": ["price_in_range"], "before": ["cancel_live_orders"]},
+
+        {"trigger": "price_change_event", "source": "out_of_range", "dest": "running",
+         "conditions": ["price_in_range"]},
+
+        # Internal transitions, the grid keeps running while its orders follow the price
+        {"trigger": "price_change_event", "source": "running", "dest": None,
+         "conditions": ["price_crossed_level"], "after": ["shift_live_orders"]},
+
+        {"trigger": "balance_change_event", "source": "running", "dest": None,
+         "conditions": ["any_level_filled"], "after": ["shift_live_orders"]},
+
+        {"trigger": "balance_change_event", "source": "out_of_range", "dest": None,
+         "conditions": ["any_level_filled"]}
+    ]
+
+    def __init__(self, market, strategy_settings):
+        """
+
+        :param market: Market object
+        :param strategy_settings: dict:
+            lower_price: price of the lowest level
+            upper_price: price of the highest level
+            levels: number of levels
+            spacing: "arithmetic" (default) for a fixed price step, "geometric" for a fixed percentage step
+            total_buy_cost: quote currency to buy with, divided evenly over all levels
+            active_levels: number of orders kept on the exchange on each side of the price (default 5)
+        """
+        super().__init__(market, strategy_settings)
+        self.grid = Grid.compile(strategy_settings)
+        self.total_buy_cost = strategy_settings.get("total_buy_cost", 0)
+        if not self.total_buy_cost > 0:
+            raise ValueError(f"The grid needs a positive total_buy_cost, got {self.total_buy_cost}")
+        self.active_levels = strategy_settings.get("active_levels", 5)
+        if int(self.active_levels) != self.active_levels or self.active_levels < 1:
+            raise ValueError(f"active_levels must be a whole number of at least 1, got {self.active_levels}")
+        self.cost_per_level = self.total_buy_cost / len(self.grid)
+        self.bought_counter = strategy_settings.get("bought_counter", 0)
+        self.round_trips = strategy_settings.get("round_trips", 0)
+
+        self.orders = OrderTable()
+        self.armed = {"buy": ArmedLevels(), "sell": ArmedLevels()}
+        self.live = set()               # Internal ids of the orders open on the exchange
+        for internal_id, order in strategy_settings.get("orders", {}).items():
+            self.restore_level(self.load_order(order))
+        # Index of the price among the levels when the live orders were last shifted
+        self.level_index = None
+        self.machine.set_state(self, strategy_settings.get("state", "idle"))
+
+    def serialize(self):
+        strategy = super().serialize()
+        strategy.update(self.grid.serialize())
+        strategy.update({
+            "total_buy_cost": self.total_buy_cost,
+            "active_levels": self.active_levels,
+            "bought_counter": self.bought_counter,
+            "round_trips": self.round_trips,
+            "state": self.state
+        })
+        return strategy
+
+    def watch_prices(self):
+        return [self.orders[internal_id].price for internal_id in self.live] + \
+               [self.grid.lower_price, self.grid.upper_price]
+
+    def thresholds(self):
+        return list(self.grid.prices)
+
+    @staticmethod
+    def level_id(side, index):
+        return f"grid_{side}_{index}"
+
+    @staticmethod
+    def level_of(order):
+        _, side, index = order.internal_id.split("_")
+        return side, int(index)
+
+    def restore_level(self, order):
+        side, index = self.level_of(order)
+        if index >= len(self.grid) or order.price != self.grid.prices[index]:
+            logger.warning(f"Dropping {order}, the grid has no level for it anymore")
+            return
+        self.orders[order.internal_id] = order
+        self.armed[side].add(index)
+        if order.status == "open":
+            self.live.add(order.internal_id)
+
+    # Conditionals
+    def price_in_range(self):
+        return self.grid.in_range(self.market.last_price)
+
+    def price_crossed_level(self):
+        return self.grid.index(self.market.last_price) != self.level_index
+
+    # Only the live orders can fill, whatever the size of the grid
+    def any_level_filled(self):
+        filled = []
+        for internal_id in list(self.live):
+            order = self.orders[internal_id]
+            amount, cost = order.take_fills()
+            if amount > 0:
+                self.update_bought_counter(order, cost)
+            if order.status == "filled":
+                filled.append(order)
+            elif order.status == "canceled":
+                logger.info(f"Arming {order} again")
+                self.park(order)
+        for order in filled:
+            self.rearm(order)
+        return len(filled) > 0
+
+    # Before transitions
+    def arm_buy_levels(self):
+        """ Arms a buy on every level below the price, unless the grid has been trading already. """
+        if self.orders:
+            return
+        for index in range(self.grid.index(self.market.last_price)):
+            self.arm("buy", index, cost=self.cost_per_level)
+
+    def cancel_live_orders(self):
+        orders = [self.orders[internal_id] for internal_id in self.live]
+        try:
+            self.cancel_orders(orders)
+        finally:
+            for order in orders:
+                if order.status == "canceled":
+                    self.park(order)
+        self.level_index = None
+
+    # on_enter methods
+    def on_enter_running(self):
+        self.shift_live_orders()
+
+    # After transitions
+    def shift_live_orders(self):
+        """ Keeps the active_levels armed buys below the price and sells above it live, and cancels the others. """
+        index = self.grid.index(self.market.last_price)
+        if self.level_index is not None and index != self.level_index:
+            logger.debug(f"{self.market.symbol} crossed {abs(index - self.level_index)} grid levels")
+        self.level_index = index
+        wanted = {self.level_id("buy", i) for i in self.armed["buy"].below(index, self.active_levels)}
+        wanted.update(self.level_id("sell", i) for i in self.armed["sell"].above(index, self.active_levels))
+        stale = [self.orders[internal_id] for internal_id in self.live - wanted]
+        fresh = [self.orders[internal_id] for internal_id in wanted - self.live]
+        try:
+            self.cancel_orders(stale)
+        finally:
+            for order in stale:
+                if order.status == "canceled":
+                    self.park(order)
+        try:
+            self.place_orders(order for order in fresh if order.amount > 0)
+        finally:
+            self.live.update(order.internal_id for order in fresh if order.status == "open")
+
+    # Other methods
+    def arm(self, side, index, amount=0, cost=0):
+        """ Puts an order of side on a level, or adds to the order the level has already. """
+        internal_id = self.level_id(side, index)
+        order = self.orders.get(internal_id)
+        if order is None:
+            self.orders[internal_id] = Order(self.market.exchange, self.market, side, "limit", self.grid.prices[index],
+                                             amount=amount, cost=cost, internal_id=internal_id)
+            self.armed[side].add(index)
+            return
+        if order.status == "open":
+            # The order is placed again with the added amount when it's in reach of the price
+            self.cancel_orders([order])
+            self.park(order)
+        order.amount = order.amount + (amount or cost / order.price)
+
+    def disarm(self, order):
+        side, index = self.level_of(order)
+        del self.orders[order.internal_id]
+        self.armed[side].remove(index)
+        self.live.discard(order.internal_id)
+
+    def park(self, order):
+        """ Takes a canceled order back to an armed level, what it filled arms the opposite side. """
+        self.live.discard(order.internal_id)
+        order.status = "potential"
+        if order.settled_amount > 0:
+            self.arm_opposite(order, order.settled_amount)
+            remaining = order.amount - order.filled
+            order.filled = order.filled_cost = order.settled_amount = order.settled_cost = 0
+            if remaining <= order.amount * 1e-9:
+                self.disarm(order)
+            else:
+                order.amount = remaining
+
+    def rearm(self, order):
+        self.disarm(order)
+        self.arm_opposite(order, order.settled_amount)
+        if order.side == "sell":
+            self.round_trips += 1
+
+    def arm_opposite(self, order, amount):
+        """ A filled buy arms a sell of what it bought one level up, a filled sell a buy of what it sold one level
+        down.
+        """
+        side, index = self.level_of(order)
+        opposite, index = ("sell", index + 1) if side == "buy" else ("buy", index - 1)
+        if 0 <= index < len(self.grid):
+            self.arm(opposite, index, amount=amount)
+        else:
+            logger.info(f"{order} filled at the edge of the grid, there's no level to {opposite} {amount} at")
+
+    def update_bought_counter(self, order, cost):
+        if order.side == "buy":
+            self.bought_counter += cost
+        elif order.side == "sell":
+            self.bought_counter -= cost
@@ -0,0 +1,405 @@
+""" Runs the bot as several worker processes, each trading a shard of the exchanges and markets.
+
+The bot settings are split into shards by exchange, and exchanges with more than markets_per_shard markets into
+several shards by market. Every shard runs a TradingBot with its own Exchange instances in a worker process,
+with its own session file in the shards folder. The supervisor:
+- writes the log records of all workers, so only one process writes the log files,
+- collects the health and metrics of the workers, served and dumped like those of a single bot with an extra
+  shard label,
+- restarts workers that crash or stop reporting, from their last saved session, waiting longer after every crash
+  in a row,
+- rebalances the shards when the config file changes: only the workers of changed shards are stopped, and the
+  markets they traded carry their saved state (strategies, orders, prices) over to their new shard.
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import zlib
+from superjson import json
+
+import ccxt
+
+from history import History
+from metrics import HELP, METRICS, Metrics
+from session_store import SessionStore
+from tradingbot import TradingBot
+from utils import atomic_write
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+HELP.update({
+    "bctbot_shard_up": "Whether the worker process of a shard is running",
+    "bctbot_shard_restarts": "Times the worker process of a shard was restarted",
+    "bctbot_shard_cycles": "Cycles run by the current worker process of a shard",
+    "bctbot_shard_markets": "Markets traded by a shard",
+    "bctbot_shard_report_age_seconds": "Seconds since the last report of the worker process of a shard"
+})
+
+
+def shard_rate_limit(exch_name, settings, count):
+    """ Rate limit settings that give each of count shards trading on the same account its share of the limit. """
+    rate_limit = dict(settings.get("rate_limit", {}))
+    if count == 1:
+        return rate_limit
+    rate = rate_limit.get("rate")
+    if rate is None:
+        rate_limit_ms = settings.get("ccxt_config", {}).get("rateLimit")
+        if rate_limit_ms is None and hasattr(ccxt, exch_name):
+            rate_limit_ms = getattr(ccxt, exch_name)().rateLimit
+        if not rate_limit_ms:
+            return rate_limit
+        rate = 1000 / rate_limit_ms
+    rate_limit["rate"] = rate / count
+    rate_limit["burst"] = max(1, rate_limit.get("burst", 1) / count)
+    return rate_limit
+
+
+def partition(bot_settings, markets_per_shard=None):
+    """ Splits bot settings into shards: one per exchange, or more for exchanges with over markets_per_shard markets.
+
+    Markets are assigned to the shards of their exchange by a hash of their symbol, so adding or removing a market
+    doesn't move the others as long as the number of shards stays the same.
+
+    :return: dict of shard id to the bot settings of that shard
+    """
+    shards = {}
+    for exch_name, settings in bot_settings.items():
+        markets = settings.get("traded_markets", {})
+        count = max(1, -(-len(markets) // markets_per_shard)) if markets_per_shard else 1
+        if count == 1:
+            shards[exch_name] = {exch_name: settings}
+            continue
+        chunks = [{} for _ in range(count)]
+        for symbol, market in markets.items():
+            chunks[zlib.crc32(symbol.encode("utf-8")) % count][symbol] = market
+        rate_limit = shard_rate_limit(exch_name, settings, count)
+        for i, chunk in enumerate(chunks):
+            shard_id = f"{exch_name}-{i}"
+            # Shards only cache the metadata of their own markets, so they can't share a cache file
+            market_cache = dict(settings.get("market_cache", {}),
+                                folder=os.path.join(settings.get("market_cache", {}).get("folder", "market_cache"),
+                                                    shard_id))
+            shards[shard_id] = {exch_name: dict(settings, traded_markets=chunk, rate_limit=rate_limit,
+                                                market_cache=market_cache)}
+    return shards
+
+
+def shard_file(file_path, shard_id):
+    """ :return: file_path with the shard id before its extension, like log/profile.binance-0.folded """
+    root, extension = os.path.splitext(file_path)
+    return f"{root}.{shard_id}{extension}"
+
+
+def run_worker(shard_id, session_path, mode, status_queue, log_queue, report_interval, setup=None,
+               snapshot_format="json", profile=None, tapes_folder=None):
+    """ Entry point of a worker process: runs the bot of a shard from its session file until it gets SIGTERM.
+
+    :param profile: optional (cycles, output) to profile the first cycles with, see TradingBot.profile
+    :param tapes_folder: optional folder to record the calls to the exchanges to, see TradingBot.record_tapes
+    """
+    logging_setup.log_to_queue(log_queue)
+    if setup is not None:
+        setup()
+    bot = TradingBot(snapshot_format=snapshot_format)
+    bot.load_session(session_path)
+    if profile is not None:
+        bot.profile(*profile)
+    if tapes_folder is not None:
+        bot.record_tapes(tapes_folder)
+    signal.signal(signal.SIGTERM, lambda signum, frame: bot.stop())
+    # Ctrl+C reaches the whole process group, the supervisor stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    last_report = None
+
+    def send(bot):
+        markets = sum(len(exchange.traded_markets) for exchange in bot.exchanges.values())
+        status_queue.put({"shard": shard_id, "pid": os.getpid(), "cycles": bot.cycles, "markets": markets,
+                          "metrics": METRICS.snapshot()})
+
+    def report(bot):
+        nonlocal last_report
+        now = time.monotonic()
+        # The first cycle is always reported, it tells the supervisor the worker got through a whole cycle
+        if last_report is None or now - last_report >= report_interval:
+            last_report = now
+            send(bot)
+
+    bot.cycle_callbacks.append(report)
+    send(bot)
+    try:
+        bot.run(mode)
+    finally:
+        bot.stop_recording()
+    send(bot)
+
+
+class Shard:
+
+    def __init__(self, shard_id, settings, session_path):
+        self.shard_id = shard_id
+        self.settings = settings
+        self.config = json.dumps(settings, sort_keys=True)     # To tell whether the config of the shard changed
+        self.session_path = session_path
+        self.process = None
+        self.starts = 0
+        self.crashes = 0            # Crashes in a row, reset once a restarted worker completes a cycle
+        self.restart_at = 0
+        self.last_report = None
+        self.status = {}
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor:
+
+    def __init__(self, config_file_path, folder="shards", markets_per_shard=None, mode="sync",
+                 heartbeat_timeout=600, report_interval=5, check_interval=1, max_restart_delay=300, setup=None,
+                 snapshot_format="json", profile=None, tapes_folder=None):
+        """
+        :param setup: picklable function every worker calls before loading its session, e.g. to register backends
+        :param snapshot_format: format the workers save the sessions of their shards in, see SessionStore
+        :param profile: optional (cycles, output): every worker profiles its first cycles to output with its shard
+            id before the extension
+        :param tapes_folder: optional folder the workers record the calls to their exchanges to, in a subfolder per
+            shard, and another one for every restart of its worker (<shard id>.<restart>), so a crash keeps its tape
+        """
+        self.config_file_path = config_file_path
+        self.folder = folder
+        self.markets_per_shard = markets_per_shard
+        self.mode = mode
+        self.snapshot_format = snapshot_format
+        self.profile = profile
+        self.tapes_folder = tapes_folder
+        self.heartbeat_timeout = heartbeat_timeout
+        self.report_interval = report_interval
+        self.check_interval = check_interval
+        self.max_restart_delay = max_restart_delay
+        self.setup = setup
+        # Spawned workers start from a clean interpreter instead of a copy of the supervisor's threads and locks
+        self.context = multiprocessing.get_context("spawn")
+        self.status_queue = self.context.Queue()
+        self.log_queue = self.context.Queue()
+        self.shards = {}
+        self.market_configs = {}    # (exchange, symbol) -> config of the market when its shard was last started
+        self.config_mtime = None
+        self.active = True
+        self.wake = threading.Event()
+
+    def run(self):
+        log_listener = logging_setup.listen_to_queue(self.log_queue)
+        try:
+            self.rebalance(self.load_config())
+            while self.active:
+                self.check()
+                self.wake.wait(self.check_interval)
+        finally:
+            self.stop_workers(list(self.shards.values()))
+            log_listener.stop()
+
+    def stop(self):
+        """ Stops the supervisor and its workers. Safe to call from signal handlers. """
+        self.active = False
+        self.wake.set()
+
+    def load_config(self):
+        self.config_mtime = os.stat(self.config_file_path).st_mtime
+        return SessionStore(self.config_file_path).load()
+
+    def check(self):
+        self.read_reports()
+        try:
+            changed = os.stat(self.config_file_path).st_mtime != self.config_mtime
+        except OSError:
+            changed = False
+        if changed:
+            try:
+                bot_settings = self.load_config()
+            except Exception as e:
+                logger.error(f"Keeping the current shards, the changed config can't be loaded: {e!r}")
+            else:
+                logger.info(f"{self.config_file_path} changed, rebalancing the shards")
+                self.rebalance(bot_settings)
+        for shard in self.shards.values():
+            self.supervise(shard)
+        self.update_metrics()
+
+    def read_reports(self):
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except Exception:
+                return
+            shard = self.shards.get(status["shard"])
+            # Reports of workers that were stopped since are outdated
+            if shard is None or shard.process is None or shard.process.pid != status["pid"]:
+                continue
+            shard.last_report = time.monotonic()
+            shard.status = status
+            if status["cycles"] > 0:
+                shard.crashes = 0
+
+    def supervise(self, shard):
+        now = time.monotonic()
+        if shard.alive():
+            if now - shard.last_report > self.heartbeat_timeout:
+                logger.error(f"Worker of shard {shard.shard_id} didn't report for {now - shard.last_report:.0f}s, "
+                             f"restarting it")
+                self.stop_worker(shard)
+                self.crashed(shard, now)
+            return
+        if shard.process is not None:
+            logger.error(f"Worker of shard {shard.shard_id} exited with code {shard.process.exitcode}")
+            shard.process = None
+            self.crashed(shard, now)
+        if now >= shard.restart_at:
+            self.start_worker(shard)
+
+    def crashed(self, shard, now):
+        shard.crashes += 1
+        delay = min(self.max_restart_delay, 2 ** (shard.crashes - 1))
+        shard.restart_at = now + delay
+        logger.info(f"Restarting shard {shard.shard_id} from {shard.session_path} in {delay}s")
+
+    def start_worker(self, shard):
+        profile, tapes_folder = None, None
+        # A restarted worker would overwrite the profile of the cycles from the start
+        if self.profile is not None and not shard.starts:
+            cycles, output = self.profile
+            profile = (cycles, shard_file(output, shard.shard_id))
+        if self.tapes_folder is not None:
+            tapes_folder = os.path.join(self.tapes_folder,
+                                        f"{shard.shard_id}.{shard.starts}" if shard.starts else shard.shard_id)
+        shard.process = self.context.Process(target=run_worker, name=f"worker {shard.shard_id}",
+                                             args=(shard.shard_id, shard.session_path, self.mode, self.status_queue,
+                                                   self.log_queue, self.report_interval, self.setup,
+                                                   self.snapshot_format, profile, tapes_folder))
+        shard.process.start()
+        shard.starts += 1
+        shard.last_report = time.monotonic()
+        shard.status = {}
+        logger.info(f"Started worker {shard.process.pid} for shard {shard.shard_id}")
+
+    def stop_worker(self, shard, timeout=60):
+        """ Lets the worker finish its cycle and save its session, killing it if it takes longer than timeout. """
+        if not shard.alive():
+            shard.process = None
+            return
+        shard.process.terminate()
+        shard.process.join(timeout)
+        if shard.process.is_alive():
+            logger.warning(f"Killing worker of shard {shard.shard_id}, it didn't stop within {timeout}s")
+            shard.process.kill()
+            shard.process.join()
+        shard.process = None
+
+    def stop_workers(self, shards):
+        # Signal all workers first, so they finish their cycles at the same time
+        for shard in shards:
+            if shard.alive():
+                shard.process.terminate()
+        for shard in shards:
+            self.stop_worker(shard)
+
+    def session_path(self, shard_id):
+        return os.path.join(self.folder, f"{shard_id}.json")
+
+    def rebalance(self, bot_settings):
+        """ Partitions the bot settings again and restarts the workers of the shards that changed. """
+        os.makedirs(self.folder, exist_ok=True)
+        first = not self.shards
+        shards = {shard_id: Shard(shard_id, settings, self.session_path(shard_id))
+                  for shard_id, settings in partition(bot_settings, self.markets_per_shard).items()}
+        changed = [shard_id for shard_id, shard in shards.items()
+                   if shard_id not in self.shards or self.shards[shard_id].config != shard.config]
+        removed = [shard_id for shard_id in self.shards if shard_id not in shards]
+        if not changed and not removed:
+            return
+        stopped = [self.shards[shard_id] for shard_id in changed + removed if shard_id in self.shards]
+        self.stop_workers(stopped)
+        # At startup the sessions of a previous run are picked up, whatever shards they were in
+        if first:
+            paths = [os.path.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith(".json")]
+        else:
+            paths = [shard.session_path for shard in stopped]
+        state = self.saved_markets(paths)
+        for shard_id in changed:
+            self.write_session(shards[shard_id], state)
+        for path in set(paths) - {shard.session_path for shard in shards.values()}:
+            for file_path in (path, path + ".journal", path + ".snapshot"):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        for shard_id, shard in shards.items():
+            if shard_id not in changed:
+                shards[shard_id] = self.shards[shard_id]
+        self.shards = shards
+        for shard_id in changed:
+            self.start_worker(self.shards[shard_id])
+        logger.info(f"Running {len(self.shards)} shards, (re)started {changed}, removed {removed}")
+
+    @staticmethod
+    def saved_markets(paths):
+        """ :return: dict of (exchange, symbol) to the saved settings of every market in the sessions at paths """
+        markets = {}
+        for path in paths:
+            try:
+                bot_settings = SessionStore(path).load()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable session {path}: {e!r}")
+                continue
+            for exch_name, exchange in bot_settings.items():
+                for symbol, market in exchange.get("traded_markets", {}).items():
+                    for history in ("prices", "balances"):
+                        if isinstance(market.get(history), History):
+                            market[history] = market[history].serialize()
+                    markets[(exch_name, symbol)] = market
+        return markets
+
+    def write_session(self, shard, state):
+        """ Writes the session the worker of a shard starts from: the config of the shard, with the saved state of
+        its markets unless their config changed since they were started. """
+        session = {}
+        for exch_name, settings in shard.settings.items():
+            markets = {}
+            for symbol, config in settings.get("traded_markets", {}).items():
+                key = (exch_name, symbol)
+                config_json = json.dumps(config, sort_keys=True)
+                applied = self.market_configs.get(key)
+                use_saved = key in state and (applied is None or applied == config_json)
+                markets[symbol] = state[key] if use_saved else config
+                self.market_configs[key] = config_json
+            session[exch_name] = dict(settings, traded_markets=markets)
+        atomic_write(shard.session_path, json.dumps(session, pretty=True))
+        # A journal or binary snapshot left next to the new session belongs to the old one
+        for file_path in (shard.session_path + ".journal", shard.session_path + ".snapshot"):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def health(self):
+        """ :return: dict of shard id to the state of its worker """
+        now = time.monotonic()
+        return {shard_id: {"up": shard.alive(),
+                           "pid": shard.process.pid if shard.process else None,
+                           "restarts": max(0, shard.starts - 1),
+                           "cycles": shard.status.get("cycles", 0),
+                           "markets": shard.status.get("markets", 0),
+                           "report_age": now - shard.last_report if shard.last_report is not None else None}
+                for shard_id, shard in self.shards.items()}
+
+    def update_metrics(self):
+        """ Publishes the health of the shards and the latest metrics of their workers in METRICS. """
+        metrics = Metrics()
+        for shard_id, health in self.health().items():
+            metrics.set("bctbot_shard_up", int(health["up"]), shard=shard_id)
+            metrics.set("bctbot_shard_restarts", health["restarts"], shard=shard_id)
+            metrics.set("bctbot_shard_cycles", health["cycles"], shard=shard_id)
+            metrics.set("bctbot_shard_markets", health["markets"], shard=shard_id)
+            if health["report_age"] is not None:
+                metrics.set("bctbot_shard_report_age_seconds", health["report_age"], shard=shard_id)
+            snapshot = self.shards[shard_id].status.get("metrics")
+            if snapshot:
+                metrics.merge(snapshot, shard=shard_id)
+        METRICS.replace(metrics)
@@ -0,0 +1,286 @@
+""" Records the requests the bot makes to an exchange on a tape, and replays tapes without network.
+
+A TapeRecorder attached to an Exchange (see TradingBot.record_tapes) writes down every call of the ccxt unified API
+the bot makes, from the loop, the strategies or the async engine: its arguments, its response or error, when it
+started and how long it took. The end of every cycle is marked as well. A tape is a gzip compressed stream of
+msgpack records, written as the calls happen, so the tape of a bot that crashed can still be replayed up to its
+last cycle. It starts with a header holding the markets and the settings (without credentials) of the exchange
+when the recording started:
+    {"version": 1, "exchange": <name>, "id": <ccxt id>, "has": {...}, "markets": {...}, "currencies": {...},
+     "settings": <Exchange.serialize()>, "start": <ms>}
+followed by [CALL, offset s, duration s, endpoint, args, kwargs, error or None, packed response] and
+[CYCLE, offset s] records.
+
+replay(file_path) registers a TapeExchange under the name of the recorded exchange, so a TradingBot built from
+tape.settings trades on it. Every call gets the next recorded response to the same request, or to the same
+endpoint if the arguments differ (like the symbols of a batch of tickers in another order), and recorded errors
+are raised again. Replayed calls return right away, or after their recorded duration divided by speed. The clock
+of a replayed exchange (milliseconds()) is the time the last replayed call was recorded at.
+"""
+import asyncio
+import collections
+import copy
+import gzip
+import threading
+import time
+
+import ccxt
+import ccxt.async_support as ccxt_async
+import msgpack
+from ccxt.base.errors import ExchangeError
+
+from exchange import Exchange
+from snapshot import default
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+TAPE_VERSION = 1
+CALL, CYCLE = 0, 1
+# The markets are in the header, which keeps tapes of exchanges with thousands of markets small
+UNRECORDED = {"load_markets"}
+CREDENTIALS = ("apiKey", "secret", "password", "uid", "privateKey")
+ENDPOINTS = ("fetch_balance", "fetch_ticker", "fetch_tickers", "fetch_open_orders", "fetch_orders", "fetch_order",
+             "fetch_my_trades", "create_order", "cancel_order", "create_orders", "cancel_orders", "cancel_all_orders")
+
+
+class TapeExhausted(Exception):
+    """ Raised when the bot makes a call the tape has no (more) recordings of. Not an ExchangeError, so a replay
+    that went off the tape stops instead of being retried or logged away. """
+
+
+def pack(value):
+    return msgpack.packb(value, use_bin_type=True, default=default)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def header(exch_name, exchange, start):
+    settings = exchange.serialize()
+    settings["ccxt_config"] = {key: value for key, value in settings["ccxt_config"].items() if key not in CREDENTIALS}
+    return {"version": TAPE_VERSION, "exchange": exch_name, "id": exchange.id,
+            "has": {feature: value for feature, value in exchange.has.items() if value},
+            "markets": exchange.markets, "currencies": exchange.currencies, "settings": settings,
+            "start": int(start * 1000)}
+
+
+def read(file_path):
+    """ :return: list of the records of the tape at file_path, up to the last complete one if the recording was
+        cut off
+    :raise ValueError: if the file isn't a tape of a known version
+    """
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=2 ** 31 - 1)
+    records = []
+    with gzip.open(file_path, "rb") as f:
+        while True:
+            try:
+                chunk = f.read1(1 << 16)
+            except (EOFError, OSError) as e:
+                logger.warning(f"The tape {file_path} was cut off, replaying it up to there: {e!r}")
+                chunk = b""
+            if not chunk:
+                break
+            unpacker.feed(chunk)
+            records.extend(unpacker)
+    if not records or not isinstance(records[0], dict) or records[0].get("version") != TAPE_VERSION:
+        raise ValueError(f"{file_path} isn't a tape of version {TAPE_VERSION}")
+    return records
+
+
+class TapeRecorder:
+    """ Writes the calls to an exchange on a tape. Calls may come from several threads at once. """
+
+    def __init__(self, file_path, exch_name, exchange):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.calls = 0
+        self.cycles = 0
+        self.file = gzip.open(file_path, "wb", compresslevel=6)
+        self.file.write(pack(header(exch_name, exchange, self.start)))
+
+    def record(self, endpoint, args, kwargs, duration, response=None, error=None):
+        if endpoint in UNRECORDED:
+            return
+        offset = time.time() - self.start - duration
+        error = None if error is None else [error.__class__.__name__, str(error)]
+        try:
+            data = pack([CALL, offset, duration, endpoint, args, kwargs, error, pack(response)])
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Can't record the {endpoint} response on {self.file_path}: {e!r}")
+            return
+        with self.lock:
+            self.file.write(data)
+            self.calls += 1
+
+    def cycle_done(self):
+        """ Marks the end of a cycle and flushes the tape, so it can be replayed up to here. """
+        with self.lock:
+            self.file.write(pack([CYCLE, time.time() - self.start]))
+            self.cycles += 1
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info(f"Recorded {self.calls} calls in {self.cycles} cycles on {self.file_path}")
+
+
+class TapeCall:
+    """ A recorded call served by a Tape: the delay to replay it with, and its response or error. """
+
+    def __init__(self, delay, response, error):
+        self.delay = delay
+        self.response = response
+        self.error = error
+
+    def result(self):
+        """ :return: a fresh copy of the recorded response
+        :raise: the recorded error, as the ccxt error class of the same name if there is one
+        """
+        if self.error is not None:
+            name, message = self.error
+            error_class = getattr(ccxt, name, None)
+            if not isinstance(error_class, type) or not issubclass(error_class, Exception):
+                error_class = ExchangeError
+            raise error_class(message)
+        return unpack(self.response)
+
+
+class Tape:
+    """ The calls recorded on a tape, served in the order they were recorded. """
+
+    def __init__(self, file_path, speed=None):
+        """
+
+        :param file_path: tape written by a TapeRecorder
+        :param speed: None to replay calls without delay, otherwise the factor to divide recorded durations by
+        """
+        records = read(file_path)
+        self.file_path = file_path
+        self.header = records[0]
+        self.exchange = self.header["exchange"]
+        self.settings = self.header["settings"]
+        self.speed = speed
+        self.calls = [record for record in records[1:] if record[0] == CALL]
+        self.cycles = sum(1 for record in records[1:] if record[0] == CYCLE)
+        self.lock = threading.Lock()
+        self.rewind()
+
+    @staticmethod
+    def request_key(endpoint, args, kwargs):
+        try:
+            return pack([endpoint, args, kwargs or {}])
+        except (TypeError, ValueError):
+            return None
+
+    def rewind(self):
+        """ Serves the tape from its beginning again. """
+        self.by_request = collections.defaultdict(collections.deque)
+        self.by_endpoint = collections.defaultdict(collections.deque)
+        for index, (_, _, _, endpoint, args, kwargs, _, _) in enumerate(self.calls):
+            self.by_request[self.request_key(endpoint, args, kwargs)].append(index)
+            self.by_endpoint[endpoint].append(index)
+        self.served = [False] * len(self.calls)
+        self.served_calls = 0
+        self.mismatches = 0         # Calls served with the recording of another request to the same endpoint
+        self.clock = self.header["start"]
+
+    def next_unserved(self, indices):
+        while indices and self.served[indices[0]]:
+            indices.popleft()
+        return indices.popleft() if indices else None
+
+    def serve(self, endpoint, args, kwargs):
+        """ :return: TapeCall of the next recording of the request
+        :raise TapeExhausted: if the tape has no more recordings of calls to endpoint
+        """
+        key = self.request_key(endpoint, args, kwargs)
+        with self.lock:
+            index = self.next_unserved(self.by_request.get(key, collections.deque()))
+            if index is None:
+                index = self.next_unserved(self.by_endpoint.get(endpoint, collections.deque()))
+                if index is None:
+                    raise TapeExhausted(f"The tape {self.file_path} has no more {endpoint} calls")
+                self.mismatches += 1
+            self.served[index] = True
+            self.served_calls += 1
+            _, offset, duration, _, _, _, error, response = self.calls[index]
+            self.clock = max(self.clock, self.header["start"] + int((offset + duration) * 1000))
+        return TapeCall(duration / self.speed if self.speed else 0, response, error)
+
+    def prices(self):
+        """ :return: dict of symbol to the last prices of its tickers, in the order they were recorded """
+        prices = collections.defaultdict(list)
+        for _, _, _, endpoint, args, _, error, response in self.calls:
+            if error is not None or endpoint not in ("fetch_ticker", "fetch_tickers"):
+                continue
+            response = unpack(response)
+            tickers = {args[0]: response} if endpoint == "fetch_ticker" else response
+            for symbol, ticker in tickers.items():
+                if ticker.get("last") is not None:
+                    prices[symbol].append(ticker["last"])
+        return dict(prices)
+
+
+def replayed(endpoint):
+    def call(self, *args, **kwargs):
+        tape_call = self.tape.serve(endpoint, args, kwargs)
+        if tape_call.delay:
+            time.sleep(tape_call.delay)
+        return tape_call.result()
+    call.__name__ = endpoint
+    return call
+
+
+def replayed_async(endpoint):
+    async def call(self, *args, **kwargs):
+        tape_call = self.tape.serve(endpoint, args, kwargs)
+        if tape_call.delay:
+            await asyncio.sleep(tape_call.delay)
+        return tape_call.result()
+    call.__name__ = endpoint
+    return call
+
+
+class TapeReplay:
+    """ The parts of TapeExchange shared by its synchronous and async variants. """
+    tape = None         # Tape served, set on the classes replay registers
+
+    def describe(self):
+        return self.deep_extend(super().describe(), {"id": self.tape.header["id"], "has": self.tape.header["has"]})
+
+    def load_markets(self, reload=False, params={}):
+        self.set_markets(copy.deepcopy(self.tape.header["markets"]), copy.deepcopy(self.tape.header["currencies"]))
+        return self.markets
+
+    def milliseconds(self):
+        return self.tape.clock
+
+
+class TapeExchange(TapeReplay, ccxt.Exchange):
+    pass
+
+
+class AsyncTapeExchange(TapeReplay, ccxt_async.Exchange):
+
+    async def load_markets(self, reload=False, params={}):
+        return TapeReplay.load_markets(self, reload, params)
+
+
+for endpoint in ENDPOINTS:
+    setattr(TapeExchange, endpoint, replayed(endpoint))
+    setattr(AsyncTapeExchange, endpoint, replayed_async(endpoint))
+
+
+def replay(file_path, speed=None):
+    """ Registers the exchange recorded on the tape at file_path as a backend under the name it was recorded with.
+
+    :return: the Tape, whose settings initialize the exchange in a TradingBot
+    """
+    tape = Tape(file_path, speed)
+    Exchange.register_backend(tape.exchange, type("TapeExchange", (TapeExchange,), {"tape": tape}),
+                              type("AsyncTapeExchange", (AsyncTapeExchange,), {"tape": tape}))
+    return tape
@@ -0,0 +1,187 @@
+""" Changes to the config file applied by the ConfigWatcher while the bot runs, on paper exchanges. """
+import json
+import os
+
+import pytest
+
+from exchange import Exchange
+from paper_exchange import PaperExchange
+from tradingbot import TradingBot
+
+STRATEGY = {"total_buy_cost": 1, "buy_price_1": 0.9, "buy_amount_percentage_1": 1, "sell_price_1": 1.2,
+            "sell_amount_percentage_1": 1}
+NAME = "range_account_building_1"
+
+
+def paper(*symbols):
+    return {"ccxt_config": {"symbols": ["A/ETH", "B/ETH", "C/ETH"], "initial_balance": {"ETH": 10}},
+            "traded_markets": {symbol: {"strategies": {NAME: dict(STRATEGY)}} for symbol in symbols}}
+
+
+@pytest.fixture
+def bot(tmp_path):
+    Exchange.register_backend("paper", PaperExchange)
+    Exchange.register_backend("paper_2", PaperExchange)
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"paper": paper("A/ETH", "B/ETH")}))
+    bot = TradingBot(config_file_path=str(path))
+    bot.load_session()
+    return bot
+
+
+def edit(bot, change):
+    """ Edits the config file as it is now, the way a user would, and has the watcher apply it. """
+    with open(bot.config_file_path) as f:
+        config = json.load(f)
+    change(config)
+    with open(bot.config_file_path, "w") as f:
+        json.dump(config, f)
+    # Coarse file system clocks may not tell the edit from the last write
+    stat = os.stat(bot.config_file_path)
+    os.utime(bot.config_file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    return bot.config_watcher.check()
+
+
+def config_file(bot):
+    with open(bot.config_file_path) as f:
+        return json.load(f)
+
+
+def buy(bot, symbol):
+    """ Has the strategy of a market place its buy order. """
+    market = bot.exchanges["paper"].traded_markets[symbol]
+    market.add_price(0.85)
+    market.update_balance()
+    market.dispatch_balance_event()
+    market.dispatch_price_event()
+    return market.strategies[NAME]
+
+
+def test_exchanges_are_added_removed_and_rebuilt(bot):
+    exchange = bot.exchanges["paper"]
+    assert edit(bot, lambda config: config.update(paper_2=paper("C/ETH")))
+    assert bot.config_watcher.counts == {"exchanges added": 1}
+    assert list(bot.exchanges["paper_2"].traded_markets) == ["C/ETH"]
+    assert bot.exchanges["paper"] is exchange
+    strategy = buy(bot, "A/ETH")
+    assert edit(bot, lambda config: config["paper"].update(tickers_per_request=7))
+    assert bot.config_watcher.counts == {"exchanges rebuilt": 1}
+    rebuilt = bot.exchanges["paper"]
+    assert rebuilt is not exchange and rebuilt.tickers_per_request == 7
+    assert set(rebuilt.traded_markets) == {"A/ETH", "B/ETH"}
+    # The markets and orders carry over to the new exchange
+    assert rebuilt.api_calls["load_markets"] == 0
+    assert rebuilt.traded_markets["A/ETH"].strategies[NAME].state == strategy.state
+    assert list(rebuilt.order_store.orders) == list(exchange.order_store.orders)
+    assert edit(bot, lambda config: config.pop("paper_2"))
+    assert bot.config_watcher.counts == {"exchanges removed": 1}
+    assert list(bot.exchanges) == ["paper"]
+    assert "paper_2" not in config_file(bot)
+
+
+def test_markets_are_added_removed_and_rebuilt(bot):
+    exchange = bot.exchanges["paper"]
+    market_b = exchange.traded_markets["B/ETH"]
+    strategy = buy(bot, "A/ETH")
+
+    def change(config):
+        markets = config["paper"]["traded_markets"]
+        markets["A/ETH"]["price_history_size"] = 500
+        markets["C/ETH"] = {"strategies": {NAME: dict(STRATEGY)}}
+        del markets["B/ETH"]
+
+    assert edit(bot, change)
+    assert bot.config_watcher.counts == {"markets removed": 1, "markets rebuilt": 1, "markets added": 1}
+    assert bot.exchanges["paper"] is exchange
+    assert set(exchange.traded_markets) == {"A/ETH", "C/ETH"}
+    assert set(bot.scheduler.schedules["paper"]) == {"A/ETH", "C/ETH"}
+    assert market_b not in exchange.balance_tracker.markets["ETH"]
+    market_a = exchange.traded_markets["A/ETH"]
+    assert market_a.price_history_size == 500
+    # The rebuilt market keeps its prices and the state and orders of its strategy
+    assert len(market_a.prices) == 1
+    rebuilt = market_a.strategies[NAME]
+    assert rebuilt is not strategy and rebuilt.state == strategy.state
+    assert [order.id for order in rebuilt.orders.select(status="open")] == \
+           [order.id for order in strategy.orders.select(status="open")]
+
+
+def test_strategies_are_added_removed_and_rebuilt(bot):
+    exchange = bot.exchanges["paper"]
+    market_a, market_b = exchange.traded_markets["A/ETH"], exchange.traded_markets["B/ETH"]
+    strategy = buy(bot, "A/ETH")
+    open_orders = [order.id for order in strategy.orders.select(status="open")]
+
+    def change(config):
+        markets = config["paper"]["traded_markets"]
+        markets["A/ETH"]["strategies"][NAME]["total_buy_cost"] = 2
+        markets["B/ETH"]["strategies"]["range_account_building_2"] = dict(STRATEGY)
+
+    assert edit(bot, change)
+    assert bot.config_watcher.counts == {"strategies rebuilt": 1, "strategies added": 1}
+    # Changing a strategy doesn't rebuild its market
+    assert exchange.traded_markets["A/ETH"] is market_a and exchange.traded_markets["B/ETH"] is market_b
+    rebuilt = market_a.strategies[NAME]
+    assert rebuilt is not strategy and rebuilt.state == strategy.state
+    assert set(market_b.strategies) == {NAME, "range_account_building_2"}
+    assert edit(bot, lambda config: config["paper"]["traded_markets"]["A/ETH"]["strategies"].pop(NAME))
+    assert bot.config_watcher.counts == {"strategies removed": 1}
+    assert market_a.strategies == {}
+    # Its orders stay on the exchange, the bot no longer follows them
+    assert all(exchange.order_store.get(id) is None for id in open_orders)
+    assert exchange.fetch_order(open_orders[0], "A/ETH")["status"] == "open"
+
+
+def test_a_market_that_fails_to_rebuild_keeps_trading(bot):
+    exchange = bot.exchanges["paper"]
+    market = exchange.traded_markets["A/ETH"]
+    strategy = buy(bot, "A/ETH")
+    applied = bot.session_store.config
+
+    def change(config):
+        markets = config["paper"]["traded_markets"]
+        markets["A/ETH"]["feed"] = {"type": "websockt"}
+        markets["B/ETH"]["strategies"][NAME]["total_buy_cost"] = 2
+
+    assert edit(bot, change)
+    assert bot.config_watcher.failures == 1
+    assert exchange.traded_markets["A/ETH"] is market and market.strategies[NAME] is strategy
+    assert exchange.traded_markets_settings["A/ETH"] is not None
+    assert set(bot.scheduler.schedules["paper"]) == {"A/ETH", "B/ETH"}
+    # The other changes are applied, the file isn't rewritten with the bot's state
+    assert bot.config_watcher.counts == {"strategies rebuilt": 1}
+    assert config_file(bot)["paper"]["traded_markets"]["A/ETH"]["feed"] == {"type": "websockt"}
+    assert bot.session_store.config == applied
+    # Once fixed the edit is applied against the config last applied
+    assert edit(bot, lambda config: config["paper"]["traded_markets"]["A/ETH"].update(feed={"type": "rest"}))
+    assert bot.config_watcher.failures == 0
+    assert exchange.traded_markets["A/ETH"] is not market
+    assert exchange.traded_markets["A/ETH"].strategies[NAME].state == strategy.state
+    assert config_file(bot)["paper"]["traded_markets"]["A/ETH"]["feed"] == {"type": "rest"}
+
+
+def test_an_exchange_that_fails_to_rebuild_keeps_trading(bot):
+    exchange = bot.exchanges["paper"]
+
+    def change(config):
+        config["paper"]["tickers_per_request"] = 7
+        config["paper"]["traded_markets"]["A/ETH"]["feed"] = {"type": "websockt"}
+
+    assert edit(bot, change)
+    assert bot.config_watcher.failures == 1
+    assert bot.exchanges["paper"] is exchange
+    assert set(exchange.traded_markets) == {"A/ETH", "B/ETH"}
+    assert "paper" in bot.scheduler.schedules
+    assert set(config_file(bot)["paper"]["traded_markets"]) == {"A/ETH", "B/ETH"}
+
+
+def test_an_edit_after_a_compaction_only_applies_what_it_changes(bot):
+    # The first checkpoint writes the defaulted settings the sparse config left out, the edit comes before the
+    # watcher checks the file again
+    bot.session_store.compact(bot)
+    exchange = bot.exchanges["paper"]
+    market = exchange.traded_markets["A/ETH"]
+    assert edit(bot, lambda config: config["paper"]["traded_markets"]["A/ETH"]["strategies"][NAME].update(
+        total_buy_cost=2))
+    assert bot.config_watcher.counts == {"strategies rebuilt": 1}
+    assert bot.exchanges["paper"] is exchange and exchange.traded_markets["A/ETH"] is market
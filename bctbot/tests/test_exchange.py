@@ -0,0 +1,29 @@
+""" Loading the markets of an Exchange from its cache and refreshing them. """
+import pytest
+
+from exchange import Exchange
+from simulated_exchange import SimulatedExchange
+
+
+@pytest.fixture
+def settings(tmp_path):
+    Exchange.register_backend("simulated_markets", SimulatedExchange)
+    return {"ccxt_config": {"markets_count": 3},
+            "market_cache": {"enabled": True, "folder": str(tmp_path), "ttl": 0},
+            "traded_markets": {"C0/ETH": {}}}
+
+
+def test_stale_markets_are_swapped_in_between_cycles(settings):
+    Exchange("simulated_markets", settings)         # Caches the markets, which are stale right away
+    exchange = Exchange("simulated_markets", settings)
+    markets = exchange.markets
+    exchange.refresh_thread.join()
+    # The download doesn't touch the markets trading goes on with
+    assert exchange.refreshed_markets is not None
+    assert exchange.markets is markets
+    exchange.add_market("C1/ETH", {})
+    exchange.apply_refreshed_markets()
+    # The markets are filtered when they are swapped in, not when they were downloaded
+    assert set(exchange.markets) == {"C0/ETH", "C1/ETH"}
+    assert exchange.refreshed_markets is None
+    assert exchange.market("C1/ETH")["id"] == "C1-ETH"
@@ -0,0 +1,71 @@
+""" Runs WebSocketFeed against the MockFeedServer, offline. """
+import socket
+import time
+
+import pytest
+
+from exchange import Exchange
+from simulated_exchange import SimulatedExchange
+from ws_mock_server import MockFeedServer
+
+SYMBOL = "C0/ETH"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the feed")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    server = MockFeedServer(port=free_port(), interval=0.02)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def market(server):
+    Exchange.register_backend("simulated_feed", SimulatedExchange)
+    settings = {
+        "ccxt_config": {"markets_count": 1},
+        "traded_markets": {SYMBOL: {"feed": {"type": "websocket", "url": f"ws://localhost:{server.port}",
+                                             "reconnect_delay": 0.05}}}
+    }
+    market = Exchange("simulated_feed", settings).traded_markets[SYMBOL]
+    market.feed.start(market)
+    yield market
+    market.feed.stop()
+
+
+def test_streams_prices_and_book_into_market(server, market):
+    wait_until(lambda: market.feed.live and market.bid is not None and market.prices_added >= 3)
+    # The first price is the resync over REST, the ones after it came from the stream
+    assert market.exchange.api_calls["fetch_ticker"] == 1
+    assert market.bid < market.ask
+    assert market.bid == pytest.approx(market.last_price, rel=0.02)
+
+
+def test_reconnects_and_resyncs_over_rest(server, market):
+    wait_until(lambda: market.feed.live and market.prices_added >= 2)
+    server.drop_connections()
+    wait_until(lambda: market.feed.reconnects == 1 and market.feed.live)
+    wait_until(lambda: market.exchange.api_calls["fetch_ticker"] == 2)
+    added = market.prices_added
+    wait_until(lambda: market.prices_added > added + 1)
+
+
+def test_not_live_while_server_is_down(server, market):
+    wait_until(lambda: market.feed.live)
+    server.stop()
+    # The loop polls the ticker over REST while the feed keeps trying to reconnect
+    wait_until(lambda: not market.feed.live and market.feed.reconnects >= 1)
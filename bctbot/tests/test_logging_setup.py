@@ -0,0 +1,18 @@
+""" Checks that the log records of every module of the bot reach the log files. """
+import glob
+import os
+
+import logging_setup
+
+BOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# logging_setup logs through the root logger, run_bot.py as __main__
+UNCONFIGURED = {"logging_setup", "run_bot"}
+
+
+def test_every_module_logger_is_configured():
+    modules = set()
+    for file_path in glob.glob(os.path.join(BOT_FOLDER, "*.py")):
+        with open(file_path, encoding="utf-8") as f:
+            if "getLogger(__name__)" in f.read():
+                modules.add(os.path.splitext(os.path.basename(file_path))[0])
+    assert modules - UNCONFIGURED - set(logging_setup.LOGGING_CONFIG["loggers"]) == set()
@@ -0,0 +1,218 @@
+""" Fill accounting of the OrderStore and Order.take_fills, against an exchange faked in memory. """
+from collections import Counter
+
+import pytest
+
+from order import Order
+from order_store import OrderStore
+
+SYMBOL = "ADB/ETH"
+
+
+class FakeExchange:
+    """ The endpoints the order store uses, serving the trades and orders the test sets up. """
+    id = "fake"
+
+    def __init__(self, has=None):
+        self.has = has if has is not None else {"fetchMyTrades": True, "fetchOrder": True}
+        self.api_calls = Counter()
+        self.trades = []
+        self.orders = {}            # Id -> ccxt order structure
+        self.order_store = None
+
+    def order(self, id, amount, price, status="open", timestamp=1000, filled=0, cost=0):
+        self.orders[id] = {"id": id, "symbol": SYMBOL, "amount": amount, "price": price, "status": status,
+                           "timestamp": timestamp, "filled": filled, "cost": cost, "fee": None}
+
+    def trade(self, id, order, amount, price, timestamp, fee=None):
+        self.trades.append({"id": id, "order": order, "amount": amount, "price": price, "cost": amount * price,
+                            "timestamp": timestamp, "fee": fee})
+
+    def fetch_my_trades(self, symbol, since=None, limit=None):
+        self.api_calls["fetch_my_trades"] += 1
+        trades = sorted((trade for trade in self.trades if since is None or trade["timestamp"] >= since),
+                        key=lambda trade: trade["timestamp"])
+        return trades[:limit] if limit else trades
+
+    def fetch_orders(self, symbol, since=None):
+        self.api_calls["fetch_orders"] += 1
+        return [dict(order) for order in self.orders.values() if since is None or order["timestamp"] >= since]
+
+    def fetch_order(self, id, symbol):
+        self.api_calls["fetch_order"] += 1
+        return dict(self.orders[id])
+
+    def fetch_open_orders(self, symbol):
+        self.api_calls["fetch_open_orders"] += 1
+        return [dict(order) for order in self.orders.values() if order["status"] == "open"]
+
+
+class FakeMarket:
+    """ The open orders snapshot of a Market and its fills, fetched once until invalidated. """
+    symbol = SYMBOL
+    base, quote = SYMBOL.split("/")
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.open_orders_by_id = None
+        self.orders_outdated = True
+
+    def fetch_open_orders(self):
+        if self.open_orders_by_id is None:
+            self.open_orders_by_id = {order["id"]: order for order in self.exchange.fetch_open_orders(self.symbol)}
+
+    def order_is_open(self, order_id):
+        self.fetch_open_orders()
+        return order_id in self.open_orders_by_id
+
+    def invalidate_open_orders(self):
+        self.open_orders_by_id = None
+        self.orders_outdated = True
+
+    def refresh_orders(self):
+        if self.orders_outdated:
+            self.orders_outdated = False
+            self.exchange.order_store.refresh(self)
+
+
+def setup(source=None, trades_per_request=None, has=None):
+    exchange = FakeExchange(has)
+    exchange.order_store = OrderStore(exchange, source, trades_per_request)
+    return exchange, FakeMarket(exchange)
+
+
+def place(exchange, market, id, side="buy", amount=10, price=1.0, **kwargs):
+    exchange.order(id, amount, price)
+    return Order(exchange, market, side, "limit", price, amount=amount, id=id, status="open", timestamp=1000,
+                 **kwargs)
+
+
+def next_cycle(exchange, market):
+    market.invalidate_open_orders()
+    exchange.api_calls.clear()
+
+
+def test_partial_fills_are_taken_once():
+    exchange, market = setup()
+    order = place(exchange, market, "o1")
+    exchange.trade("t1", "o1", 4, 1.0, 1001)
+    assert order.take_fills() == (4, 4.0)
+    assert order.status == "open"
+    # The store caught up once this cycle, the same fills aren't taken again
+    assert order.take_fills() == (0, 0)
+    next_cycle(exchange, market)
+    exchange.trade("t2", "o1", 6, 0.9, 1002)
+    amount, cost = order.take_fills()
+    assert amount == pytest.approx(6) and cost == pytest.approx(5.4)
+    assert order.status == "filled"
+    assert order.average == pytest.approx(0.94)
+    assert exchange.order_store.get("o1") is None
+
+
+def test_fees_in_the_base_currency_reduce_the_amount_bought():
+    exchange, market = setup()
+    buy = place(exchange, market, "b1")
+    sell = place(exchange, market, "s1", side="sell", amount=5, price=2.0)
+    exchange.trade("t1", "b1", 10, 1.0, 1001, fee={"currency": "ADB", "cost": 0.01})
+    exchange.trade("t2", "s1", 5, 2.0, 1001, fee={"currency": "ETH", "cost": 0.01})
+    assert buy.take_fills() == (pytest.approx(9.99), 10.0)
+    assert buy.fees == {"ADB": 0.01}
+    # Fees in the quote currency don't change the amount sold
+    assert sell.take_fills() == (5, 10.0)
+
+
+def test_settled_fills_survive_a_restart():
+    exchange, market = setup()
+    order = place(exchange, market, "o1")
+    exchange.trade("t1", "o1", 4, 1.0, 1001)
+    assert order.take_fills() == (4, 4.0)
+    saved = {field: getattr(order, field) for field in Order.FIELDS if field not in ("cost", "initial_cost")}
+    # A new store rebuilds the fills from the trades, only what came after the last take is new
+    exchange.trade("t2", "o1", 3, 1.0, 1002)
+    exchange.order_store = OrderStore(exchange)
+    market.invalidate_open_orders()
+    restarted = Order(exchange, market, amount=10, **saved)
+    assert restarted.take_fills() == (3, 3.0)
+    assert restarted.filled == 7
+
+
+def test_trades_are_paged_from_the_cursor():
+    exchange, market = setup(trades_per_request=2)
+    order = place(exchange, market, "o1")
+    for i in range(5):
+        exchange.trade(f"t{i}", "o1", 1, 1.0, 1001 + i)
+    assert order.take_fills() == (5, 5.0)
+    # since is inclusive, every page starts with the last trade of the page before
+    assert exchange.api_calls["fetch_my_trades"] == 5
+    assert exchange.order_store.cursors[SYMBOL] == 1005
+    next_cycle(exchange, market)
+    exchange.trade("t5", "o1", 1, 1.0, 1006)
+    assert order.take_fills() == (1, 1.0)
+    # From the last trade seen on, which with the new one fills a page, so the next page is asked for as well
+    assert exchange.api_calls["fetch_my_trades"] == 2
+
+
+def test_a_full_page_of_one_timestamp_ends_the_paging():
+    exchange, market = setup(trades_per_request=2)
+    order = place(exchange, market, "o1")
+    for i in range(3):
+        exchange.trade(f"t{i}", "o1", 1, 1.0, 1001)
+    order.take_fills()
+    assert exchange.api_calls["fetch_my_trades"] == 2
+
+
+@pytest.mark.parametrize("status", ["canceled", "expired"])
+def test_orders_closed_by_the_exchange_are_noticed_from_trades(status):
+    exchange, market = setup()
+    order = place(exchange, market, "o1", side="sell")
+    exchange.trade("t1", "o1", 2, 1.0, 1001)
+    assert order.take_fills() == (2, 2.0)
+    next_cycle(exchange, market)
+    exchange.orders["o1"].update(status=status, filled=2, cost=2.0)
+    order.take_fills()
+    assert order.status == "canceled"
+    assert order.filled == 2
+    assert exchange.api_calls["fetch_order"] == 1
+    assert exchange.order_store.get("o1") is None
+
+
+def test_only_orders_that_left_the_open_orders_are_looked_up():
+    exchange, market = setup()
+    orders = [place(exchange, market, f"o{i}") for i in range(3)]
+    for order in orders:
+        order.take_fills()
+    assert exchange.api_calls["fetch_order"] == 0
+    next_cycle(exchange, market)
+    exchange.orders["o1"]["status"] = "canceled"
+    for order in orders:
+        order.take_fills()
+    assert [order.status for order in orders] == ["open", "canceled", "open"]
+    assert exchange.api_calls == {"fetch_open_orders": 1, "fetch_my_trades": 1, "fetch_order": 1}
+
+
+def test_orders_filled_after_the_snapshot_are_not_taken_as_canceled():
+    exchange, market = setup(has={"fetchMyTrades": True})
+    order = place(exchange, market, "o1")
+    market.fetch_open_orders()
+    exchange.orders["o1"]["status"] = "closed"
+    exchange.trade("t1", "o1", 10, 1.0, 1001)
+    assert order.take_fills() == (10, 10.0)
+    assert order.status == "filled"
+
+
+def test_without_fetch_order_orders_gone_without_trades_are_canceled():
+    exchange, market = setup(has={"fetchMyTrades": True})
+    order = place(exchange, market, "o1")
+    exchange.orders["o1"]["status"] = "canceled"
+    assert order.take_fills() == (0, 0)
+    assert order.status == "canceled"
+
+
+def test_orders_source_takes_over_the_order_structure():
+    exchange, market = setup("orders")
+    order = place(exchange, market, "o1")
+    exchange.orders["o1"].update(status="closed", filled=10, cost=9.5, fee={"currency": "ADB", "cost": 0.1})
+    amount, cost = order.take_fills()
+    assert amount == pytest.approx(9.9) and cost == 9.5
+    assert order.status == "filled"
+    assert exchange.api_calls["fetch_orders"] == 1
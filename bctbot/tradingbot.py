@@ -1,66 +1,231 @@
 from superjson import json
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from ccxt.base.errors import ExchangeError
+from async_engine import AsyncTradingEngine
+from config_watcher import ConfigWatcher
 from exchange import Exchange
+from metrics import PhaseTimer
+from profiler import SamplingProfiler
+from scheduler import Scheduler
+from session_store import SessionStore
+from tape import TapeRecorder
+from utils import atomic_write
 
 import logging_setup
+from logging_setup import Lazy
 logger = logging_setup.logging.getLogger(__name__)
 
 class TradingBot:
 
-    def __init__(self, bot_settings=None):
-        logger.info(f"Initializing Tradingbot with the following settings: {bot_settings}")
-        self.config_file_path = "trading_bot_config.json"
+    def __init__(self, bot_settings=None, config_file_path="trading_bot_config.json", snapshot_format="json"):
+        # The settings hold the histories of every market, too much to log
+        logger.info("Initializing Tradingbot, traded markets per exchange: %s",
+                    {exch_name: len(settings.get("traded_markets", {}))
+                     for exch_name, settings in (bot_settings or {}).items()})
+        self.config_file_path = config_file_path
+        self.session_store = SessionStore(self.config_file_path, snapshot_format=snapshot_format)
         self.cycles = 0
         self.LOOP_SLEEP = 10
         self.active = True
+        self.wake = threading.Event()
+        self.profiler = None
+        self.cycle_callbacks = []           # Called after every cycle, once the session is saved
+        self.feeds_running = False
+        self.config_watcher = None          # Applies changes to the config file while running, see load_session
+        self.tapes_folder = None            # Folder the calls to the exchanges are recorded to, see record_tapes
         self.bot_settings = {} if bot_settings is None else bot_settings
         self.exchanges = self.load_exchanges()
+        self.scheduler = Scheduler(self.exchanges, base_interval=self.LOOP_SLEEP)
 
     def load_exchanges(self):
+        """ Initializes the exchanges in parallel, as each may have to download its markets first. """
         if not self.bot_settings:
             return {}
-        exchanges = {}
-        for exch_name, settings in self.bot_settings.items():
-            exchanges[exch_name] = Exchange(exch_name, settings)
-        return exchanges
+        with ThreadPoolExecutor(max_workers=len(self.bot_settings)) as executor:
+            futures = {exch_name: executor.submit(Exchange, exch_name, settings)
+                       for exch_name, settings in self.bot_settings.items()}
+            return {exch_name: future.result() for exch_name, future in futures.items()}
 
     def loop(self):
-        logger.debug(self)
-        for exchange in self.exchanges.values():
+        """ Polls the markets that are due, then sleeps until the next market is due.
+
+        The time spent on every phase of the cycle goes to the bctbot_cycle_phase_seconds metric: fetching
+        balances and prices, running the strategies (including the orders they place), logging and checkpointing.
+        """
+        timer = PhaseTimer()
+        timer.phase("logging")
+        logger.debug("%s", self, extra={"sample": logging_setup.TICK_SAMPLE})
+        for exch_name, markets in self.scheduler.due().items():
+            exchange = self.exchanges[exch_name]
             try:
-                exchange.get_balance()
-                for market in exchange.traded_markets.values():
-                    market.update_balance()
-                    if market.balance_changed():
-                        for strategy in market.strategies:
-                            strategy.balance_change_event()
-                    market.update_ticker()
-                    if market.price_changed():
-                        for strategy in market.strategies:
-                            strategy.price_change_event()
+                timer.phase("balance")
+                exchange.poll_balance()
+                timer.phase("prices")
+                polled = {market.symbol for market in markets if not market.feed.live}
+                prices = exchange.fetch_traded_prices(polled) if polled else {}
+                for market in markets:
+                    timer.phase("strategies")
+                    with market.lock:
+                        market.invalidate_open_orders()
+                        market.update_balance()
+                        market.dispatch_balance_event()
+                        if market.symbol in polled:
+                            if market.symbol in prices:
+                                market.add_price(prices[market.symbol])
+                            else:
+                                timer.phase("prices")
+                                market.update_ticker()
+                                timer.phase("strategies")
+                            market.dispatch_price_event()
+                    self.scheduler.reschedule(exch_name, market)
             except ExchangeError as e:
                 logging_setup.logging.exception(str(e))
                 continue
-        self.save_session(self.config_file_path)
+        timer.phase("logging")
+        for exchange in self.exchanges.values():
+            logger.debug("API calls to %s so far: %s", exchange.id, Lazy(lambda: dict(exchange.api_calls)))
+            if exchange.rate_limiter is not None:
+                logger.debug("Rate limiter of %s: %s", exchange.id, Lazy(exchange.rate_limiter.metrics),
+                             extra={"sample": logging_setup.TICK_SAMPLE})
+        logger.debug("Polling metrics: %s", Lazy(self.scheduler.metrics),
+                     extra={"sample": logging_setup.TICK_SAMPLE})
+        timer.phase("checkpoint")
+        self.finish_cycle()
+        timer.stop()
+        self.wake.wait(self.scheduler.time_until_next())
+
+    def finish_cycle(self):
+        for exchange in self.exchanges.values():
+            exchange.apply_refreshed_markets()
+        if self.config_watcher is not None:
+            self.config_watcher.check()
+        self.checkpoint()
+        for exchange in self.exchanges.values():
+            if exchange.recorder is not None:
+                exchange.recorder.cycle_done()
         self.cycles += 1
-        time.sleep(self.LOOP_SLEEP)
+        if self.profiler is not None and self.profiler.cycle_done():
+            self.profiler = None
+        for callback in self.cycle_callbacks:
+            callback(self)
+
+    def run(self, mode="sync"):
+        """ Runs cycles until stopped, polling one call at a time (sync) or concurrently (async). """
+        if mode == "async":
+            AsyncTradingEngine(self).run_forever()
+            return
+        self.start_feeds()
+        try:
+            while self.active:
+                self.loop()
+        finally:
+            self.stop_feeds()
+
+    def stop(self):
+        """ Stops the bot after the current cycle, without waiting for the next one to be due. Safe to call from
+        other threads and signal handlers. """
+        self.active = False
+        self.wake.set()
+
+    def profile(self, cycles, output="log/profile.folded", interval=0.005):
+        """ Samples the thread calling this for the next cycles and writes the stacks to output for a flame graph. """
+        self.profiler = SamplingProfiler(output, cycles, interval)
+        self.profiler.start()
+
+    def record_tapes(self, folder):
+        """ Records the calls to every exchange from now on to <folder>/<exchange name>.tape, to replay them with
+        tape.replay. Exchanges added or rebuilt later are recorded to <exchange name>.<cycle>.tape from the cycle
+        they were added in. """
+        os.makedirs(folder, exist_ok=True)
+        self.tapes_folder = folder
+        for exch_name, exchange in self.exchanges.items():
+            self.start_recording(exch_name, exchange, f"{exch_name}.tape")
+
+    def start_recording(self, exch_name, exchange, file_name):
+        exchange.recorder = TapeRecorder(os.path.join(self.tapes_folder, file_name), exch_name, exchange)
+
+    def stop_recording(self):
+        for exchange in self.exchanges.values():
+            if exchange.recorder is not None:
+                exchange.recorder.close()
+                exchange.recorder = None
+        self.tapes_folder = None
+
+    def start_feeds(self):
+        self.feeds_running = True
+        for exchange in self.exchanges.values():
+            exchange.start_feeds()
+
+    def stop_feeds(self):
+        self.feeds_running = False
+        for exchange in self.exchanges.values():
+            exchange.stop_feeds()
+
+    def add_exchange(self, exch_name, settings, loaded_markets=None):
+        """ Starts trading on an exchange, replacing the Exchange trading on it so far once the new one is built: an
+        exchange that can't be built leaves the one trading untouched. """
+        exchange = Exchange(exch_name, settings, loaded_markets)
+        if exch_name in self.exchanges:
+            self.remove_exchange(exch_name)
+        self.exchanges[exch_name] = exchange
+        self.scheduler.add_exchange(exch_name, exchange)
+        if self.tapes_folder is not None:
+            self.start_recording(exch_name, exchange, f"{exch_name}.{self.cycles}.tape")
+        if self.feeds_running:
+            exchange.start_feeds()
+        return exchange
+
+    def remove_exchange(self, exch_name):
+        """ Stops trading on an exchange, its open orders stay on the exchange. """
+        exchange = self.exchanges.pop(exch_name)
+        self.scheduler.remove_exchange(exch_name)
+        exchange.shutdown()
+        if exchange.recorder is not None:
+            exchange.recorder.close()
+        return exchange
+
+    def add_market(self, exchange, symbol, market_settings):
+        market = exchange.add_market(symbol, market_settings)
+        self.scheduler.add_market(exchange.exchange_name, market)
+        if self.feeds_running:
+            market.feed.start(market)
+        return market
+
+    def remove_market(self, exchange, symbol):
+        self.scheduler.remove_market(exchange.exchange_name, symbol)
+        return exchange.remove_market(symbol)
+
+    def checkpoint(self):
+        """ Persists what changed in the session since the last checkpoint. """
+        self.session_store.save(self)
 
     def save_session(self, file_path=None):
-        # Copy the config that the bot was initialized with
+        """ Writes the full session as a single JSON file, e.g. to export it or to look into a binary session. """
         file_path = self.config_file_path if file_path is None else file_path
         logger.debug(f"Saving current session to {file_path}")
         session_settings = {}
         for exch_name, exchange in self.exchanges.items():
             session_settings[exch_name] = exchange.serialize()
-        json.dump(session_settings, file_path, pretty=True, overwrite=True)
+        atomic_write(file_path, json.dumps(session_settings, pretty=True))
 
     def load_session(self, file_path=None):
+        """ Loads the session from the config file and replays the changes journaled since. Changes made to the
+        config file from then on are applied at the end of every cycle. """
         file_path = self.config_file_path if file_path is None else file_path
         logger.debug(f"Loading session from {file_path}")
-        bot_settings = json.load(file_path)
-        self.__init__(bot_settings)
+        snapshot_format = self.session_store.snapshot_format
+        store = SessionStore(file_path, snapshot_format=snapshot_format)
+        bot_settings = store.load()
+        self.__init__(bot_settings, file_path, snapshot_format)
+        self.session_store.config = store.config
+        # A binary snapshot may be based on an older config file, changes made to it since are applied right away
+        if os.path.exists(file_path):
+            self.config_watcher = ConfigWatcher(self)
+            self.config_watcher.check()
 
     def __str__(self):
         exchanges = "\n  ".join([str(exchange) for exchange in self.exchanges.values()])
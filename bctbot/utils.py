@@ -1,7 +1,13 @@
+import asyncio
 import math
+import os
+import random
+import tempfile
 import time
 from functools import wraps
 
+from metrics import METRICS
+
 import logging_setup
 logger = logging_setup.logging.getLogger(__name__)
 
@@ -9,32 +15,100 @@ logger = logging_setup.logging.getLogger(__name__)
 class RetrySettings:
     tries = 10
     delay = 2
-    backoff = 1.5
+    backoff = 3
+    max_delay = 10
+    max_total_delay = 30
 
     class PersistentErrorAfterRetries(Exception):
         """Raised when api calls fail even after retries so that manual intervention is necessary"""
         pass
 
+    class CircuitOpen(PersistentErrorAfterRetries):
+        """Raised instead of calling the api while the circuit breaker of that exchange endpoint is open"""
+        pass
+
     @staticmethod
     def raise_retry_error(*args, **kwargs):
         raise RetrySettings.PersistentErrorAfterRetries
 
 
-def retry(exceptions, tries=RetrySettings.tries, delay=RetrySettings.delay, backoff=RetrySettings.backoff, logger=None,
-          on_fail=None):
+class CircuitBreaker:
+    """ Stops calling an exchange endpoint for a while after it failed too often in a row.
+
+    Closed: calls go through. After failure_threshold consecutive failures the breaker opens and calls fail
+    immediately. After reset_timeout seconds one trial call is let through (half open); it closes the breaker
+    when it succeeds and opens it again when it fails.
     """
-    Retry calling the decorated function using an exponential backoff.
 
-    Args:
-        exceptions: The exception to check. may be a tuple of
-            exceptions to check.
-        tries: Number of times to try (not retry) before giving up.
-        delay: Initial delay between retries in seconds.
-        backoff: Backoff multiplier (e.g. value of 2 will double the delay
-            each retry).
-        logger: Logger to use. If None, print.
+    failure_threshold = 5
+    reset_timeout = 60
+    breakers = {}       # (exchange id, endpoint[, symbol]) -> CircuitBreaker
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+
+    @classmethod
+    def get(cls, key):
+        if key not in cls.breakers:
+            cls.breakers[key] = cls(key)
+        return cls.breakers[key]
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit breaker {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.opened_at is None and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            logger.warning(f"Circuit breaker {self.name} opened after {self.failures} failures")
+
+
+def breaker_key(obj, f, *args):
+    """ Identifies the endpoint of a decorated method by the exchange it's called on and the method name, and by the
+    symbol for methods of a market or an order, so a failing market doesn't open the breaker of the others. """
+    exchange = getattr(obj, "exchange", obj)
+    key = (getattr(exchange, "exchange_name", getattr(exchange, "id", None)), f.__name__)
+    symbol = getattr(getattr(obj, "market", obj), "symbol", None)
+    return key + (symbol,) if isinstance(symbol, str) else key
+
+
+def count_retry(breaker):
+    exchange, function = breaker.name[:2]
+    METRICS.inc("bctbot_retries_total", exchange=exchange, function=function)
+
+
+def retry_delays(tries, delay, backoff, max_delay, max_total_delay):
+    """ Yields at most tries - 1 delays using decorrelated jitter.
+
+    Every delay is picked randomly between delay and backoff times the previous one, capped at max_delay.
+    Stops early when the delays would add up to more than max_total_delay.
     """
+    total, mdelay = 0, delay
+    for _ in range(tries - 1):
+        mdelay = min(max_delay, random.uniform(delay, mdelay * backoff))
+        if total + mdelay > max_total_delay:
+            return
+        total += mdelay
+        yield mdelay
+
 
+def validate_retry_settings(tries, delay, backoff):
     if backoff < 1:
         raise ValueError("backoff can't be less than 1")
     tries = math.floor(tries)
@@ -42,30 +116,121 @@ def retry(exceptions, tries=RetrySettings.tries, delay=RetrySettings.delay, back
         raise ValueError("tries must be 0 or greater")
     if delay < 0:
         raise ValueError("delay can't be less than 0")
+    return tries
+
+
+def retry(exceptions, tries=RetrySettings.tries, delay=RetrySettings.delay, backoff=RetrySettings.backoff, logger=None,
+          on_fail=None, max_delay=RetrySettings.max_delay, max_total_delay=RetrySettings.max_total_delay,
+          key=breaker_key):
+    """
+    Retry calling the decorated method using exponential backoff with decorrelated jitter, guarded by a
+    circuit breaker per exchange endpoint.
+
+    Args:
+        exceptions: The exception to check. may be a tuple of
+            exceptions to check.
+        tries: Number of times to try (not retry) before giving up.
+        delay: Minimum delay between retries in seconds.
+        backoff: Maximum multiplier of the previous delay for the next
+            (randomly picked) delay.
+        logger: Logger to use. If None, use the logger of this module.
+        on_fail: Called with the instance when all tries failed or the
+            circuit breaker is open. If None, try one last time.
+        max_delay: Maximum delay between two tries in seconds.
+        max_total_delay: Stop retrying when the delays would add up to more.
+        key: Function of (instance, method, *args) giving the circuit
+            breaker key.
+    """
+
+    tries = validate_retry_settings(tries, delay, backoff)
+    log = logger or logging_setup.logging.getLogger(__name__)
 
     def deco_retry(f):
 
         @wraps(f)
         def f_retry(self, *args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(self, *args, **kwargs)
-                except exceptions as e:
-                    msg = '{}, Retrying {} in {} seconds... ({} tries left out of {})'.format(e.__class__.__name__,
-                                                                                              f.__name__, mdelay,
-                                                                                              mtries - 1, tries)
-                    if logger:
-                        logger.warning(msg)
-                    else:
-                        print(msg)
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
+            breaker = CircuitBreaker.get(key(self, f, *args))
+            if breaker.allow():
+                for mdelay in retry_delays(tries, delay, backoff, max_delay, max_total_delay):
+                    try:
+                        result = f(self, *args, **kwargs)
+                        breaker.record_success()
+                        return result
+                    except exceptions as e:
+                        breaker.record_failure()
+                        if not breaker.allow():
+                            break
+                        log.warning(f"{e.__class__.__name__}, Retrying {f.__name__} in {mdelay:.2f} seconds...")
+                        count_retry(breaker)
+                        time.sleep(mdelay)
             if on_fail:
                 return on_fail(self)
+            if not breaker.allow():
+                raise RetrySettings.CircuitOpen(f"Circuit breaker {breaker.name} is open")
             return f(self, *args, **kwargs)
 
         return f_retry  # true decorator
 
-    return deco_retry
\ No newline at end of file
+    return deco_retry
+
+
+def async_retry(exceptions, tries=RetrySettings.tries, delay=RetrySettings.delay, backoff=RetrySettings.backoff,
+                logger=None, on_fail=None, max_delay=RetrySettings.max_delay,
+                max_total_delay=RetrySettings.max_total_delay, key=breaker_key):
+    """
+    Like retry, but for coroutine methods: waits with asyncio.sleep so other tasks keep running in the meantime.
+    on_fail may be a regular function or a coroutine function.
+    """
+
+    tries = validate_retry_settings(tries, delay, backoff)
+    log = logger or logging_setup.logging.getLogger(__name__)
+
+    def deco_retry(f):
+
+        @wraps(f)
+        async def f_retry(self, *args, **kwargs):
+            breaker = CircuitBreaker.get(key(self, f, *args))
+            if breaker.allow():
+                for mdelay in retry_delays(tries, delay, backoff, max_delay, max_total_delay):
+                    try:
+                        result = await f(self, *args, **kwargs)
+                        breaker.record_success()
+                        return result
+                    except exceptions as e:
+                        breaker.record_failure()
+                        if not breaker.allow():
+                            break
+                        log.warning(f"{e.__class__.__name__}, Retrying {f.__name__} in {mdelay:.2f} seconds...")
+                        count_retry(breaker)
+                        await asyncio.sleep(mdelay)
+            if on_fail:
+                result = on_fail(self)
+                return await result if asyncio.iscoroutine(result) else result
+            if not breaker.allow():
+                raise RetrySettings.CircuitOpen(f"Circuit breaker {breaker.name} is open")
+            return await f(self, *args, **kwargs)
+
+        return f_retry  # true decorator
+
+    return deco_retry
+
+
+def atomic_write(file_path, data):
+    """ Writes data to file_path so that the file contains either the old or the new data, even after a crash.
+
+    The data is written to a temporary file in the same folder first, which then replaces the original file.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    folder = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=os.path.basename(file_path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return len(data)
@@ -0,0 +1,113 @@
+""" Local stand-in for an exchange's WebSocket market data stream, to run and test WebSocketFeed offline.
+
+It speaks the protocol of feeds.JsonTradeAdapter: clients subscribe to market ids and receive random walk
+trades and top of book updates for them. Run it standalone with:
+    python ws_mock_server.py --port 8765 --interval 0.5
+and point a market's feed at it: "feed": {"type": "websocket", "url": "ws://localhost:8765"}
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+
+import websockets
+
+import logging_setup
+logger = logging_setup.logging.getLogger(__name__)
+
+
+class MockFeedServer:
+
+    def __init__(self, host="localhost", port=8765, interval=0.5, start_price=0.000005, volatility=0.002):
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.start_price = start_price
+        self.volatility = volatility
+        self.prices = {}
+        self.connections = set()
+        self.thread = None
+        self.loop = None
+        self.server = None
+
+    def next_price(self, symbol):
+        price = self.prices.get(symbol, self.start_price)
+        self.prices[symbol] = price * (1 + random.gauss(0, self.volatility))
+        return self.prices[symbol]
+
+    async def handler(self, websocket, path=None):
+        subscriptions = set()
+        self.connections.add(websocket)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), timeout=self.interval)
+                    data = json.loads(message)
+                    if data.get("op") == "subscribe":
+                        subscriptions.add(data["symbol"])
+                except asyncio.TimeoutError:
+                    pass
+                for symbol in subscriptions:
+                    price = self.next_price(symbol)
+                    spread = price * 0.001
+                    await websocket.send(json.dumps({"type": "trade", "symbol": symbol, "price": price}))
+                    await websocket.send(json.dumps({"type": "book", "symbol": symbol,
+                                                     "bid": price - spread, "ask": price + spread}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(websocket)
+
+    async def serve(self):
+        self.server = await websockets.serve(self.handler, self.host, self.port)
+        logger.info(f"Mock feed server listening on ws://{self.host}:{self.port}")
+        await self.server.wait_closed()
+
+    def start(self):
+        """ Runs the server in a background thread, e.g. from a test. """
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start_serving())
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="mock feed server", daemon=True)
+        self.thread.start()
+        started.wait()
+
+    async def start_serving(self):
+        self.server = await websockets.serve(self.handler, self.host, self.port)
+
+    def drop_connections(self):
+        """ Closes all client connections, to test reconnecting. """
+        for websocket in list(self.connections):
+            asyncio.run_coroutine_threadsafe(websocket.close(), self.loop)
+
+    def stop(self):
+        """ Closes the server and its connections, so clients see the disconnect. """
+        if self.loop is None or not self.loop.is_running():
+            return
+
+        async def close():
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between updates per market")
+    args = parser.parse_args()
+    asyncio.run(MockFeedServer(args.host, args.port, args.interval).serve())
+
+
+if __name__ == "__main__":
+    main()